@@ -0,0 +1,351 @@
+import argparse
+import logging
+import math
+import threading
+
+from meanRange import open_log
+from stream_stats import RunningStats
+import utils
+
+# Every statistic is an exponential moving average updated in O(1) per range,
+# compared to a baseline learned at the start of the session
+ewma_alpha = 0.02           # weight of a new value (about the last 50 values)
+baseline_count = 200        # values learning the baseline of an anchor
+
+# Anomalies
+bias_thresh = 0.2           # m, mean residual (antenna delay, moved anchor)
+noise_thresh = 0.3          # m, standard deviation of the residuals
+drift_slack = 0.1           # m, residual change ignored by the drift detection
+drift_thresh = 5.0          # m, accumulated change that flags a drift (CUSUM)
+dropout_thresh = 0.5        # fraction of the positions missing the anchor
+silent_after = 5.0          # s without range while the other anchors are received
+active_window = 30.0        # s, an anchor missing for longer is only reported silent
+weak_rx_power = -95.0       # dBm
+rx_power_drop = 6.0         # dB under the baseline
+hysteresis = 0.8            # a flag clears under that fraction of its threshold
+power_hysteresis = 3.0      # dB, same for the RX power flags
+min_leverage_slack = 0.2    # residuals of an anchor the position depends too much on are skipped
+
+
+def build_arg_parser():
+    """Build argument parser."""
+    p = argparse.ArgumentParser(
+        description="Anchor health: update rate, dropouts, residuals and RX " \
+                    "power of every anchor, with their anomalies"
+    )
+    p.add_argument('--csv', type=str, default="../logs/positions.csv",
+                    help='CSV file we want to read from (.gz, .bz2, .xz accepted)')
+    p.add_argument('--config', type=str, default="../config.json",
+                    help='Anchors of the room')
+    return p
+
+
+class Ewma:
+    """
+    Exponential moving average and variance of a stream, O(1) per value
+    """
+
+    def __init__(self, alpha=ewma_alpha):
+        self.alpha = alpha
+        self.mean = None
+        self.variance = 0.0
+
+    def add(self, value):
+        """
+        Args:
+            value (float) : new value
+        """
+        if self.mean is None:
+            self.mean = value
+            return
+        delta = value - self.mean
+        self.mean += self.alpha * delta
+        self.variance = (1 - self.alpha) * (self.variance + self.alpha * delta * delta)
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+
+class AnchorHealth:
+    """
+    Streaming statistics of one anchor
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.last_time = None
+        self.interval = Ewma()      # s between 2 ranges
+        self.dropout = Ewma()       # 1 when a position misses the anchor
+        self.residual = Ewma()      # measured - predicted range
+        self.rx_power = Ewma()
+        self.baseline = RunningStats()          # first residuals
+        self.power_baseline = RunningStats()    # first RX powers
+        self.cusum_high = 0.0
+        self.cusum_low = 0.0
+        self.flags = ["never seen"]
+
+    def add_range(self, timestamp):
+        if self.last_time is not None and timestamp > self.last_time:
+            self.interval.add(timestamp - self.last_time)
+        self.last_time = timestamp
+        self.count += 1
+        self.dropout.add(0.0)
+
+    def add_residual(self, residual):
+        self.residual.add(residual)
+        if self.baseline.count < baseline_count:
+            self.baseline.add(residual)
+            return
+        # Two sided CUSUM of the change from the baseline, bounded so that
+        # the flag clears once the residuals come back
+        change = residual - self.baseline.mean
+        self.cusum_high = min(max(0.0, self.cusum_high + change - drift_slack), 2 * drift_thresh)
+        self.cusum_low = min(max(0.0, self.cusum_low - change - drift_slack), 2 * drift_thresh)
+
+    def add_rx_power(self, power):
+        self.rx_power.add(power)
+        if self.power_baseline.count < baseline_count:
+            self.power_baseline.add(power)
+
+    def check(self, last_any):
+        """
+        Anomalies of the anchor. A raised flag clears a bit under its
+        threshold (hysteresis) so it doesn't blink on noisy statistics.
+
+        Args:
+            last_any (float) : time of the last range of any anchor
+
+        Returns:
+            flags (list of str) : empty if the anchor looks fine
+        """
+        if self.last_time is None:
+            return ["never seen"]
+        flags = []
+
+        def flag(name, value, thresh, clear=None):
+            if name in self.flags:
+                thresh = thresh * hysteresis if clear is None else clear
+            if value is not None and value > thresh:
+                flags.append(name)
+
+        flag("silent", last_any - self.last_time, silent_after)
+        flag("dropouts", self.dropout.mean, dropout_thresh)
+        if self.baseline.count >= baseline_count // 4:
+            flag("bias", abs(self.residual.mean), bias_thresh)
+            flag("noisy", self.residual.std, noise_thresh)
+        flag("drift", max(self.cusum_high, self.cusum_low), drift_thresh)
+        if self.rx_power.mean is not None:
+            flag("weak signal", -self.rx_power.mean, -weak_rx_power,
+                 -weak_rx_power - power_hysteresis)
+            if self.power_baseline.count >= baseline_count:
+                flag("power drop", self.power_baseline.mean - self.rx_power.mean, rx_power_drop,
+                     rx_power_drop - power_hysteresis)
+        return flags
+
+    def summary(self, now):
+        """
+        Args:
+            now (float) : current time
+
+        Returns:
+            summary (dict) : statistics and flags, JSON serializable
+        """
+        def rounded(value, digits):
+            return None if value is None else round(value, digits)
+
+        interval = self.interval.mean
+        return {
+            "ranges": self.count,
+            "rate": rounded(1 / interval if interval else None, 2),
+            "age": rounded(now - self.last_time if self.last_time is not None else None, 2),
+            "dropout": rounded(self.dropout.mean, 3),
+            "residual": rounded(self.residual.mean, 3),
+            "residual_std": rounded(self.residual.std if self.residual.mean is not None else None, 3),
+            "rx_power": rounded(self.rx_power.mean, 1),
+            "flags": list(self.flags),
+        }
+
+
+class AnchorMonitor:
+    """
+    Health of every anchor, fed with the solved positions. Each position
+    costs O(1) per anchor: moving averages and a CUSUM drift detector, no
+    history is kept. The flags are logged when they change and the
+    statistics are read by the live views (see dashboard.py).
+    """
+
+    def __init__(self, anchors):
+        """
+        Args:
+            anchors (dictionary{key: anchor id, value: tuple(x, y, z)}) :
+                                                    anchors positions with ids
+        """
+        self._lock = threading.Lock()
+        self.anchors = {k: (float(v[0]), float(v[1])) for k, v in anchors.items()}
+        self.health = {k: AnchorHealth() for k in anchors}
+        self.last_any = None
+
+    def update(self, ranges, x, y, timestamp, rx_power=None):
+        """
+        Add a solved position
+
+        Args:
+            ranges (dictionary{k: anchor id, v: distance float}) : ranges used
+                                                                   for the position
+            x (float) : x coordinate of the tag
+            y (float) : y coordinate of the tag
+            timestamp (float) : time of the position
+            rx_power (dictionary{k: anchor id, v: dBm float}, optional) : RX
+                                    power of the ranges (0.0 if not sent)
+        """
+        with self._lock:
+            self.last_any = timestamp if self.last_any is None else max(self.last_any, timestamp)
+            residuals = self.residuals(ranges, x, y)
+            for anchor_id in ranges:
+                health = self.health.get(anchor_id)
+                if health is None:
+                    continue
+                health.add_range(timestamp)
+                if anchor_id in residuals:
+                    health.add_residual(residuals[anchor_id])
+                power = rx_power.get(anchor_id) if rx_power else None
+                if power:
+                    health.add_rx_power(power)
+
+            for anchor_id, health in self.health.items():
+                if anchor_id not in ranges and health.last_time is not None \
+                        and timestamp - health.last_time < active_window:
+                    health.dropout.add(1.0)
+                flags = health.check(self.last_any)
+                if flags != health.flags:
+                    if flags:
+                        utils.logger.warning(f"Anchor {anchor_id}: {', '.join(flags)}")
+                    elif health.flags != ["never seen"]:
+                        utils.logger.info(f"Anchor {anchor_id} back to normal")
+                    health.flags = flags
+
+    def residuals(self, ranges, x, y):
+        """
+        Residual of each range against the position solved without the most
+        suspicious range. The least squares spreads the error of one anchor
+        on all the others: the anchor that agrees the least with the others
+        (largest studentized residual) gets its leave-one-out residual, and
+        the others are compared to the position solved without it. Both come
+        from the linearized solution, no other solve is needed.
+
+        Args:
+            ranges (dictionary{k: anchor id, v: distance float}) : ranges used
+            x (float) : x coordinate of the tag
+            y (float) : y coordinate of the tag
+
+        Returns:
+            residuals (dictionary{k: anchor id, v: float}) : measured minus
+                        predicted range in m, empty without redundant ranges
+                        (less than 4)
+        """
+        ids = [a for a in ranges if a in self.anchors]
+        if len(ids) < 4:
+            return {}
+        units, raw = [], []
+        for anchor_id in ids:
+            ax, ay = self.anchors[anchor_id]
+            dx, dy = x - ax, y - ay
+            distance = math.hypot(dx, dy)
+            if distance < 1e-6:
+                return {}
+            units.append((dx / distance, dy / distance))
+            raw.append(float(ranges[anchor_id]) - distance)
+
+        # Inverse of J^T J, J the unit vectors from the anchors to the tag
+        a = sum(ux * ux for ux, _ in units)
+        b = sum(ux * uy for ux, uy in units)
+        c = sum(uy * uy for _, uy in units)
+        det = a * c - b * b
+        if det < 1e-9:
+            return {}
+        slack = [1 - (c * ux * ux - 2 * b * ux * uy + a * uy * uy) / det for ux, uy in units]
+        if min(slack) < min_leverage_slack:
+            return {}   # one anchor alone fixes the position, nothing to compare it to
+
+        worst = max(range(len(ids)), key=lambda i: abs(raw[i]) / math.sqrt(slack[i]))
+        deleted = raw[worst] / slack[worst]
+        ux, uy = units[worst]
+        # Move of the position when the worst range is removed
+        shift_x = -(c * ux - b * uy) / det * deleted
+        shift_y = -(a * uy - b * ux) / det * deleted
+
+        residuals = {}
+        for i, anchor_id in enumerate(ids):
+            if i == worst:
+                residuals[anchor_id] = deleted
+            else:
+                residuals[anchor_id] = raw[i] - (units[i][0] * shift_x + units[i][1] * shift_y)
+        return residuals
+
+    def status(self, now=None):
+        """
+        Args:
+            now (float, optional) : current time. Defaults to the last position
+
+        Returns:
+            status (dictionary{k: anchor id, v: dict}) : see AnchorHealth.summary
+        """
+        with self._lock:
+            if now is None:
+                now = self.last_any or 0.0
+            return {anchor_id: health.summary(now) for anchor_id, health in self.health.items()}
+
+
+def monitor_csv(path, anchors):
+    """
+    Run the monitor on a positions log
+
+    Args:
+        path (str) : CSV log
+        anchors (dictionary{key: anchor id, value: tuple(x, y, z)})
+
+    Returns:
+        monitor (AnchorMonitor) : state at the end of the log
+    """
+    from datetime import datetime
+
+    monitor = AnchorMonitor(anchors)
+    with open_log(path) as file:
+        for row in utils.read_log(file):
+            try:
+                ranges = {row[f"id_{i}"]: float(row[f"d{i}"]) for i in range(1, 5)
+                          if row.get(f"id_{i}") and row.get(f"d{i}")}
+                x, y = float(row["pos_x"]), float(row["pos_y"])
+                # str(datetime) has no fraction when the microseconds are 0
+                t = datetime.fromisoformat(row["Timestamp"]).timestamp()
+            except (KeyError, TypeError, ValueError):
+                continue  # skip invalid rows
+            monitor.update(ranges, x, y, t)
+    return monitor
+
+
+def main():
+    parser = build_arg_parser()
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO) # To see the results
+    utils.setup_logging()
+
+    anchors = utils.load_anchors(args.config)
+    if not anchors:
+        return
+    monitor = monitor_csv(args.csv, anchors)
+
+    logging.info(f"{'Anchor':<8}{'Ranges':>8}{'Rate':>8}{'Drop':>7}{'Resid.':>8}{'Std':>7}"
+                 f"{'RX':>8}  Flags")
+    for anchor_id, s in sorted(monitor.status().items()):
+        def fmt(value):
+            return "-" if value is None else value
+        logging.info(f"{anchor_id:<8}{s['ranges']:>8}{fmt(s['rate']):>8}{fmt(s['dropout']):>7}"
+                     f"{fmt(s['residual']):>8}{fmt(s['residual_std']):>7}"
+                     f"{fmt(s['rx_power']):>8}  {', '.join(s['flags'])}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import os
+import struct
+import time
+
+# Raw capture of a Tag connection: every chunk received by the server with
+# its receive time, so a session can be replayed exactly (see replay.py).
+#
+#   file header : "SPCAP", version (B), length of the address (H), address
+#   records     : receive time (d, time.time()), length (I), bytes received
+
+CAPTURE_MAGIC = b"SPCAP"
+CAPTURE_VERSION = 1
+
+HEADER = struct.Struct("<5sBH")
+RECORD = struct.Struct("<dI")
+
+
+class CaptureWriter:
+    """
+    Records the bytes received on one connection
+    """
+
+    def __init__(self, directory, addr):
+        """
+        Args:
+            directory (str) : folder of the captures, created if needed
+            addr (tuple(ip, port)) : address of the Tag
+        """
+        os.makedirs(directory, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d_%H%M%S')}_{addr[0]}_{addr[1]}.spcap"
+        self.path = os.path.join(directory, name)
+        self.file = open(self.path, "wb")
+        address = f"{addr[0]}:{addr[1]}".encode("utf-8")
+        self.file.write(HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, len(address)) + address)
+
+    def write(self, chunk, recv_time=None):
+        """
+        Args:
+            chunk (bytes) : data received
+            recv_time (float, optional) : time of the reception. Defaults to now
+        """
+        if recv_time is None:
+            recv_time = time.time()
+        self.file.write(RECORD.pack(recv_time, len(chunk)) + chunk)
+
+    def flush(self):
+        """ Write the buffered records (connection lost, maybe resumed later) """
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CaptureReader:
+    """
+    Reads a capture, record by record (constant memory)
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str) : capture file
+
+        Raises:
+            ValueError : not a capture file
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise ValueError(f"{path} is not a capture")
+            magic, version, length = HEADER.unpack(header)
+            if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+                raise ValueError(f"{path} is not a capture (version {CAPTURE_VERSION})")
+            ip, _, port = f.read(length).decode("utf-8").rpartition(":")
+        self.addr = (ip, int(port))
+        self.offset = HEADER.size + length
+
+    def __iter__(self):
+        """
+        Yields:
+            recv_time (float) : time of the reception
+            chunk (bytes) : data received
+        """
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            while True:
+                record = f.read(RECORD.size)
+                if len(record) < RECORD.size:
+                    return
+                recv_time, length = RECORD.unpack(record)
+                chunk = f.read(length)
+                if len(chunk) < length:
+                    return  # the server stopped while writing it
+                yield recv_time, chunk
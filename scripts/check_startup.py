@@ -0,0 +1,91 @@
+import argparse
+import logging
+import statistics
+import subprocess
+import sys
+import time
+
+# Cold start budgets in seconds (interpreter + imports + argparse), measured
+# with `python <script> --help`. Chosen for a Raspberry Pi, a laptop is ~5x faster
+budgets = {
+    "server.py": 1.0,
+    "meanRange.py": 0.3,
+}
+
+# Modules that must never be loaded by the headless ingestion path
+heavy_modules = ["matplotlib", "scipy", "tkinter", "turtle", "zeroconf"]
+
+
+def build_arg_parser():
+    """Build argument parser."""
+    p = argparse.ArgumentParser(
+        description="Measure the cold start time of the scripts and check " \
+                    "that no plotting/GUI module is imported by the server"
+    )
+    p.add_argument('--runs', type=int, default=5,
+                    help='Number of cold starts measured per script (median kept)')
+    return p
+
+
+def cold_start(script, runs):
+    """
+    Median wall time of `python script --help` in a fresh interpreter
+
+    Args:
+        script (str) : script to start
+        runs (int) : number of measures
+
+    Returns:
+        seconds (float) : median of the measures
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, script, "--help"],
+                       stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def loaded_heavy_modules(module):
+    """
+    Heavy modules present in sys.modules after importing a module
+
+    Args:
+        module (str) : module name to import (ex: server)
+
+    Returns:
+        loaded (list of str) : heavy modules that were imported
+    """
+    code = (
+        f"import sys, {module}\n"
+        f"print(' '.join(m for m in {heavy_modules!r} if m in sys.modules))"
+    )
+    result = subprocess.run([sys.executable, "-c", code],
+                            capture_output=True, text=True, check=True)
+    return result.stdout.split()
+
+
+def main():
+    parser = build_arg_parser()
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO) # To see the results
+
+    ok = True
+    for script, budget in budgets.items():
+        seconds = cold_start(script, args.runs)
+        status = "OK" if seconds <= budget else "OVER BUDGET"
+        ok = ok and seconds <= budget
+        logging.info(f"{script}: {seconds:.3f} s (budget {budget:.1f} s) {status}")
+
+    loaded = loaded_heavy_modules("server")
+    if loaded:
+        ok = False
+        logging.error(f"server imports heavy modules at startup: {', '.join(loaded)}")
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
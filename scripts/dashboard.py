@@ -0,0 +1,304 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import utils
+
+DASHBOARD_IP = "127.0.0.1"  # Local machine only
+DASHBOARD_PORT = 8000
+
+tick = 0.2          # seconds between 2 batches sent to the browsers
+max_client_rate = 1 / tick
+default_client_rate = 2.0   # updates per second if the page doesn't ask
+
+
+class Broadcaster:
+    """
+    Builds one batch per tick from the LiveState and shares it with every
+    client. The JSON is encoded once per tick no matter how many browsers
+    are connected, and nothing is built when the state did not change.
+    """
+
+    def __init__(self, live_state, monitor=None):
+        self.live_state = live_state
+        self.monitor = monitor
+        self.condition = threading.Condition()
+        self.payload = None
+        self.seq = 0
+
+    def run(self):
+        """ Tick forever, to be started in a daemon thread """
+        last_version = -1
+        while True:
+            version, tags = self.live_state.snapshot()
+            if version != last_version:
+                last_version = version
+                batch = {
+                    "time": time.time(),
+                    "tags": {
+                        k: {"x": v["x"], "y": v["y"], "time": v["time"]}
+                        for k, v in tags.items()
+                    },
+                    "stops": self.live_state.stops(),
+                    "zones": self.live_state.zones(),
+                    "proximity": self.live_state.proximity(),
+                    "anchors": self.live_state.anchors_status(),
+                    "health": self.monitor.status(time.time()) if self.monitor else {},
+                }
+                payload = f"data: {json.dumps(batch)}\n\n".encode("utf-8")
+                with self.condition:
+                    self.payload = payload
+                    self.seq += 1
+                    self.condition.notify_all()
+            time.sleep(tick)
+
+    def wait(self, last_seq, timeout):
+        """
+        Wait for a batch newer than last_seq
+
+        Args:
+            last_seq (int) : sequence number of the last batch sent
+            timeout (float) : maximum wait in seconds
+
+        Returns:
+            seq (int) : sequence number of the latest batch
+            payload (bytes or None) : latest batch, None if nothing new
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.seq != last_seq, timeout)
+            if self.seq == last_seq:
+                return last_seq, None
+            return self.seq, self.payload
+
+
+def make_handler(broadcaster, anchors, zones=None, monitor=None):
+    """
+    Build the request handler class bound to a broadcaster
+
+    Args:
+        broadcaster (Broadcaster) : source of the batches
+        anchors (dictionary{key: anchor id, value: tuple(x, y, z)}) :
+                                                    anchors positions with ids
+        zones (dictionary{key: zone name, value: numpy.ndarray}, optional) :
+                                                    polygons of the zones
+        monitor (anchor_health.AnchorMonitor, optional) : served on /health
+
+    Returns:
+        handler (class) : BaseHTTPRequestHandler subclass
+    """
+    anchors_json = json.dumps({k: list(v) for k, v in anchors.items()}).encode("utf-8")
+    zones_json = json.dumps({k: v.tolist() for k, v in (zones or {}).items()}).encode("utf-8")
+
+    class DashboardHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/":
+                self.send_body(PAGE.encode("utf-8"), "text/html; charset=utf-8")
+            elif url.path == "/anchors":
+                self.send_body(anchors_json, "application/json")
+            elif url.path == "/zones":
+                self.send_body(zones_json, "application/json")
+            elif url.path == "/health":
+                # For scripts and alerting: curl localhost:8000/health
+                status = monitor.status(time.time()) if monitor else {}
+                self.send_body(json.dumps(status).encode("utf-8"), "application/json")
+            elif url.path == "/events":
+                self.stream(parse_qs(url.query))
+            else:
+                self.send_error(404)
+
+        def send_body(self, body, content_type):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def stream(self, query):
+            """
+            Server-Sent Events stream. Each client gets at most `rate` batches
+            per second: the batches in between are skipped since each one
+            already holds the full latest state.
+            """
+            try:
+                rate = float(query.get("rate", [default_client_rate])[0])
+            except ValueError:
+                rate = default_client_rate
+            rate = min(max(rate, 0.1), max_client_rate)
+            period = 1 / rate
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+
+            seq = -1
+            try:
+                while True:
+                    seq, payload = broadcaster.wait(seq, timeout=15.0)
+                    if payload is None:
+                        self.wfile.write(b": keepalive\n\n")   # SSE comment
+                    else:
+                        self.wfile.write(payload)
+                    self.wfile.flush()
+                    time.sleep(period)
+            except (ConnectionResetError, BrokenPipeError):
+                utils.logger.debug("Dashboard client left")
+
+        def log_message(self, format, *args):
+            utils.logger.debug("Dashboard: " + format % args)
+
+    return DashboardHandler
+
+
+def start(live_state, anchors, port=DASHBOARD_PORT, zones=None, monitor=None):
+    """
+    Start the dashboard in background threads
+
+    Args:
+        live_state (LiveState) : state published by the ingestion loop
+        anchors (dictionary{key: anchor id, value: tuple(x, y, z)}) :
+                        anchors positions with ids, empty or None without config
+        port (int, optional) : HTTP port. Defaults to DASHBOARD_PORT
+        zones (dictionary{key: zone name, value: numpy.ndarray}, optional) :
+                                                    polygons drawn on the map
+        monitor (anchor_health.AnchorMonitor, optional) : health of the anchors
+
+    Returns:
+        httpd (ThreadingHTTPServer) : the running server
+    """
+    anchors = anchors or {}     # utils.load_anchors gives [] without config
+    broadcaster = Broadcaster(live_state, monitor)
+    threading.Thread(target=broadcaster.run, daemon=True).start()
+
+    httpd = ThreadingHTTPServer((DASHBOARD_IP, port), make_handler(broadcaster, anchors, zones, monitor))
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    utils.logger.info(f"Dashboard on http://{DASHBOARD_IP}:{port}/")
+    return httpd
+
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Spatial Pedagogy</title>
+<style>
+  body { font-family: Arial, sans-serif; margin: 0; display: flex; }
+  canvas { border-right: 1px solid #ccc; }
+  #side { padding: 10px; font-size: 13px; }
+  table { border-collapse: collapse; }
+  td, th { padding: 2px 8px; text-align: left; }
+  .stale { color: #c00; }
+</style>
+</head>
+<body>
+<canvas id="map" width="800" height="600"></canvas>
+<div id="side">
+  <h3>Tags</h3><table id="tags"></table>
+  <h3>Groups</h3><div id="groups"></div>
+  <h3>Anchors</h3><table id="anchors"></table>
+</div>
+<script>
+const canvas = document.getElementById("map");
+const ctx = canvas.getContext("2d");
+const colors = ["blue", "red", "orange", "purple", "brown", "magenta", "cyan", "gray"];
+let anchors = {};
+let zones = {};
+let view = {x0: 0, y0: 0, scale: 50};
+
+function fit() {
+  const xs = Object.values(anchors).map(a => a[0]);
+  const ys = Object.values(anchors).map(a => a[1]);
+  if (!xs.length) return;
+  const pad = 1;
+  const x0 = Math.min(...xs) - pad, x1 = Math.max(...xs) + pad;
+  const y0 = Math.min(...ys) - pad, y1 = Math.max(...ys) + pad;
+  view = {x0: x0, y0: y0,
+          scale: Math.min(canvas.width / (x1 - x0), canvas.height / (y1 - y0))};
+}
+
+function px(x, y) {
+  return [(x - view.x0) * view.scale, (y - view.y0) * view.scale];
+}
+
+function dot(x, y, r, color, label) {
+  const [u, v] = px(x, y);
+  ctx.fillStyle = color;
+  ctx.beginPath(); ctx.arc(u, v, r, 0, 2 * Math.PI); ctx.fill();
+  if (label) { ctx.fillStyle = "black"; ctx.fillText(label, u + r + 2, v); }
+}
+
+function draw(batch) {
+  ctx.clearRect(0, 0, canvas.width, canvas.height);
+  ctx.strokeStyle = "#999";
+  for (const [name, polygon] of Object.entries(zones)) {
+    ctx.beginPath();
+    polygon.forEach((p, i) => { const [u, v] = px(p[0], p[1]); i ? ctx.lineTo(u, v) : ctx.moveTo(u, v); });
+    ctx.closePath(); ctx.stroke();
+    const [u, v] = px(polygon[0][0], polygon[0][1]);
+    ctx.fillStyle = "#999"; ctx.fillText(name, u + 3, v + 12);
+  }
+  for (const [id, a] of Object.entries(anchors)) {
+    const s = batch.anchors[id];
+    dot(a[0], a[1], 8, s && s.age < 2 ? "green" : "lightgray", id);
+  }
+  ctx.strokeStyle = "green";
+  for (const [a, b] of batch.proximity.close) {
+    const ta = batch.tags[a], tb = batch.tags[b];
+    if (!ta || !tb) continue;
+    const [u1, v1] = px(ta.x, ta.y), [u2, v2] = px(tb.x, tb.y);
+    ctx.beginPath(); ctx.moveTo(u1, v1); ctx.lineTo(u2, v2); ctx.stroke();
+  }
+  const ids = Object.keys(batch.tags).sort();
+  ids.forEach((id, i) => {
+    const color = colors[i % colors.length];
+    for (const s of batch.stops[id] || []) dot(s.x, s.y, 5, color, "");
+    const t = batch.tags[id];
+    dot(t.x, t.y, 8, color, id);
+  });
+
+  let rows = "<tr><th>Tag</th><th>x</th><th>y</th><th>Stops</th><th>Zone</th><th>Time per zone (s)</th></tr>";
+  for (const id of ids) {
+    const t = batch.tags[id];
+    const z = batch.zones[id] || {dwell: {}};
+    const dwell = Object.entries(z.dwell).map(([k, v]) => `${k}: ${v}`).join(", ");
+    rows += `<tr><td>${id}</td><td>${t.x}</td><td>${t.y}</td>` +
+            `<td>${(batch.stops[id] || []).length}</td><td>${z.zone || ""}</td><td>${dwell}</td></tr>`;
+  }
+  document.getElementById("tags").innerHTML = rows;
+  document.getElementById("groups").innerHTML =
+    batch.proximity.groups.map(g => g.join(", ")).join("<br>") || "none";
+
+  rows = "<tr><th>Anchor</th><th>Range</th><th>Tag</th><th>Age (s)</th>" +
+         "<th>Rate (Hz)</th><th>Dropouts</th><th>Residual (m)</th><th>RX (dBm)</th><th>Health</th></tr>";
+  for (const id of Object.keys(anchors).sort()) {
+    const s = batch.anchors[id];
+    const h = batch.health[id];
+    const health = h ? `<td>${h.rate ?? ""}</td><td>${h.dropout ?? ""}</td>` +
+                       `<td>${h.residual ?? ""} ± ${h.residual_std ?? ""}</td><td>${h.rx_power ?? ""}</td>` +
+                       `<td>${h.flags.join(", ") || "ok"}</td>` : '<td colspan="5"></td>';
+    if (!s) { rows += `<tr class="stale"><td>${id}</td><td colspan="3">never seen</td>${health}</tr>`; continue; }
+    const bad = s.age >= 2 || (h && h.flags.length);
+    rows += `<tr class="${bad ? "stale" : ""}"><td>${id}</td><td>${s.range}</td>` +
+            `<td>${s.tag}</td><td>${s.age}</td>${health}</tr>`;
+  }
+  document.getElementById("anchors").innerHTML = rows;
+}
+
+Promise.all([fetch("/anchors").then(r => r.json()), fetch("/zones").then(r => r.json())]).then(([a, z]) => {
+  anchors = a;
+  zones = z;
+  fit();
+  const rate = new URLSearchParams(location.search).get("rate") || 2;
+  const events = new EventSource("/events?rate=" + rate);
+  events.onmessage = e => draw(JSON.parse(e.data));
+});
+</script>
+</body>
+</html>
+"""
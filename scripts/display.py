@@ -0,0 +1,160 @@
+import turtle
+
+import utils
+
+meter2pixel = 50   # Ususally always fit in the window (real-time only)
+                    # Decrease this number if the anchors are at more than 3-4 meters apart
+
+max_fps = 10    # The window is never redrawn faster than that
+
+# Colors cycled through when there are many tags
+tag_colors = ["blue", "red", "orange", "purple", "brown", "magenta", "cyan", "gray"]
+
+
+def to_screen(x, y):
+    """
+    Convert a position in meters to turtle window coordinates
+
+    Args:
+        x (float) : x coordinate in meters
+        y (float) : y coordinate in meters
+
+    Returns:
+        pos_x, pos_y (int) : coordinates in the turtle window
+    """
+    pos_x = -250 + int(x * meter2pixel) # constants to fit in turtle window
+    pos_y = 150 - int(y * meter2pixel)
+    return pos_x, pos_y
+
+
+def run(live_state, anchors, fps=max_fps):
+    """
+    Display the live position of every tag. Has to run in the main thread
+    (Tk requirement) while the ingestion runs in another one.
+
+    The anchors are static, so they are drawn only once. The tags layer is
+    redrawn at most `fps` times per second and only if the state changed.
+    Nothing here is called by the ingestion, so a slow window never delays
+    the socket reads.
+
+    Args:
+        live_state (LiveState) : state published by the ingestion loop
+        anchors (dictionary{key: anchor id, value: tuple(x, y, z)}) :
+                                                    anchors positions with ids
+        fps (int, optional) : maximum redraws per second. Defaults to max_fps
+    """
+    screen = screen_init()
+
+    for anchor_id, (ax, ay, az) in anchors.items():
+        pos_x, pos_y = to_screen(ax, ay)
+        draw_uwb_anchor(pos_x, pos_y, anchor_id, t_anchors)
+    screen.update()
+
+    interval = max(1, int(1000 / fps))
+    last_version = -1
+
+    def render():
+        nonlocal last_version
+        version, tags = live_state.snapshot()
+
+        if version != last_version:
+            clean(t_tag)
+            for i, (tag_id, tag) in enumerate(sorted(tags.items())):
+                color = tag_colors[i % len(tag_colors)]
+                draw_uwb_tag(tag["x"], tag["y"], str(tag_id), t_tag, color)
+            screen.update()
+            last_version = version
+
+        screen.ontimer(render, interval)
+
+    render()
+
+    try:
+        screen.mainloop()
+    except turtle.Terminator:
+        utils.logger.info("Display window closed")
+
+
+# All the functions under this point are functions to display the turtle window in real-time only
+# They are functions directly taken from the Makerfabs showcase code for the Tag and Anchors
+# https://github.com/Makerfabs/Makerfabs-ESP32-UWB/blob/main/example/IndoorPositioning/uwb_position_display.py
+
+def screen_init():
+    """
+    Initialize the turtle-based UI
+
+    Returns:
+        screen (turtle.Screen) : the window, updated manually
+    """
+    screen = turtle.Screen()
+    screen.setup(1200, 800)
+    screen.tracer(0)    # No animation, we call update() ourselves
+
+    global t_anchors, t_tag
+
+    t_anchors = turtle.Turtle()
+    t_tag = turtle.Turtle()
+    turtle_init(t_anchors)
+    turtle_init(t_tag)
+
+    return screen
+
+
+def turtle_init(t=turtle):
+    """
+    Initialize a turtle object
+    """
+    t.hideturtle()
+    t.speed(0)
+
+
+def fill_cycle(x, y, r, color="black", t=turtle):
+    """
+    Draw a filled circle on the screen
+    """
+    t.up()
+    t.goto(x, y)
+    t.down()
+    t.dot(r, color)
+    t.up()
+
+
+def write_txt(x, y, txt, color="black", t=turtle, f=('Arial', 12, 'normal')):
+    """
+    Write text at a given position
+    """
+
+    t.pencolor(color)
+    t.up()
+    t.goto(x, y)
+    t.down()
+    t.write(txt, move=False, align='left', font=f)
+    t.up()
+
+
+def clean(t=turtle):
+    """
+    Clear a turtle layer
+    """
+    t.clear()
+
+
+def draw_uwb_anchor(x, y, txt, t):
+    """
+    Draw a UWB anchor point
+    """
+    r = 20
+    fill_cycle(x, y, r, "green", t)
+    write_txt(x + r, y, txt,
+              "black",  t, f=('Arial', 16, 'normal'))
+
+
+def draw_uwb_tag(x, y, txt, t, color="blue"):
+    """
+    Draw the tag position
+    """
+    pos_x, pos_y = to_screen(x, y)
+    r = 20
+    fill_cycle(pos_x, pos_y, r, color, t)
+    write_txt(pos_x, pos_y, txt + ": (" + str(x) + "," + str(y) + ")",
+              "black",  t, f=('Arial', 16, 'normal'))
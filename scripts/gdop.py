@@ -0,0 +1,328 @@
+import argparse
+import hashlib
+from itertools import combinations
+import json
+import logging
+import os
+
+import numpy as np
+
+import utils
+
+map_cell = 0.1          # m, resolution of the precision map
+map_padding = 1.0       # m, room around the anchors covered by the map
+range_sigma = 0.1       # m, standard deviation of one range (chip incertitude)
+min_subset_size = 2     # the 2 anchors case is mapped to show its ambiguity
+
+cache_dir = "../logs/gdop"
+cache_format = 1        # change it when the content of the cache changes
+
+subset_batch = 5_000_000    # max subset x cell values computed at once
+
+
+def build_arg_parser():
+    """Build argument parser."""
+    p = argparse.ArgumentParser(
+        description="Dilution of precision and expected position error over " \
+                    "the room, for every subset of anchors of a config"
+    )
+    p.add_argument('--config', type=str, default="../config.json",
+                    help='Config file with the anchors')
+    p.add_argument('--cell', type=float, default=map_cell,
+                    help='Size of the cells of the map in meters')
+    p.add_argument('--sigma', type=float, default=range_sigma,
+                    help='Standard deviation of one range in meters')
+    p.add_argument('--worst', type=int, default=10,
+                    help='Number of worst subsets printed')
+    return p
+
+
+def anchor_subsets(nb_anchors, min_size=min_subset_size):
+    """
+    Every subset of at least min_size anchors
+
+    Args:
+        nb_anchors (int) : number of anchors
+        min_size (int, optional) : smallest subset
+
+    Returns:
+        masks (numpy.ndarray) : shape (nb_subsets, nb_anchors) booleans
+    """
+    masks = []
+    for size in range(min_size, nb_anchors + 1):
+        for subset in combinations(range(nb_anchors), size):
+            mask = np.zeros(nb_anchors, dtype=bool)
+            mask[list(subset)] = True
+            masks.append(mask)
+    return np.array(masks, dtype=bool).reshape(-1, nb_anchors)
+
+
+def unit_terms(anchor_xy, points):
+    """
+    Terms of H^T.H of each anchor at each point, with H the unit vectors from
+    the points to the anchors. The H^T.H of a subset is the sum of the terms
+    of its anchors.
+
+    Args:
+        anchor_xy (numpy.ndarray) : shape (nb_anchors, 2)
+        points (numpy.ndarray) : shape (nb_points, 2)
+
+    Returns:
+        uxx, uxy, uyy (numpy.ndarray) : shape (nb_anchors, nb_points) each
+    """
+    delta = points[None, :, :] - anchor_xy[:, None, :]  # (anchors, points, 2)
+    norm = np.linalg.norm(delta, axis=2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        unit = np.where(norm[..., None] > 0, delta / norm[..., None], 0.0)
+    return unit[..., 0] ** 2, unit[..., 0] * unit[..., 1], unit[..., 1] ** 2
+
+
+def dilution_of_precision(anchor_xy, masks, points, terms=None):
+    """
+    Horizontal dilution of precision of every subset at every point. All the
+    subsets are one matrix product of the masks with the unit_terms.
+
+    A subset whose anchors are all on one line (or at 2 positions, ex:
+    coincident anchors) has a mirror solution: its DOP is infinite.
+
+    Args:
+        anchor_xy (numpy.ndarray) : shape (nb_anchors, 2)
+        masks (numpy.ndarray) : shape (nb_subsets, nb_anchors) booleans
+        points (numpy.ndarray) : shape (nb_points, 2)
+        terms (tuple, optional) : unit_terms(anchor_xy, points), when many
+                                  calls are made with the same anchors
+
+    Returns:
+        dop (numpy.ndarray) : shape (nb_subsets, nb_points) float32
+    """
+    uxx, uxy, uyy = unit_terms(anchor_xy, points) if terms is None else terms
+
+    # Spread of the anchors of each subset (zero if they are on a line)
+    weights = masks.astype(float)
+    count = weights.sum(axis=1)
+    mean = weights @ anchor_xy / count[:, None]
+    centered = anchor_xy[None, :, :] - mean[:, None, :]
+    sxx = (weights * centered[..., 0] ** 2).sum(axis=1)
+    sxy = (weights * centered[..., 0] * centered[..., 1]).sum(axis=1)
+    syy = (weights * centered[..., 1] ** 2).sum(axis=1)
+    ambiguous = sxx * syy - sxy ** 2 < 1e-6
+
+    dop = np.empty((len(masks), len(points)), dtype=np.float32)
+    batch = max(1, subset_batch // max(1, len(points)))
+    for start in range(0, len(masks), batch):
+        w = weights[start:start + batch]
+        a, b, c = w @ uxx, w @ uxy, w @ uyy
+        det = a * c - b * b
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # sqrt(trace((H^T.H)^-1)) of the 2x2 matrices
+            value = np.sqrt((a + c) / det)
+        value[~(det > 1e-9)] = np.inf
+        dop[start:start + batch] = value
+    dop[ambiguous] = np.inf
+    return dop
+
+
+def config_hash(anchors, cell, sigma):
+    """
+    Identifier of a precision map: it changes with any anchor or parameter
+
+    Args:
+        anchors (dictionary{key: anchor id, value: tuple(x, y, z)})
+        cell (float) : size of the cells
+        sigma (float) : standard deviation of one range
+
+    Returns:
+        hash (str) : hexadecimal digest
+    """
+    content = json.dumps({
+        "format": cache_format,
+        "anchors": {k: [round(float(c), 4) for c in v[:2]] for k, v in sorted(anchors.items())},
+        "cell": cell,
+        "padding": map_padding,
+        "min_subset_size": min_subset_size,
+        "sigma": sigma,
+    }, sort_keys=True)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()[:16]
+
+
+class PrecisionMap:
+    """
+    Expected position error of every anchor subset on a grid over the room.
+    Computed once per anchor configuration (and cached on disk), a lookup is
+    then a dictionary access and an index computation.
+    """
+
+    def __init__(self, ids, anchor_xy, masks, dop, origin, cell, sigma):
+        """
+        Args:
+            ids (list of str) : anchor ids, in the order of the mask columns
+            anchor_xy (numpy.ndarray) : shape (nb_anchors, 2)
+            masks (numpy.ndarray) : shape (nb_subsets, nb_anchors) booleans
+            dop (numpy.ndarray) : shape (nb_subsets, nx, ny)
+            origin (numpy.ndarray) : (x, y) of the corner of the first cell
+            cell (float) : size of the cells
+            sigma (float) : standard deviation of one range
+        """
+        self.ids = list(ids)
+        self.anchor_xy = anchor_xy
+        self.masks = masks
+        self.dop = dop
+        self.origin = np.asarray(origin, dtype=float)
+        self.cell = float(cell)
+        self.sigma = float(sigma)
+        self._bits = {anchor_id: 1 << i for i, anchor_id in enumerate(self.ids)}
+        self._rows = {int(bits): row for row, bits in enumerate(masks @ (1 << np.arange(len(self.ids))))}
+
+    @classmethod
+    def compute(cls, anchors, cell=map_cell, sigma=range_sigma):
+        """
+        Args:
+            anchors (dictionary{key: anchor id, value: tuple(x, y, z)})
+            cell (float, optional) : size of the cells in meters
+            sigma (float, optional) : standard deviation of one range
+
+        Returns:
+            precision_map (PrecisionMap)
+        """
+        ids = sorted(anchors)
+        anchor_xy = np.array([anchors[k][:2] for k in ids], dtype=float).reshape(-1, 2)
+        origin = anchor_xy.min(axis=0) - map_padding
+        shape = np.ceil((anchor_xy.max(axis=0) + map_padding - origin) / cell).astype(int)
+
+        # Centers of all the cells, x major (same layout as zones.ZoneGrid)
+        ix, iy = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing="ij")
+        centers = origin + (np.stack([ix.ravel(), iy.ravel()], axis=1) + 0.5) * cell
+
+        masks = anchor_subsets(len(ids))
+        dop = dilution_of_precision(anchor_xy, masks, centers).reshape(len(masks), *shape)
+        return cls(ids, anchor_xy, masks, dop, origin, cell, sigma)
+
+    @classmethod
+    def load(cls, anchors, cell=map_cell, sigma=range_sigma, directory=cache_dir):
+        """
+        Precision map of a config, read from the cache or computed and saved
+
+        Args:
+            anchors (dictionary{key: anchor id, value: tuple(x, y, z)})
+            cell (float, optional) : size of the cells in meters
+            sigma (float, optional) : standard deviation of one range
+            directory (str, optional) : cache directory
+
+        Returns:
+            precision_map (PrecisionMap)
+        """
+        path = os.path.join(directory, f"{config_hash(anchors, cell, sigma)}.npz")
+        if os.path.exists(path):
+            with np.load(path) as data:
+                utils.logger.debug(f"Precision map loaded from {path}")
+                return cls(data["ids"].tolist(), data["anchor_xy"], data["masks"],
+                           data["dop"], data["origin"], cell, sigma)
+
+        precision_map = cls.compute(anchors, cell, sigma)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp.npz"
+            np.savez_compressed(tmp, ids=np.array(precision_map.ids), anchor_xy=precision_map.anchor_xy,
+                                masks=precision_map.masks, dop=precision_map.dop,
+                                origin=precision_map.origin)
+            os.replace(tmp, path)   # never leave a half written cache
+            utils.logger.debug(f"Precision map saved in {path}")
+        except OSError as e:
+            utils.logger.warning(f"Cannot save the precision map ({e})")
+        return precision_map
+
+    def subset_row(self, anchor_ids):
+        """
+        Args:
+            anchor_ids (iterable of str) : anchors used for a position
+
+        Returns:
+            row (int or None) : index of the subset in masks/dop, None if it
+                                was not mapped (unknown anchor, too few anchors)
+        """
+        bits = 0
+        for anchor_id in anchor_ids:
+            bit = self._bits.get(anchor_id)
+            if bit is None:
+                return None
+            bits |= bit
+        return self._rows.get(bits)
+
+    def expected_error(self, anchor_ids, x, y):
+        """
+        Expected position error (sigma x DOP) of one position
+
+        Args:
+            anchor_ids (iterable of str) : anchors used for the position
+            x (float) : x coordinate
+            y (float) : y coordinate
+
+        Returns:
+            error (float or None) : meters, inf if the geometry is ambiguous,
+                                    None if the position is outside of the map
+        """
+        row = self.subset_row(anchor_ids)
+        if row is None:
+            return None
+        ix = int((x - self.origin[0]) // self.cell)
+        iy = int((y - self.origin[1]) // self.cell)
+        if 0 <= ix < self.dop.shape[1] and 0 <= iy < self.dop.shape[2]:
+            return self.sigma * float(self.dop[row, ix, iy])
+        return None
+
+    def error_grid(self, anchor_ids=None):
+        """
+        Expected error over the whole map for one subset
+
+        Args:
+            anchor_ids (iterable of str, optional) : subset, all the anchors
+                                                     by default
+
+        Returns:
+            error (numpy.ndarray) : shape (nx, ny) meters
+            extent (list) : [x_min, x_max, y_min, y_max] for imshow
+        """
+        row = self.subset_row(self.ids if anchor_ids is None else anchor_ids)
+        if row is None:
+            raise KeyError(f"Subset not in the precision map: {anchor_ids}")
+        x_max, y_max = self.origin + np.array(self.dop.shape[1:]) * self.cell
+        return self.sigma * self.dop[row], [self.origin[0], x_max, self.origin[1], y_max]
+
+
+def main():
+    parser = build_arg_parser()
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO) # To see the results
+
+    anchors = utils.load_anchors(args.config)
+    if not anchors:
+        return
+
+    precision_map = PrecisionMap.load(anchors, args.cell, args.sigma)
+    errors = precision_map.sigma * precision_map.dop.reshape(len(precision_map.masks), -1)
+
+    finite = np.isfinite(errors)
+    median = np.array([np.median(e[f]) if f.any() else np.inf for e, f in zip(errors, finite)])
+    worst = errors.max(axis=1)
+    ambiguous = ~finite.any(axis=1)
+
+    def names(mask):
+        return ",".join(np.array(precision_map.ids)[mask])
+
+    logging.info(f"{len(precision_map.masks)} subsets of {len(precision_map.ids)} anchors, "
+                 f"{ambiguous.sum()} ambiguous (anchors on a line or coincident)")
+    full = precision_map.error_grid()[0]
+    logging.info(f"All anchors: median error {np.median(full):.3f} m, worst {full.max():.3f} m")
+    low = (errors > utils.low_confidence_error).mean() * 100
+    logging.info(f"{low:.1f} % of the (subset, cell) pairs are flagged as low confidence " \
+                 f"(expected error > {utils.low_confidence_error} m)")
+
+    order = [row for row in np.argsort(-median) if not ambiguous[row]]
+    logging.info("Worst usable subsets (median / worst expected error in m):")
+    for row in order[:args.worst]:
+        logging.info(f"  {names(precision_map.masks[row])}: {median[row]:.3f} / {worst[row]:.3f}")
+
+
+if __name__ == '__main__':
+    main()
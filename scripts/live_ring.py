@@ -0,0 +1,506 @@
+import argparse
+import logging
+import math
+import struct
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import utils
+
+# Live positions published by the server in shared memory (server --shm), so
+# any number of local programs follow them without reading positions.csv and
+# without any work or lock on the server side:
+#
+#   header  : HEADER_DTYPE, the layout and the number of records written
+#   records : capacity * record_dtype, ring of the last positions, position
+#             n (from 0) is in slot n % capacity
+#   tags    : max_tags * tag_dtype, last state of every tag
+#
+# One writer (the thread that writes the positions), many readers. Every
+# slot has a sequence number (seqlock): the writer sets it to 0, writes the
+# slot, then sets it to n + 1. A reader copies the slots and keeps those
+# whose number is still the expected one after the copy. A tag row is odd
+# while it is written.
+
+default_name = "spatialPedagogy"
+default_capacity = 4096     # positions kept, about 7 min of 1 Tag at 10 Hz
+max_ranges = 8              # ranges kept per position
+max_tags = 64
+id_size = 16                # bytes of a tag id, room name (anchor ids: 8)
+
+RING_MAGIC = b"SPRING"
+RING_VERSION = 1
+
+HEADER_DTYPE = np.dtype([
+    ("magic", "S8"), ("version", "<u4"), ("capacity", "<u4"),
+    ("max_ranges", "<u4"), ("max_tags", "<u4"),
+    ("write_seq", "<u8"),       # number of positions written since the creation
+    ("created", "<f8"),         # time.time() of the creation
+], align=True)
+
+
+def record_dtype(ranges=max_ranges):
+    """
+    Args:
+        ranges (int, optional) : ranges kept per position
+
+    Returns:
+        dtype (numpy.dtype) : one position of the ring
+    """
+    return np.dtype([
+        ("seq", "<u8"),             # n + 1, 0 while the slot is written
+        ("time", "<f8"),            # time of the measure
+        ("published", "<f8"),       # time.time() when written in the ring
+        ("tag", f"S{id_size}"),
+        ("room", f"S{id_size}"),
+        ("x", "<f8"), ("y", "<f8"),
+        ("var_x", "<f4"), ("cov_xy", "<f4"), ("var_y", "<f4"),   # NaN if unknown
+        ("expected_error", "<f4"),  # NaN if unknown
+        ("nb_ranges", "u1"),
+        ("anchor", "S8", (ranges,)),
+        ("range", "<f4", (ranges,)),
+        ("rx_power", "<f4", (ranges,)),     # NaN if unknown
+    ], align=True)
+
+
+def tag_dtype():
+    """
+    Returns:
+        dtype (numpy.dtype) : last state of one tag
+    """
+    return np.dtype([
+        ("seq", "<u8"),             # odd while the row is written
+        ("tag", f"S{id_size}"),
+        ("connected", "u1"),
+        ("count", "<u8"),           # positions of the tag since the server start
+        ("record", "<u8"),          # seq of its last position in the ring
+        ("time", "<f8"),
+        ("x", "<f8"), ("y", "<f8"),
+        ("var_x", "<f4"), ("cov_xy", "<f4"), ("var_y", "<f4"),
+        ("expected_error", "<f4"),
+    ], align=True)
+
+
+def packer(dtype):
+    """
+    struct equivalent of a dtype, with its padding: packing a whole slot
+    at once is much faster than numpy field by field
+
+    Args:
+        dtype (numpy.dtype) : record_dtype or tag_dtype
+
+    Returns:
+        packer (struct.Struct) : same size and layout as the dtype
+    """
+    codes = {"u1": "B", "u4": "I", "u8": "Q", "f4": "f", "f8": "d"}
+    fmt, position = "<", 0
+    for name in sorted(dtype.names, key=lambda name: dtype.fields[name][1]):
+        field, offset = dtype.fields[name][:2]
+        base = field.base
+        code = f"{base.itemsize}s" if base.kind == "S" else codes[base.str[1:]]
+        fmt += "x" * (offset - position) + code * (field.itemsize // base.itemsize)
+        position = offset + field.itemsize
+    fmt += "x" * (dtype.itemsize - position)
+    return struct.Struct(fmt)
+
+
+def build_arg_parser():
+    """Build argument parser."""
+    p = argparse.ArgumentParser(
+        description="Follow the live positions the server publishes in " \
+                    "shared memory (server --shm), like tail -f"
+    )
+    p.add_argument('--name', type=str, default=default_name,
+                    help='Name of the shared memory, same as the server --shm')
+    p.add_argument('--tags', action='store_true',
+                    help='Print the last state of every tag instead of the positions')
+    p.add_argument('--unlink', action='store_true',
+                    help='Remove the shared memory (it outlives the server, so ' \
+                         'the readers keep working across restarts)')
+    return p
+
+
+def _size(capacity, ranges, tags):
+    return HEADER_DTYPE.itemsize + capacity * record_dtype(ranges).itemsize \
+        + tags * tag_dtype().itemsize
+
+
+def _attach(name):
+    """ Open an existing shared memory without letting this process remove it at exit """
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:   # Python < 3.13: always tracked
+        shm = shared_memory.SharedMemory(name)
+        _untrack(shm)
+        return shm
+
+
+def _untrack(shm):
+    """ The resource tracker would remove the shared memory when this process exits """
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except (ImportError, AttributeError, KeyError):
+        pass
+
+
+class _Layout:
+    """ NumPy views on the 3 parts of a shared memory (no copy) """
+
+    def __init__(self, shm, capacity, ranges, tags):
+        self.shm = shm
+        self.header = np.ndarray((), dtype=HEADER_DTYPE, buffer=shm.buf)
+        offset = HEADER_DTYPE.itemsize
+        self.records = np.ndarray((capacity,), dtype=record_dtype(ranges),
+                                  buffer=shm.buf, offset=offset)
+        offset += self.records.nbytes
+        self.tags = np.ndarray((tags,), dtype=tag_dtype(), buffer=shm.buf, offset=offset)
+        self.capacity = capacity
+
+    def release(self):
+        """ Drop the views, the shared memory can then be closed """
+        self.header = self.records = self.tags = None
+        self.shm.close()
+
+
+class LiveRing(_Layout):
+    """
+    Writer side, owned by the thread that writes the positions. publish()
+    is 2 struct packs in the shared memory and never waits on the readers:
+    they are never even known.
+    """
+
+    def __init__(self, name=default_name, capacity=default_capacity):
+        """
+        Opens the shared memory left by a previous run if it has the same
+        layout (its readers keep going, the sequence numbers continue),
+        else creates it.
+
+        Args:
+            name (str, optional) : name of the shared memory
+            capacity (int, optional) : positions kept in the ring
+
+        Raises:
+            OSError : shared memory not available
+        """
+        size = _size(capacity, max_ranges, max_tags)
+        try:
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+            created = True
+        except FileExistsError:
+            shm = _attach(name)
+            created = False
+            header = np.ndarray((), dtype=HEADER_DTYPE, buffer=shm.buf) \
+                if shm.size >= HEADER_DTYPE.itemsize else None
+            if header is None or shm.size < size \
+                    or (header["magic"], header["version"], header["capacity"],
+                        header["max_ranges"], header["max_tags"]) \
+                    != (RING_MAGIC, RING_VERSION, capacity, max_ranges, max_tags):
+                del header
+                utils.logger.warning(f"Shared memory {name} has another layout, replaced")
+                shm.close()
+                unlink(name)
+                shm = shared_memory.SharedMemory(name, create=True, size=size)
+                created = True
+        super().__init__(shm, capacity, max_ranges, max_tags)
+
+        if created:
+            _untrack(shm)   # outlives the server, see --unlink
+            self.header["magic"] = RING_MAGIC
+            self.header["version"] = RING_VERSION
+            self.header["capacity"] = capacity
+            self.header["max_ranges"] = max_ranges
+            self.header["max_tags"] = max_tags
+            self.header["created"] = time.time()
+            self.header["write_seq"] = 0
+        self.written = int(self.header["write_seq"])
+        self.counts = [0] * max_tags    # positions of the tag of each row
+        self._padding = [b""] * max_ranges, [math.nan] * max_ranges
+        self._record = packer(self.records.dtype)
+        self._tag = packer(self.tags.dtype)
+        self._records_offset = HEADER_DTYPE.itemsize
+        self._tags_offset = self._records_offset + self.records.nbytes
+        # Sequence numbers written as 8 bytes words, faster than numpy scalars
+        self._words = shm.buf.cast("Q")
+        self._write_seq_word = HEADER_DTYPE.fields["write_seq"][1] // 8
+        self._full_logged = False
+
+        # Tags of a previous run are disconnected, their rows reused
+        self.rows = {}
+        for row in np.flatnonzero(self.tags["tag"] != b"").tolist():
+            self._write_tag(row, connected=0)
+            self.rows[self.tags["tag"][row].decode("utf-8", "replace")] = row
+        utils.logger.info(f"Live positions published in shared memory {name} " \
+                          f"({shm.size // 1024} kB, {capacity} positions)")
+
+    def publish(self, position):
+        """
+        Add a position to the ring and update the state of its tag
+
+        Args:
+            position (dict) : result of utils.compute_position
+        """
+        n = self.written
+        slot = n % self.capacity
+        tag = str(position["tag"]).encode("utf-8")[:id_size]
+        covariance = position.get("covariance") or (math.nan, math.nan, math.nan)
+        expected_error = position.get("expected_error")
+        if expected_error is None:
+            expected_error = math.nan
+
+        ranges = position["ranges"]
+        anchor_ids = sorted(ranges)[:max_ranges]
+        rx_power = position.get("rx_power") or {}
+        missing = max_ranges - len(anchor_ids)
+        no_anchor, nan = self._padding
+
+        offset = self._records_offset + slot * self._record.size
+        words = self._words
+        words[offset // 8] = 0      # readers skip the slot from now on
+        self._record.pack_into(
+            self.shm.buf, offset,
+            0, position["time"], time.time(), tag,
+            (position.get("room") or "").encode("utf-8")[:id_size],
+            position["x"], position["y"], *covariance, expected_error, len(anchor_ids),
+            *[a.encode("utf-8")[:8] for a in anchor_ids], *no_anchor[:missing],
+            *[ranges[a] for a in anchor_ids], *nan[:missing],
+            *[rx_power.get(a) or math.nan for a in anchor_ids], *nan[:missing],
+        )
+        words[offset // 8] = n + 1
+        self.written = n + 1
+        words[self._write_seq_word] = n + 1
+
+        row = self._row(position["tag"])
+        if row is not None:
+            self.counts[row] += 1
+            self._write_tag(row, (0, tag, 1, self.counts[row], n + 1, position["time"],
+                                  position["x"], position["y"], *covariance, expected_error))
+
+    def remove(self, tag_id):
+        """
+        The tag disconnected: its row stays, marked as disconnected
+
+        Args:
+            tag_id (str) : identifier of the tag
+        """
+        row = self.rows.get(tag_id)
+        if row is not None:
+            self._write_tag(row, connected=0)
+
+    def close(self):
+        """ Stop publishing, the shared memory stays for the readers """
+        self._words.release()
+        self.release()
+
+    def _row(self, tag_id):
+        """ Row of a tag in the tags table: a free one, else the oldest disconnected one """
+        row = self.rows.get(tag_id)
+        if row is not None:
+            return row
+        free = np.flatnonzero(self.tags["tag"] == b"")
+        if len(free) == 0:
+            disconnected = np.flatnonzero(self.tags["connected"] == 0)
+            if len(disconnected) == 0:
+                if not self._full_logged:
+                    utils.logger.warning(f"More than {max_tags} tags, the last ones " \
+                                         "are only in the positions of the shared memory")
+                    self._full_logged = True
+                return None
+            free = disconnected[np.argsort(self.tags["time"][disconnected])]
+            old = self.tags["tag"][free[0]].decode("utf-8", "replace")
+            self.rows.pop(old, None)
+        row = self.rows[tag_id] = int(free[0])
+        self.counts[row] = 0
+        return row
+
+    def _write_tag(self, row, values=None, connected=None):
+        """ Write a whole tag row (tuple), or only its connected flag, under its seqlock """
+        offset = self._tags_offset + row * self._tag.size
+        words = self._words
+        seq = words[offset // 8]
+        words[offset // 8] = seq + 1    # odd: being written
+        if values is not None:
+            self._tag.pack_into(self.shm.buf, offset, seq + 1, *values[1:])
+        if connected is not None:
+            self.tags["connected"][row] = connected
+        words[offset // 8] = seq + 2
+
+
+class LiveRingReader(_Layout):
+    """
+    Reader side, any number of them in any local process. `records` and
+    `tags` are NumPy views on the shared memory (no copy) for who wants the
+    raw data, read() and latest() return only consistent copies of what
+    changed. Nothing is ever written, the server is not slowed down.
+    """
+
+    def __init__(self, name=default_name, from_start=False):
+        """
+        Args:
+            name (str, optional) : name of the shared memory (server --shm)
+            from_start (bool, optional) : the first read() returns the
+                                positions still in the ring, not only the new ones
+
+        Raises:
+            FileNotFoundError : the server never published in that shared memory
+            ValueError : not a positions ring, or another version
+        """
+        shm = _attach(name)
+        header = np.ndarray((), dtype=HEADER_DTYPE, buffer=shm.buf)
+        if header["magic"] != RING_MAGIC or header["version"] != RING_VERSION:
+            del header
+            shm.close()
+            raise ValueError(f"{name} is not a positions ring (version {RING_VERSION})")
+        capacity, ranges, tags = (int(header["capacity"]), int(header["max_ranges"]),
+                                  int(header["max_tags"]))
+        del header
+        super().__init__(shm, capacity, ranges, tags)
+        self.next = 0 if from_start else int(self.header["write_seq"])
+        self.lost = 0   # positions overwritten before they were read
+
+    @property
+    def write_seq(self):
+        """ Number of positions written so far """
+        return int(self.header["write_seq"])
+
+    def read(self):
+        """
+        Positions written since the last call, in order
+
+        Returns:
+            records (numpy.ndarray) : record_dtype array (a copy), empty if
+                                      nothing new
+        """
+        end = self.write_seq
+        if end < self.next:     # the ring was created again
+            self.next = max(0, end - self.capacity)
+        start = max(self.next, end - self.capacity)
+        self.lost += start - self.next
+        self.next = end
+        if start >= end:
+            return self.records[:0].copy()
+
+        expected = np.arange(start + 1, end + 1, dtype=np.int64)
+        slots = (expected - 1) % self.capacity
+        records = self.records[slots]
+        # Overwritten during the copy: seq changed before or after it
+        valid = (records["seq"] == expected) & (self.records["seq"][slots] == expected)
+        if not valid.all():
+            self.lost += int((~valid).sum())
+            records = records[valid]
+        return records
+
+    def wait(self, timeout=None, poll=0.0005):
+        """
+        Wait for new positions (polls write_seq, nothing is locked)
+
+        Args:
+            timeout (float, optional) : seconds, None waits forever
+            poll (float, optional) : seconds between 2 checks, the latency
+
+        Returns:
+            new (bool) : False on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.write_seq == self.next:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(poll)
+        return True
+
+    def latest(self, connected_only=True, retries=10):
+        """
+        Last state of every tag
+
+        Args:
+            connected_only (bool, optional) : skip the disconnected tags
+            retries (int, optional) : copies of a row being written
+
+        Returns:
+            tags (numpy.ndarray) : tag_dtype array (a copy)
+        """
+        used = np.flatnonzero(self.tags["tag"] != b"")
+        rows = self.tags[used]
+        for _ in range(retries):
+            after = self.tags["seq"][used]
+            bad = (rows["seq"] % 2 == 1) | (rows["seq"] != after)
+            if not bad.any():
+                break
+            rows[bad] = self.tags[used[bad]]
+        else:
+            rows = rows[~bad]
+        if connected_only:
+            rows = rows[rows["connected"] == 1]
+        return rows
+
+    def close(self):
+        self.release()
+
+
+def unlink(name=default_name):
+    """
+    Remove the shared memory of the live positions
+
+    Args:
+        name (str, optional) : name of the shared memory
+    """
+    try:
+        shm = shared_memory.SharedMemory(name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def main():
+    parser = build_arg_parser()
+    args = parser.parse_args()
+
+    utils.setup_logging(logging.INFO)
+
+    if args.unlink:
+        unlink(args.name)
+        return
+    reader = None
+    try:
+        while reader is None:
+            try:
+                reader = LiveRingReader(args.name)
+            except FileNotFoundError:
+                utils.logger.info(f"Waiting for the server to publish in {args.name} (--shm)")
+                time.sleep(1.0)
+            except ValueError as e:
+                utils.logger.error(e)
+                return
+
+        while True:
+            if args.tags:
+                print(f"{'Tag':<10}{'x':>8}{'y':>8}{'age (s)':>9}{'positions':>11}")
+                now = time.time()
+                for t in reader.latest():
+                    print(f"{t['tag'].decode():<10}{t['x']:>8.3f}{t['y']:>8.3f}"
+                          f"{now - t['time']:>9.2f}{t['count']:>11}")
+                print()
+                time.sleep(1.0)
+                continue
+            reader.wait()
+            now = time.time()
+            for r in reader.read():
+                n = r["nb_ranges"]
+                ranges = " ".join(f"{a.decode()}={d:.3f}" for a, d in zip(r["anchor"][:n], r["range"][:n]))
+                print(f"{r['seq']:>8} {r['tag'].decode():<8}{r['x']:>8.3f}{r['y']:>8.3f}  "
+                      f"{ranges}  ({(now - r['published']) * 1e6:.0f} us)")
+            if reader.lost:
+                utils.logger.warning(f"{reader.lost} positions overwritten before being read")
+                reader.lost = 0
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if reader is not None:
+            reader.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+from collections import deque
+import queue
+import threading
+import time
+
+import proximity
+import utils
+import zones
+
+# Same defaults as visualizer.detect_stops
+stop_speed_thresh = 0.2   # m/s
+stop_min_duration = 30.0  # s
+stop_smoothing = 5        # number of speeds averaged
+max_stops = 200           # finished stops kept per tag, the oldest are forgotten
+
+analytics_queue_size = 10000  # positions waiting for the analytics thread
+
+
+class StopTracker:
+    """
+    Incremental version of visualizer.detect_stops for one tag. Each new
+    position costs O(1): the speed is smoothed on the last few samples and a
+    stop is reported once it stayed under the threshold long enough.
+    """
+
+    def __init__(self, speed_thresh=stop_speed_thresh,
+                 min_duration=stop_min_duration):
+        self.speed_thresh = speed_thresh
+        self.min_duration = min_duration
+        self.speeds = deque(maxlen=stop_smoothing)
+        self.last = None        # (x, y, t) of the previous position
+        self.start = None       # t of the beginning of the low speed run
+        self.sum_x = 0.0
+        self.sum_y = 0.0
+        self.sum_weights = 0.0
+        self.count = 0
+        self.stops = deque(maxlen=max_stops)    # last finished stops
+
+    def update(self, x, y, t, covariance=None):
+        """
+        Add a position
+
+        Args:
+            x (float) : x coordinate of the tag
+            y (float) : y coordinate of the tag
+            t (float) : time of the position in seconds
+            covariance (tuple(var_x, cov_xy, var_y), optional) : uncertainty
+                        of the position, the precise ones weigh more in the
+                        location of the stop
+        """
+        if self.last is not None:
+            lx, ly, lt = self.last
+            dt = max(t - lt, 1e-6)
+            self.speeds.append(((x - lx) ** 2 + (y - ly) ** 2) ** 0.5 / dt)
+        self.last = (x, y, t)
+
+        if not self.speeds:
+            return
+
+        if sum(self.speeds) / len(self.speeds) < self.speed_thresh:
+            if self.start is None:
+                self.start = t
+                self.sum_x = self.sum_y = self.sum_weights = 0.0
+                self.count = 0
+            weight = 1.0
+            if covariance is not None and covariance[0] + covariance[2] > 0:
+                weight = 1.0 / (covariance[0] + covariance[2])
+            self.sum_x += weight * x
+            self.sum_y += weight * y
+            self.sum_weights += weight
+            self.count += 1
+        else:
+            stop = self.current()
+            if stop is not None:
+                self.stops.append(stop)
+            self.start = None
+
+    def current(self):
+        """
+        Returns:
+            stop (dict or None) : the ongoing stop if it is long enough
+        """
+        if self.start is None or self.count == 0:
+            return None
+        duration = self.last[2] - self.start
+        if duration < self.min_duration:
+            return None
+        return {
+            "x": round(self.sum_x / self.sum_weights, 3),
+            "y": round(self.sum_y / self.sum_weights, 3),
+            "start": self.start,
+            "duration": round(duration, 1),
+        }
+
+
+class LiveState:
+    """
+    Latest known state of every tag, shared between the ingestion loop and
+    the live views (turtle window, dashboard...).
+
+    The ingestion side only overwrites the last entry of a tag and queues
+    the position for the analytics thread (stops, zones, proximity), so
+    publishing is O(1) and never waits on a reader: the readers of the
+    analytics only hold the lock of that thread. Readers take a copy of the
+    state and can skip work when the version did not change since their
+    last read.
+    """
+
+    def __init__(self, zone_grid=None):
+        """
+        Args:
+            zone_grid (zones.ZoneGrid, optional) : zones of the room, to track
+                                    the time spent in each zone by each tag
+        """
+        self._lock = threading.Lock()
+        self._tags = {}
+        self._anchors = {}
+        self.zone_grid = zone_grid
+        self.version = 0
+
+        # Analytics, updated by their own thread
+        self._analytics_lock = threading.Lock()
+        self._updates = queue.Queue(analytics_queue_size)
+        self._stops = {}
+        self._zones = {}
+        self._proximity = proximity.ProximityTracker()
+        self.dropped = 0    # positions not analysed, the thread was late
+        threading.Thread(target=self._analyse, daemon=True, name="live analytics").start()
+
+    def publish(self, tag_id, x, y, ranges, timestamp=None, covariance=None):
+        """
+        Store the last position of a tag
+
+        Args:
+            tag_id (str) : identifier of the tag
+            x (float) : x coordinate of the tag
+            y (float) : y coordinate of the tag
+            ranges (dictionary{k: anchor id, v: distance float}) : ranges used
+                                                                   for the position
+            timestamp (float, optional) : time of the position. Defaults to now
+            covariance (tuple(var_x, cov_xy, var_y), optional) : uncertainty
+                                                                 of the position
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self._lock:
+            self._tags[tag_id] = {
+                "x": x,
+                "y": y,
+                "ranges": dict(ranges),
+                "time": timestamp,
+                "covariance": covariance,
+            }
+            for anchor_id, anchor_range in ranges.items():
+                self._anchors[anchor_id] = {
+                    "range": anchor_range,
+                    "tag": tag_id,
+                    "time": timestamp,
+                }
+            self.version += 1
+        try:
+            self._updates.put_nowait((tag_id, x, y, timestamp, covariance))
+        except queue.Full:
+            if self.dropped == 0:
+                utils.logger.warning("Live analytics late: positions skipped by the stops, "
+                                     "zones and proximity")
+            self.dropped += 1
+
+    def remove(self, tag_id):
+        """
+        Forget a tag (ex: its connection was closed)
+
+        Args:
+            tag_id (str) : identifier of the tag
+        """
+        with self._lock:
+            if self._tags.pop(tag_id, None) is None:
+                return
+            self.version += 1
+        # After the queued positions of the tag, waits if the queue is full
+        self._updates.put((tag_id, None, None, None, None))
+
+    def _analyse(self):
+        """ Analytics thread: stops, zones and proximity of the positions published """
+        while True:
+            tag_id, x, y, timestamp, covariance = self._updates.get()
+            with self._analytics_lock:
+                if x is None:
+                    self._stops.pop(tag_id, None)
+                    self._zones.pop(tag_id, None)
+                    self._proximity.remove(tag_id)
+                    continue
+                self._stops.setdefault(tag_id, StopTracker()).update(x, y, timestamp,
+                                                                     covariance)
+                if self.zone_grid is not None:
+                    if tag_id not in self._zones:
+                        self._zones[tag_id] = zones.ZoneTracker(self.zone_grid)
+                    self._zones[tag_id].update(x, y, timestamp)
+                self._proximity.update(tag_id, x, y, timestamp)
+
+    def snapshot(self):
+        """
+        Copy of the current state
+
+        Returns:
+            version (int) : incremented at each change of the state
+            tags (dictionary{k: tag id, v: dict}) : last position of each tag
+        """
+        with self._lock:
+            return self.version, {k: dict(v) for k, v in self._tags.items()}
+
+    def stops(self):
+        """
+        Stops detected so far for every connected tag
+
+        Returns:
+            stops (dictionary{k: tag id, v: list of dict}) : last max_stops
+                                    finished stops and the ongoing one of each tag
+        """
+        with self._analytics_lock:
+            result = {}
+            for tag_id, tracker in self._stops.items():
+                current = tracker.current()
+                result[tag_id] = list(tracker.stops) + ([current] if current else [])
+            return result
+
+    def zones(self):
+        """
+        Zone analytics of every connected tag (empty without zone_grid)
+
+        Returns:
+            zones (dictionary{k: tag id, v: dict}) : current zone, seconds
+                                        spent per zone and transitions
+        """
+        with self._analytics_lock:
+            return {tag_id: tracker.summary() for tag_id, tracker in self._zones.items()}
+
+    def proximity(self):
+        """
+        Tags close to each other (see proximity.ProximityTracker)
+
+        Returns:
+            proximity (dict) : pairs close now, groups now, and seconds and
+                               meetings of every pair since the start
+        """
+        with self._analytics_lock:
+            return self._proximity.summary()
+
+    def anchors_status(self, now=None):
+        """
+        Last range received by every anchor
+
+        Args:
+            now (float, optional) : current time. Defaults to time.time()
+
+        Returns:
+            status (dictionary{k: anchor id, v: dict}) : last range, tag that
+                                        measured it and seconds since then
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            return {
+                anchor_id: {**s, "age": round(now - s["time"], 2)}
+                for anchor_id, s in self._anchors.items()
+            }
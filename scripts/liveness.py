@@ -0,0 +1,94 @@
+import socket
+import time
+
+import protocol
+import utils
+
+# The Tag sends a heartbeat every 250 ms between its data frames (see
+# networkLoop in src/main.cpp), even without any anchor in range: a silent
+# connection is a lost Tag, not a Tag out of reach of the anchors
+heartbeat_timeout = 1.0     # s without any byte from a Tag sending heartbeats
+legacy_timeout = 5.0        # s, older firmwares only send a frame every 500 ms
+poll_interval = 0.25        # s between 2 checks of the connections
+
+# TCP keepalive, for the connections that stop without a FIN or RST (Tag
+# powered off, out of Wi-Fi): the kernel gives up after idle + interval * count
+keepalive_idle = 1          # s of silence before the first probe
+keepalive_interval = 1      # s between 2 probes
+keepalive_count = 2         # unanswered probes before the connection is dropped
+
+
+def set_keepalive(conn):
+    """
+    Enable short TCP keepalive probes on a Tag connection (the options the
+    platform doesn't have are skipped)
+
+    Args:
+        conn (socket.socket) : accepted connection
+    """
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    options = (("TCP_KEEPIDLE", keepalive_idle),
+               ("TCP_KEEPALIVE", keepalive_idle),   # macOS name of TCP_KEEPIDLE
+               ("TCP_KEEPINTVL", keepalive_interval),
+               ("TCP_KEEPCNT", keepalive_count))
+    for name, value in options:
+        if hasattr(socket, name):
+            try:
+                conn.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+            except OSError:
+                pass
+
+
+class Liveness:
+    """
+    Liveness of one Tag connection. Any byte received proves the Tag is
+    alive, the heartbeats also tell how many anchors it is ranging with, so
+    "no anchor in range" is logged instead of dropping the connection.
+    """
+
+    def __init__(self, addr, now=None):
+        """
+        Args:
+            addr (tuple(ip, port)) : address of the Tag
+            now (float, optional) : time.monotonic() of the connection
+        """
+        self.addr = addr
+        self.last = time.monotonic() if now is None else now
+        self.heartbeats = False     # the firmware sends heartbeats
+        self.in_range = None        # anchors in range, from the last heartbeat
+
+    @property
+    def timeout(self):
+        """ Seconds of silence after which the Tag is lost """
+        return heartbeat_timeout if self.heartbeats else legacy_timeout
+
+    def received(self, frames, now=None):
+        """
+        Data was received on the connection
+
+        Args:
+            frames (list of protocol.Frame) : frames decoded from it
+            now (float, optional) : time.monotonic() of the reception
+        """
+        self.last = time.monotonic() if now is None else now
+        for frame in frames:
+            if frame.frame_type != protocol.FRAME_TYPE_HEARTBEAT:
+                continue
+            self.heartbeats = True
+            if frame.in_range == 0 and self.in_range != 0:
+                utils.logger.warning(f"Tag {frame.tag:X} connected but no anchor in range")
+            elif frame.in_range and self.in_range == 0:
+                utils.logger.info(f"Tag {frame.tag:X} back in range of {frame.in_range} anchors")
+            self.in_range = frame.in_range
+
+    def stale(self, now=None):
+        """
+        Args:
+            now (float, optional) : time.monotonic()
+
+        Returns:
+            stale (bool) : True if the Tag is lost
+        """
+        if now is None:
+            now = time.monotonic()
+        return now - self.last > self.timeout
@@ -0,0 +1,126 @@
+import numpy as np
+
+lod_factor = 4          # each level keeps 1 point out of lod_factor
+lod_min_points = 1000   # no level coarser than that
+lod_budget = 5000       # maximum points drawn at once
+
+
+def downsample(xs, ys, factor=lod_factor):
+    """
+    Shape preserving downsampling of a 2D trajectory (Largest Triangle Three
+    Buckets). The points are cut in buckets of `factor` points and the point
+    of each bucket that makes the largest triangle with the means of the
+    previous and next buckets is kept. Using the previous bucket mean instead
+    of the previously kept point makes every bucket independent, so the
+    whole level is computed at once. The first and last points are kept.
+
+    Args:
+        xs (numpy.ndarray) : x coordinates
+        ys (numpy.ndarray) : y coordinates
+        factor (int, optional) : number of points per bucket
+
+    Returns:
+        indexes (numpy.ndarray) : sorted indexes of the kept points
+    """
+    n = len(xs)
+    if n <= 2 or factor <= 1:
+        return np.arange(n)
+
+    nb_buckets = -(-(n - 2) // factor)
+    pad = nb_buckets * factor - (n - 2)
+    bx = np.pad(xs[1:-1], (0, pad), mode="edge").reshape(nb_buckets, factor)
+    by = np.pad(ys[1:-1], (0, pad), mode="edge").reshape(nb_buckets, factor)
+
+    mean_x, mean_y = bx.mean(axis=1), by.mean(axis=1)
+    prev_x = np.concatenate([[xs[0]], mean_x[:-1]])
+    prev_y = np.concatenate([[ys[0]], mean_y[:-1]])
+    next_x = np.concatenate([mean_x[1:], [xs[-1]]])
+    next_y = np.concatenate([mean_y[1:], [ys[-1]]])
+
+    # Twice the triangle area (prev, point, next), for every point at once
+    area = np.abs((bx - prev_x[:, None]) * (next_y - prev_y)[:, None]
+                  - (next_x - prev_x)[:, None] * (by - prev_y[:, None]))
+    kept = 1 + np.arange(nb_buckets) * factor + np.argmax(area, axis=1)
+    kept = np.minimum(kept, n - 2)  # a padded point is the last real one
+
+    return np.unique(np.concatenate([[0], kept, [n - 1]]))
+
+
+class TrajectoryPyramid:
+    """
+    Multi-resolution trajectory, computed once. Level 0 is every point, each
+    next level keeps 1 point out of lod_factor of the previous one. Each level
+    is an array of indexes in the full trajectory, so the timestamps of the
+    kept points are known and a time window is found by binary search.
+    """
+
+    def __init__(self, xs, ys, factor=lod_factor, min_points=lod_min_points):
+        """
+        Args:
+            xs (numpy.ndarray) : x coordinates of the full trajectory
+            ys (numpy.ndarray) : y coordinates of the full trajectory
+            factor (int, optional) : reduction between 2 levels
+            min_points (int, optional) : size under which no level is added
+        """
+        self.xs = np.asarray(xs, dtype=float)
+        self.ys = np.asarray(ys, dtype=float)
+        self.levels = [np.arange(len(self.xs))]
+        while len(self.levels[-1]) > min_points:
+            level = self.levels[-1]
+            kept = downsample(self.xs[level], self.ys[level], factor)
+            if len(kept) == len(level):
+                break
+            self.levels.append(level[kept])
+
+    def select(self, start, end, bbox=None, budget=lod_budget):
+        """
+        Points to draw for a time window and a zoom: the finest level that
+        has at most `budget` points visible.
+
+        Args:
+            start (int) : first index of the time window (in the full trajectory)
+            end (int) : index after the last one of the time window
+            bbox (tuple(x_min, x_max, y_min, y_max), optional) : visible area,
+                        the points outside of it (except the neighbors of
+                        visible ones, to keep the lines) are not returned
+            budget (int, optional) : maximum number of points
+
+        Returns:
+            indexes (numpy.ndarray) : indexes in the full trajectory to draw
+            gaps (numpy.ndarray) : gaps[i] is True if points were skipped
+                                   between indexes[i] and indexes[i + 1]
+        """
+        # From the coarsest level, stop before the first one over budget
+        result = None
+        for level in reversed(self.levels):
+            lo, hi = np.searchsorted(level, [start, end])
+            positions = np.arange(lo, hi)
+            if bbox is not None and len(positions) > 0:
+                x_min, x_max, y_min, y_max = bbox
+                x, y = self.xs[level[positions]], self.ys[level[positions]]
+                inside = (x >= x_min) & (x <= x_max) & (y >= y_min) & (y <= y_max)
+                # Keep the segments that enter or leave the visible area
+                visible = inside.copy()
+                visible[1:] |= inside[:-1]
+                visible[:-1] |= inside[1:]
+                positions = positions[visible]
+            if result is not None and len(positions) > budget:
+                break
+            result = level, positions
+
+        level, positions = result
+        return level[positions], np.diff(positions) > 1
+
+    def path(self, start, end, bbox=None, budget=lod_budget):
+        """
+        Same as select, as coordinates ready for a matplotlib line: a NaN
+        is inserted where points were skipped so no false segment is drawn.
+
+        Returns:
+            xs (numpy.ndarray) : x coordinates
+            ys (numpy.ndarray) : y coordinates
+        """
+        indexes, gaps = self.select(start, end, bbox, budget)
+        xs, ys = self.xs[indexes], self.ys[indexes]
+        breaks = np.nonzero(gaps)[0] + 1
+        return np.insert(xs, breaks, np.nan), np.insert(ys, breaks, np.nan)
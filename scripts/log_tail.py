@@ -0,0 +1,128 @@
+import csv
+import itertools
+import os
+
+import numpy as np
+
+import utils
+
+
+class GrowingArray:
+    """
+    Numpy array that is appended to: the capacity doubles when it is full,
+    so adding n values costs O(n) amortized and views never copy.
+    """
+
+    def __init__(self, capacity=1024, dtype=float):
+        self.data = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def extend(self, values):
+        """
+        Args:
+            values (numpy.ndarray) : values added at the end
+        """
+        needed = self.size + len(values)
+        if needed > len(self.data):
+            capacity = max(needed, 2 * len(self.data))
+            data = np.empty(capacity, dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size:needed] = values
+        self.size = needed
+
+    @property
+    def values(self):
+        """ View on the values (no copy) """
+        return self.data[:self.size]
+
+    def __len__(self):
+        return self.size
+
+
+class LogTail:
+    """
+    Follows a positions CSV that the server is writing: each read parses
+    only the rows appended since the previous one. A row being written
+    (no end of line yet) is kept for the next read.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str) : CSV log
+        """
+        self.path = path
+        self.offset = 0
+        self.columns = None     # (x, y, timestamp, tag) indexes from the first row
+        self.partial = b""
+
+    def read(self):
+        """
+        Rows appended since the last call
+
+        Returns:
+            xs (numpy.ndarray) : x coordinates
+            ys (numpy.ndarray) : y coordinates
+            timestamps (numpy.ndarray) : time of each position in seconds
+            tags (numpy.ndarray) : Tag of each position, "" if the log has no
+                                   Tag column
+            restarted (bool) : the log was cleared since the last call, the
+                               previous positions are not in it anymore
+        """
+        restarted = False
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        if size < self.offset:     # utils.clear_file() was called
+            self.offset, self.columns, self.partial = 0, None, b""
+            restarted = True
+
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(self.offset)
+                data = self.partial + f.read()
+        except OSError:     # the server did not create it yet
+            return (*self._parse([]), restarted)
+        self.offset += len(data) - len(self.partial)
+
+        end = data.rfind(b"\n") + 1
+        self.partial = data[end:]
+        lines = data[:end].decode("utf-8", errors="replace").splitlines()
+
+        rows = csv.reader(lines)
+        if self.columns is None:
+            first = next(rows, None)
+            if first is None:
+                return (*self._parse([]), restarted)
+            header, is_header = utils.log_header(first)
+            if not is_header:   # the log of the server: the first row is a position
+                rows = itertools.chain([first], rows)
+            x = "x_transformed" if "x_transformed" in header else "pos_x"
+            y = "y_transformed" if "y_transformed" in header else "pos_y"
+            self.columns = (header.index(x), header.index(y), header.index("Timestamp"),
+                            header.index("Tag") if "Tag" in header else None)
+        return (*self._parse(rows), restarted)
+
+    def _parse(self, rows):
+        """ x, y, time and tag arrays of csv rows, invalid rows are skipped """
+        xs, ys, times, tags = [], [], [], []
+        if self.columns is not None:
+            ix, iy, it, itag = self.columns
+            last = max(ix, iy, it)
+            for row in rows:
+                if len(row) <= last:
+                    continue
+                try:
+                    x, y = float(row[ix]), float(row[iy])
+                    t = np.datetime64(row[it].strip(), "us")
+                except ValueError:
+                    continue
+                xs.append(x)
+                ys.append(y)
+                times.append(t)
+                tags.append(row[itag] if itag is not None and itag < len(row) else "")
+        timestamps = np.array(times, dtype="datetime64[us]").astype(np.int64) / 1e6
+        return (np.array(xs, dtype=float), np.array(ys, dtype=float), timestamps,
+                np.array(tags, dtype=str))
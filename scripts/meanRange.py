@@ -1,66 +1,187 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+import bz2
 import csv
+import gzip
+import itertools
 import logging
+import lzma
 import os
 
+# stream_stats (numpy) is imported when there is something to compute so the
+# script starts fast (see check_startup.py)
+
+chunk_size = 10000  # rows read before updating the stats
+max_anchor_columns = 4  # id_1..id_4 / d1..d4 in positions.csv
+
 def build_arg_parser():
     """Build argument parser."""
 
     p = argparse.ArgumentParser(
-        description="Reading mean ranges per anchor from CSV"
-    )    
-    p.add_argument('--csv', type=str, default="../logs/positions.csv",
-                    help='CSV file we want to read from')
+        description="Reading range statistics per anchor from CSV"
+    )
+    p.add_argument('--csv', type=str, nargs='+', default=["../logs/positions.csv"],
+                    help='CSV file(s) we want to read from (.gz, .bz2, .xz accepted), ' \
+                         'or SQLite storage (see store.py)')
+    p.add_argument('--session', type=str,
+                    help='SQLite only: id or name of the session kept')
+    p.add_argument('--tag', type=str,
+                    help='SQLite only: tag kept')
+    p.add_argument('--anchor', type=str,
+                    help='SQLite only: anchor kept')
+    p.add_argument('--start', type=str,
+                    help='SQLite only: first time kept, ex: "2025-12-02 10:15"')
+    p.add_argument('--end', type=str,
+                    help='SQLite only: last time kept')
+    p.add_argument('--workers', type=int, default=1,
+                    help='Number of files processed in parallel')
+    p.add_argument('--histogram', type=float, default=0.0,
+                    help='Also print a histogram with bins of that width (m)')
     return p
 
+
+def open_log(path):
+    """
+    Open a CSV log, compressed or not (from its extension)
+
+    Args:
+        path (str) : path to the log
+
+    Returns:
+        file (text file object)
+    """
+    openers = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+    opener = openers.get(os.path.splitext(path)[1], open)
+    return opener(path, "rt", newline="")
+
+
+def read_chunks(path):
+    """
+    Stream the ranges of a log, chunk by chunk. Rows can have any number of
+    anchors (empty id/range columns are ignored).
+
+    Args:
+        path (str) : path to the CSV log
+
+    Yields:
+        chunk (dictionary{k: anchor id, v: list of float}) : ranges of each
+                                                anchor in the next chunk_size rows
+    """
+    with open_log(path) as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        rows_left = reader
+        if "Timestamp" not in header:
+            # Log of the server, no header row: the columns of
+            # utils.log_columns (not imported, it loads numpy)
+            rows_left = itertools.chain([header], reader)
+            header = ["Nb Anchors", "id_1", "id_2", "id_3", "id_4", "d1", "d2", "d3", "d4"]
+        columns = [(header.index(f"id_{i}"), header.index(f"d{i}"))
+                   for i in range(1, max_anchor_columns + 1)
+                   if f"id_{i}" in header and f"d{i}" in header]
+
+        chunk = {}
+        rows = 0
+        for row in rows_left:
+            for id_col, d_col in columns:
+                if d_col >= len(row) or not row[id_col] or not row[d_col]:
+                    continue
+                try:
+                    value = float(row[d_col])
+                except ValueError:
+                    continue  # skip invalid values
+                chunk.setdefault(row[id_col], []).append(value)
+            rows += 1
+            if rows == chunk_size:
+                yield chunk
+                chunk = {}
+                rows = 0
+        if chunk:
+            yield chunk
+
+
+def process_file(path, filters=None):
+    """
+    Statistics of one log (one shard)
+
+    Args:
+        path (str) : path to the CSV log or SQLite storage
+        filters (dict, optional) : SQLite only, store.read_range_chunks
+                                   filters (session, tag, anchor, start, end)
+
+    Returns:
+        stats (dictionary{k: anchor id, v: stream_stats.AnchorStats})
+    """
+    import store
+    import stream_stats
+
+    if store.is_database(path):
+        # The selection is done by SQLite, on the indexes
+        chunks = store.read_range_chunks(path, **(filters or {}))
+    else:
+        chunks = read_chunks(path)
+
+    stats = {}
+    for chunk in chunks:
+        for anchor_id, values in chunk.items():
+            stats.setdefault(anchor_id, stream_stats.AnchorStats()).update(values)
+    logging.debug(f"{path} processed.")
+    return stats
+
+
 def main():
-    """ 
-    Dynamically reads the CSV to know how many ranges to print.
-    The whole CSV has to have the same amount of anchors though.
-    You can't have half the measures with 3 anchors and the other 4.
     """
-    
+    Reads the CSV logs in constant memory and prints, for every anchor found,
+    the count, mean, std, min/max and percentiles of its ranges.
+    Rows can have different numbers of anchors. Several files are merged.
+    """
+
     parser = build_arg_parser()
     args = parser.parse_args()
-    csv_path = args.csv
 
     logging.getLogger().setLevel(logging.INFO) # To see the results
 
-    if not os.path.exists(csv_path):
-        logging.error(f"File {csv_path} does not exist.")
+    paths = [p for p in args.csv if os.path.exists(p)]
+    for missing in set(args.csv) - set(paths):
+        logging.error(f"File {missing} does not exist.")
+    if not paths:
         return
 
-    with open(csv_path, "r") as f:
-        reader = csv.DictReader(f)
-        rows = list(reader)
+    import store
+    filters = {"session": args.session, "tag": args.tag, "anchor": args.anchor,
+               "start": store.parse_time(args.start), "end": store.parse_time(args.end)}
 
-    if not rows:
-        logging.warning("CSV is empty.")
-        return
-    
-    logging.debug(f"{csv_path} loaded.")
-
-    first_row = rows[0]
-    nb_anchors = int(first_row["Nb Anchors"])
-
-    anchor_ranges = [f"d{i+1}" for i in range(nb_anchors)]
-    ids = [f"id_{i+1}" for i in range(nb_anchors)]
-
-    dict_ranges_ids = {anchor_ranges[i] : ids[i] for i in range(nb_anchors)}
+    if args.workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            shards = list(pool.map(process_file, paths, [filters] * len(paths)))
+    else:
+        shards = [process_file(p, filters) for p in paths]
 
-    anchor_ids = {ids[i] : first_row[ids[i]] for i in range(nb_anchors)}
-    anchor_distances = {anchor_ids[id]: [] for id in anchor_ids.keys()}
+    import stream_stats
+    stats = stream_stats.merge_anchor_stats(shards)
 
-    for row in rows:
-        for distance in anchor_ranges:
-            val = row[distance]
-            anchor_distances[anchor_ids[dict_ranges_ids[distance]]].append(float(val))
-
-    means = {anchor_id: sum(vals) / len(vals) for anchor_id, vals in anchor_distances.items()}
+    if not stats:
+        logging.warning("CSV is empty.")
+        return
 
     # Print results
-    for anchor_id, mean_val in means.items():
-        logging.info(f"  {anchor_id}: {mean_val:.3f}\n")
+    for anchor_id in sorted(stats):
+        s = stats[anchor_id].stats
+        h = stats[anchor_id].histogram
+        logging.info(
+            f"  {anchor_id}: mean {s.mean:.3f}  std {s.std:.3f}  "
+            f"min {s.min:.3f}  p5 {h.percentile(5):.3f}  p50 {h.percentile(50):.3f}  "
+            f"p95 {h.percentile(95):.3f}  max {s.max:.3f}  ({s.count} ranges)\n"
+        )
+
+        if args.histogram > 0:
+            edges, counts = h.coarse(args.histogram)
+            peak = counts.max()
+            for edge, count in zip(edges, counts):
+                bar = "#" * int(round(40 * count / peak))
+                logging.info(f"    {edge:6.3f} | {bar} {count}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,282 @@
+import argparse
+import json
+import logging
+import math
+import os
+
+import numpy as np
+
+import utils
+
+model_path = "../calibration/range_model.json"
+
+# Without a learned model: the rule of the DW1000 application notes, the
+# direct path is probably blocked when the total RX power is more than
+# 6 dB above the first path power
+nlos_power_gap = 6.0    # dB
+nlos_weight = 0.1       # weight left to a range sure to be NLOS
+nlos_residual = 0.3     # m, training ranges longer than predicted by that are NLOS
+min_variance = 1e-4     # m^2, clip of the predicted range variances
+max_variance = 4.0      # m^2
+
+# Features of a range: 1, RX - first path power (dB), RX power (dB), range (m)
+FEATURES = ["bias", "power_gap", "rx_power", "range"]
+
+
+def build_arg_parser():
+    """Build argument parser."""
+    p = argparse.ArgumentParser(
+        description="Learn the NLOS classifier and the range weights of the " \
+                    "server from raw captures (see capture.py)"
+    )
+    p.add_argument('--capture', type=str, nargs='+', required=True,
+                    help='Capture file(s) of the room')
+    p.add_argument('--config', type=str, default="../config.json",
+                    help='Config file with the anchors of the room')
+    p.add_argument('--output', type=str, default=model_path,
+                    help='Model file written, read by the server --range_model')
+    return p
+
+
+def features(ids, dists, powers):
+    """
+    Features of the ranges of one measurement, all at once
+
+    Args:
+        ids (list of str) : anchors of the ranges
+        dists (numpy.ndarray) : ranges in m
+        powers (dictionary{k: anchor id, v: tuple(rx dBm, first path dBm)})
+
+    Returns:
+        X (numpy.ndarray) : shape (n, len(FEATURES))
+        known (numpy.ndarray) : shape (n,) False when the Tag didn't send
+                                the powers of the range (old firmware)
+    """
+    p = np.array([powers.get(a, (0.0, 0.0)) for a in ids], dtype=float).reshape(-1, 2)
+    known = (p[:, 0] != 0.0) & (p[:, 1] != 0.0)
+    X = np.column_stack([np.ones(len(ids)), p[:, 0] - p[:, 1], p[:, 0], dists])
+    return X, known
+
+
+def sigmoid(z):
+    return 1.0 / (1.0 + np.exp(-np.clip(z, -30, 30)))
+
+
+class RangeModel:
+    """
+    Trust in each range from its powers: probability that it is NLOS
+    (logistic regression) and variance of a LOS range (log-linear). Both
+    are linear in FEATURES, so a whole measurement is scored with two dot
+    products. The solver weighs each range by the inverse of its variance,
+    NLOS ranges count nlos_weight times less.
+    """
+
+    def __init__(self, classifier=None, variance=None, unknown_variance=None,
+                 weight=nlos_weight):
+        """
+        Args:
+            classifier (list of float, optional) : logistic coefficients of
+                            FEATURES. Defaults to the nlos_power_gap rule
+            variance (list of float, optional) : log variance coefficients of
+                            FEATURES. Defaults to utils.range_sigma everywhere
+            unknown_variance (float, optional) : variance of the ranges sent
+                            without powers. Defaults to utils.range_sigma^2
+            weight (float, optional) : weight left to a NLOS range
+        """
+        if classifier is None:
+            classifier = [-nlos_power_gap, 1.0, 0.0, 0.0]
+        if variance is None:
+            variance = [math.log(utils.range_sigma ** 2), 0.0, 0.0, 0.0]
+        if unknown_variance is None:
+            unknown_variance = utils.range_sigma ** 2
+        self.classifier = np.asarray(classifier, dtype=float)
+        self.variance = np.asarray(variance, dtype=float)
+        self.unknown_variance = float(unknown_variance)
+        self.weight = float(weight)
+
+    def nlos_probability(self, X):
+        """
+        Args:
+            X (numpy.ndarray) : see features
+
+        Returns:
+            p (numpy.ndarray) : probability of each range to be NLOS
+        """
+        return sigmoid(X @ self.classifier)
+
+    def variances(self, ranges, powers):
+        """
+        Variance of each range, the inverse of its weight in the solve
+
+        Args:
+            ranges (dictionary{k: anchor id, v: distance float})
+            powers (dictionary{k: anchor id, v: tuple(rx dBm, first path dBm)})
+
+        Returns:
+            variances (dictionary{k: anchor id, v: float}) : in m^2, None if
+                            no range has its powers (nothing to weigh)
+        """
+        ids = list(ranges)
+        X, known = features(ids, np.fromiter(ranges.values(), dtype=float, count=len(ids)), powers)
+        if not known.any():
+            return None
+        variance = np.clip(np.exp(X @ self.variance), min_variance, max_variance)
+        variance /= 1.0 - (1.0 - self.weight) * self.nlos_probability(X)
+        variance[~known] = self.unknown_variance
+        return dict(zip(ids, variance.tolist()))
+
+    @classmethod
+    def fit(cls, X, residuals, iterations=25, ridge=1e-3):
+        """
+        Learn the model from ranges of known residuals
+
+        Args:
+            X (numpy.ndarray) : shape (n, len(FEATURES)) see features
+            residuals (numpy.ndarray) : measured - predicted range of each row
+            iterations (int, optional) : Newton steps of the logistic regression
+            ridge (float, optional) : L2 regularization
+
+        Returns:
+            model (RangeModel)
+        """
+        labels = (residuals > nlos_residual).astype(float)
+
+        # Features centered and scaled so the Newton steps are well conditioned
+        center = np.r_[0.0, X[:, 1:].mean(axis=0)]
+        scale = np.r_[1.0, X[:, 1:].std(axis=0) + 1e-9]
+        Z = (X - center) / scale
+
+        w = np.zeros(X.shape[1])
+        for _ in range(iterations):
+            p = sigmoid(Z @ w)
+            gradient = Z.T @ (p - labels) + ridge * w
+            hessian = (Z * (p * (1 - p))[:, None]).T @ Z + ridge * np.eye(len(w))
+            step = np.linalg.solve(hessian, gradient)
+            w -= step
+            if np.abs(step).max() < 1e-6:
+                break
+        classifier = w / scale
+        classifier[0] -= classifier[1:] @ center[1:]
+
+        # E[log(r^2)] = log(variance) - 1.27 for gaussian residuals
+        los = labels == 0
+        log_r2 = np.log(residuals[los] ** 2 + min_variance)
+        variance, *_ = np.linalg.lstsq(X[los], log_r2, rcond=None)
+        variance[0] += 1.27
+        unknown = float(np.clip(np.exp(np.median(X[los] @ variance)), min_variance, max_variance))
+        return cls(classifier, variance, unknown)
+
+    def save(self, path):
+        """
+        Args:
+            path (str) : JSON file
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({
+                "features": FEATURES,
+                "classifier": self.classifier.tolist(),
+                "variance": self.variance.tolist(),
+                "unknown_variance": self.unknown_variance,
+                "nlos_weight": self.weight,
+            }, f, indent=2)
+
+    @classmethod
+    def load(cls, path=model_path):
+        """
+        Args:
+            path (str, optional) : JSON file written by save
+
+        Returns:
+            model (RangeModel) : the default one if the file doesn't exist
+        """
+        if not os.path.exists(path):
+            utils.logger.info(f"No range model in {path}, NLOS rule of " \
+                              f"{nlos_power_gap} dB between RX and first path power")
+            return cls()
+        with open(path, "r") as f:
+            data = json.load(f)
+        return cls(data["classifier"], data["variance"], data["unknown_variance"],
+                   data.get("nlos_weight", nlos_weight))
+
+
+def training_data(paths, anchors):
+    """
+    Features and leave-one-out residuals of every range of captures that
+    has its powers, the positions solved with equal weights
+
+    Args:
+        paths (list of str) : capture files
+        anchors (dictionary{key: anchor id, value: tuple(x, y, z)})
+
+    Returns:
+        X (numpy.ndarray) : shape (n, len(FEATURES))
+        residuals (numpy.ndarray) : shape (n,) in m
+    """
+    import anchor_health
+    import capture
+    import protocol
+    from session import TagSession
+
+    monitor = anchor_health.AnchorMonitor(anchors)
+    rows, residuals = [], []
+    for path in paths:
+        try:
+            reader = capture.CaptureReader(path)
+        except (OSError, ValueError) as e:
+            logging.error(f"Cannot read {path}: {e}")
+            continue
+        decoder = protocol.StreamDecoder()
+        sessions = {}
+        for recv_time, chunk in reader:
+            for frame in decoder.feed(chunk):
+                tag_id = f"{frame.tag:X}" if frame.tag is not None else reader.addr[0]
+                session = sessions.setdefault(tag_id, TagSession(tag_id, list(anchors)))
+                for _, raw_ranges, powers in session.measurements(frame, recv_time,
+                                                                  filter_ranges=False):
+                    ranges = {a: r for a, r in raw_ranges.items()
+                              if a in anchors and 0.0 < r < 15.0}
+                    if len(ranges) < 4:
+                        continue
+                    x, y, _ = utils.tag_pos(ranges, anchors)
+                    loo = monitor.residuals(ranges, x, y)
+                    ids = list(loo)
+                    X, known = features(ids, np.array([ranges[a] for a in ids]), powers)
+                    rows.append(X[known])
+                    residuals.append(np.array([loo[a] for a in ids])[known])
+    if not rows:
+        return np.empty((0, len(FEATURES))), np.empty(0)
+    return np.concatenate(rows), np.concatenate(residuals)
+
+
+def main():
+    parser = build_arg_parser()
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    utils.setup_logging()
+
+    anchors = utils.load_anchors(args.config)
+    if not anchors:
+        return
+    X, residuals = training_data(args.capture, anchors)
+    if len(X) < 50:
+        logging.error(f"Only {len(X)} ranges with their powers and redundant anchors, " \
+                      "record longer captures with a recent firmware")
+        return
+
+    model = RangeModel.fit(X, residuals)
+    model.save(args.output)
+
+    nlos = residuals > nlos_residual
+    predicted = model.nlos_probability(X) > 0.5
+    logging.info(f"{len(X)} ranges, {nlos.mean():.1%} NLOS (residual > {nlos_residual} m)")
+    logging.info(f"Classifier agrees with the residuals on {(predicted == nlos).mean():.1%} " \
+                 f"of the ranges, finds {predicted[nlos].mean() if nlos.any() else 0:.1%} of the NLOS")
+    for name, c, v in zip(FEATURES, model.classifier, model.variance):
+        logging.info(f"{name:<10} classifier {c:+.4f}   log variance {v:+.4f}")
+    logging.info(f"Model saved in {args.output}")
+
+
+if __name__ == '__main__':
+    main()
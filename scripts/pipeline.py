@@ -0,0 +1,359 @@
+import multiprocessing
+import queue
+import selectors
+import signal
+import threading
+import time
+
+import gdop
+import liveness
+import protocol
+from session import ResumeCache, TagSession, resume_window
+import utils
+
+# Solving in worker processes, the ingestion only reads the sockets and
+# decodes the frames:
+#
+#   sockets -> front end -> one bounded queue per worker -> solver workers
+#   (tag sessions are sticky: a tag always goes to the same worker)
+#   -> results queue -> writer thread (back in reception order) -> CSV, LiveState
+
+default_queue_size = 256    # frames waiting per worker
+stats_period = 10.0         # s between 2 reports of the dropped frames
+shutdown_timeout = 5.0      # s given to the workers to finish their frames on exit
+
+BLOCK = "block"     # full queue: stop reading the sockets (TCP pushes back)
+DROP = "drop"       # full queue: drop the newest frame and count it
+
+
+def _solver_worker(inputs, results, anchors, log_level, room_configs=None, range_model=None):
+    """
+    Solver process: computes the positions of the frames of its tags
+
+    Args:
+        inputs (multiprocessing.Queue) : (seq, tag id, frame, recv time)
+                        items, frame None when the tag disconnected (its
+                        session is kept to resume it), None to stop
+        results (multiprocessing.Queue) : (seq, tag id, positions) items,
+                        positions None when the tag disconnected
+        anchors (dictionary{key: anchor id, value: tuple(x, y, z)})
+        log_level (int) : logging level of utils.logger
+        room_configs (str, optional) : glob of the room configs (see rooms.py),
+                        each worker then reloads them itself when they change
+        range_model (nlos.RangeModel, optional) : weights of the ranges
+    """
+    # Ctrl+C is for the server: it stops reading, then drains and closes the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    utils.setup_logging(log_level)
+    utils.anchors = anchors
+    utils.range_model = range_model
+    utils.precision_map = gdop.PrecisionMap.load(anchors) if anchors else None
+    if room_configs:
+        import rooms
+        utils.rooms = rooms.RoomRegistry(room_configs)
+        utils.rooms.watch()
+
+    sessions = ResumeCache(lambda tag_id: TagSession(tag_id, utils.session_anchor_ids()))
+    connected = {}  # tag id -> session, tags of the open connections
+    try:
+        while True:
+            item = inputs.get()
+            if item is None:
+                return
+            seq, tag_id, frame, recv_time = item
+            if frame is None:
+                if connected.pop(tag_id, None) is not None:
+                    sessions.release(tag_id)
+                results.put((seq, tag_id, None))
+                continue
+
+            session = connected.get(tag_id)
+            if session is None:
+                session = connected[tag_id] = sessions.get(tag_id)
+            try:
+                positions = utils.compute_frame(frame, session, recv_time)
+            except Exception:
+                # A result is always sent: the writer waits for every seq
+                utils.logger.exception(f"Cannot solve a frame of {tag_id}")
+                positions = []
+            results.put((seq, tag_id, positions))
+    except KeyboardInterrupt:
+        pass
+
+
+class SolverPool:
+    """
+    Solver worker processes and the writer thread that writes their
+    positions in the order the frames were received.
+    """
+
+    def __init__(self, nb_workers, anchors, live_state=None,
+                 queue_size=default_queue_size, policy=BLOCK, room_configs=None,
+                 range_model=None):
+        """
+        Args:
+            nb_workers (int) : number of solver processes
+            anchors (dictionary{key: anchor id, value: tuple(x, y, z)})
+            live_state (LiveState, optional) : state shared with the live views
+            queue_size (int, optional) : frames waiting per worker
+            policy (str, optional) : BLOCK or DROP when a worker is late
+            room_configs (str, optional) : glob of the room configs, to choose
+                                           the room of each Tag (see rooms.py)
+            range_model (nlos.RangeModel, optional) : weights of the ranges.
+                                           Defaults to utils.range_model
+        """
+        # spawn: the server already runs threads (dashboard) when forking
+        context = multiprocessing.get_context("spawn")
+        self.live_state = live_state
+        self.policy = policy
+        self.inputs = [context.Queue(queue_size) for _ in range(nb_workers)]
+        self.results = context.Queue()
+        self.workers = [
+            context.Process(target=_solver_worker, daemon=True,
+                            args=(inputs, self.results, anchors, utils.logger.level,
+                                  room_configs, range_model or utils.range_model))
+            for inputs in self.inputs
+        ]
+        for worker in self.workers:
+            worker.start()
+
+        self.next_seq = 0
+        self.written = 0
+        self.dropped = 0
+        self.assigned = {}  # tag id -> worker index
+        self.released = {}  # tag id -> time.monotonic() of its disconnection
+        self._written_changed = threading.Condition()
+        threading.Thread(target=self._write_results, daemon=True).start()
+
+    def _worker_of(self, tag_id):
+        """
+        Worker of a tag: the least loaded at its first frame, then sticky,
+        also when the tag reconnects within resume_window (the worker kept
+        its session)
+        """
+        if self.released:
+            self.released.pop(tag_id, None)
+        index = self.assigned.get(tag_id)
+        if index is None:
+            now = time.monotonic()
+            for released, since in list(self.released.items()):
+                if now - since > resume_window:
+                    del self.released[released]
+                    del self.assigned[released]
+            load = [0] * len(self.inputs)
+            for connected, i in self.assigned.items():
+                if connected not in self.released:
+                    load[i] += 1
+            index = self.assigned[tag_id] = load.index(min(load))
+        return index
+
+    def submit(self, tag_id, frame, recv_time):
+        """
+        Queue a frame to its tag worker (front end thread only)
+
+        Args:
+            tag_id (str) : identifier of the tag
+            frame (protocol.Frame) : frame received from the Tag
+            recv_time (float) : time.time() when the frame was received
+
+        Returns:
+            queued (bool) : False if the frame was dropped (DROP policy)
+        """
+        inputs = self.inputs[self._worker_of(tag_id)]
+        item = (self.next_seq, tag_id, frame, recv_time)
+        if self.policy == DROP:
+            try:
+                inputs.put_nowait(item)
+            except queue.Full:
+                self.dropped += 1
+                return False
+        else:
+            inputs.put(item)
+        self.next_seq += 1
+        return True
+
+    def disconnect(self, tag_id):
+        """
+        The tag connection was closed: its session is released once its
+        queued frames are solved, and resumed if the tag reconnects
+
+        Args:
+            tag_id (str) : identifier of the tag
+        """
+        index = self.assigned.get(tag_id)
+        if index is None or tag_id in self.released:
+            return
+        self.released[tag_id] = time.monotonic()
+        self.inputs[index].put((self.next_seq, tag_id, None, None))
+        self.next_seq += 1
+
+    def _write_results(self):
+        """ Writer thread: writes the results in the order of their seq """
+        pending = {}
+        next_seq = 0
+        while True:
+            seq, tag_id, positions = self.results.get()
+            pending[seq] = (tag_id, positions)
+            while next_seq in pending:
+                tag_id, positions = pending.pop(next_seq)
+                # An error must not stop the thread: the workers would block
+                # on a full results queue and the Tags would not be read anymore
+                if positions is None:
+                    try:
+                        if utils.live_ring is not None:
+                            utils.live_ring.remove(tag_id)
+                        if self.live_state is not None:
+                            self.live_state.remove(tag_id)
+                    except Exception:
+                        utils.logger.exception(f"Cannot remove the Tag {tag_id}")
+                else:
+                    for position in positions:
+                        try:
+                            utils.write_position(position, self.live_state)
+                        except Exception:
+                            utils.logger.exception(f"Cannot write a position of {tag_id}")
+                next_seq += 1
+                with self._written_changed:
+                    self.written = next_seq
+                    self._written_changed.notify_all()
+
+    def drain(self, timeout=None):
+        """
+        Wait until every frame submitted so far is written
+
+        Args:
+            timeout (float, optional) : seconds to wait at most. Defaults to no limit
+
+        Returns:
+            drained (bool) : False if the timeout expired first
+        """
+        with self._written_changed:
+            return self._written_changed.wait_for(lambda: self.written >= self.next_seq,
+                                                  timeout)
+
+    def close(self, timeout=None):
+        """
+        Stop the workers once their queues are empty
+
+        Args:
+            timeout (float, optional) : seconds to wait for each worker, the
+                                        workers still running are then
+                                        terminated. Defaults to no limit
+        """
+        for inputs in self.inputs:
+            try:
+                inputs.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                utils.logger.warning(f"Solver worker {worker.pid} stopped before its frames")
+                worker.terminate()
+
+
+def serve_forever(sock, pool):
+    """
+    Front end: reads every Tag connection at once, decodes the frames and
+    hands them to the solver workers. Nothing is solved on this thread.
+
+    Args:
+        sock (socket.socket instance): Listening socket, accepts connections
+        pool (SolverPool) : solver workers
+    """
+    selector = selectors.DefaultSelector()
+    sock.setblocking(False)
+    selector.register(sock, selectors.EVENT_READ)
+    utils.logger.info(f"Waiting for connections on port {utils.TCP_PORT}")
+
+    owners = {}     # tag id -> state of the connection it sends on
+    last_report = time.monotonic()
+    reported_drops = 0
+    while True:
+        for key, _ in selector.select(timeout=liveness.poll_interval):
+            if key.fileobj is sock:
+                _accept(sock, selector)
+            else:
+                _read(key.fileobj, key.data, selector, pool, owners)
+
+        now = time.monotonic()
+        for key in list(selector.get_map().values()):
+            if key.data is not None and key.data["liveness"].stale(now):
+                utils.logger.warning(f"Lost connection to the Tag {key.data['addr'][0]} " \
+                                     f"(silent for more than {key.data['liveness'].timeout} s)")
+                _close(key.fileobj, key.data, selector, pool, owners)
+
+        if now - last_report > stats_period:
+            if pool.dropped > reported_drops:
+                utils.logger.warning(f"{pool.dropped - reported_drops} frames dropped, " \
+                                     "the solvers are too slow (see --workers)")
+                reported_drops = pool.dropped
+            utils.logger.debug(f"{pool.next_seq - pool.written} frames being solved")
+            utils.recorders.purge(now)
+            last_report = now
+
+
+def _accept(sock, selector):
+    """ New Tag connection """
+    conn, addr = sock.accept()
+    conn.setblocking(False)
+    liveness.set_keepalive(conn)
+    utils.logger.info(f"Connection accepted from {addr}")
+    state = {
+        "addr": addr,
+        "conn": conn,
+        "decoder": protocol.StreamDecoder(),
+        "tags": set(),
+        "liveness": liveness.Liveness(addr),
+        "recorder": utils.recorders.get(addr[0], addr) if utils.capture_dir else None,
+    }
+    selector.register(conn, selectors.EVENT_READ, state)
+
+
+def _read(conn, state, selector, pool, owners):
+    """ Decode what a Tag sent and queue its frames """
+    if conn.fileno() == -1:
+        return  # closed earlier in the same select, its Tag reconnected
+    try:
+        chunk = conn.recv(4096)
+    except BlockingIOError:
+        return
+    except OSError:     # reset, or TCP keepalive without answer
+        chunk = b""
+    if not chunk:
+        utils.logger.warning(f"Connection lost from {state['addr']}, waiting for new device...")
+        _close(conn, state, selector, pool, owners)
+        return
+
+    recv_time = time.time()
+    if state["recorder"] is not None:
+        state["recorder"].write(chunk, recv_time)
+    frames = state["decoder"].feed(chunk)
+    state["liveness"].received(frames)
+    for frame in frames:
+        # Old firmwares (JSON) don't send their id
+        tag_id = f"{frame.tag:X}" if frame.tag is not None else state["addr"][0]
+        if tag_id not in state["tags"]:
+            previous = owners.get(tag_id)
+            if previous is not None and previous is not state:
+                # The Tag reconnected before its old connection timed out
+                utils.logger.warning(f"Tag {tag_id} reconnected from {state['addr']}, " \
+                                     f"closing its connection from {previous['addr']}")
+                _close(previous["conn"], previous, selector, pool, owners)
+            owners[tag_id] = state
+            state["tags"].add(tag_id)
+        # Heartbeats too: they refine the clock of the session (see DeviceClock)
+        pool.submit(tag_id, frame, recv_time)
+
+
+def _close(conn, state, selector, pool, owners):
+    """ Forget a Tag connection, the sessions of its tags are kept to resume them """
+    selector.unregister(conn)
+    conn.close()
+    if state["recorder"] is not None:
+        state["recorder"].flush()
+        utils.recorders.release(state["addr"][0])
+    for tag_id in state["tags"]:
+        if owners.get(tag_id) is state:
+            del owners[tag_id]
+            pool.disconnect(tag_id)
@@ -0,0 +1,343 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations, islice
+import json
+import logging
+import math
+import os
+
+import numpy as np
+
+import gdop
+import utils
+import zones
+
+eval_cell = 0.25        # m, grid used to score a layout (coarser than gdop.map_cell)
+hole_weight = 1.0       # m of score added when the whole room is a coverage hole
+exhaustive_limit = 200_000  # layouts above which the search is not exhaustive
+exhaustive_chunk = 2_000    # layouts scored per task in the exhaustive search
+anneal_iterations = 3000
+anneal_start_temp = 0.05    # m of score, worse layouts are accepted early
+anneal_end_temp = 0.0005
+
+_problem = None         # scoring problem of a worker process (_init_worker)
+
+
+def build_arg_parser():
+    """Build argument parser."""
+    p = argparse.ArgumentParser(
+        description="Search where to mount the anchors in a room to minimize " \
+                    "the expected position error and the coverage holes"
+    )
+    p.add_argument('--room', type=str, required=True,
+                    help='JSON file with the room "outline" polygon and optional ' \
+                         '"candidates" mounting points, ex: {"outline": [[0, 0], ' \
+                         '[8, 0], [8, 5], [0, 5]], "candidates": [[0, 0, 2.1], ...]}')
+    p.add_argument('--anchors', type=int, default=4,
+                    help='Number of anchors to place')
+    p.add_argument('--objective', choices=["mean", "worst"], default="mean",
+                    help='Minimize the mean or the worst expected error over the room')
+    p.add_argument('--method', choices=["auto", "exhaustive", "greedy", "anneal"],
+                    default="auto",
+                    help='Search method, auto is exhaustive for small searches ' \
+                         'and annealing from the greedy layout otherwise')
+    p.add_argument('--spacing', type=float, default=0.5,
+                    help='Spacing of the candidates generated along the walls ' \
+                         'when the room has no "candidates"')
+    p.add_argument('--height', type=float, default=0.0,
+                    help='Height of the generated candidates')
+    p.add_argument('--restarts', type=int, default=os.cpu_count(),
+                    help='Number of independent annealing runs')
+    p.add_argument('--workers', type=int, default=os.cpu_count(),
+                    help='Number of processes of the search')
+    p.add_argument('--seed', type=int, default=0,
+                    help='Seed of the annealing (results are reproducible)')
+    p.add_argument('--output', type=str, default="../config_placement.json",
+                    help='Config file written with the best layout')
+    return p
+
+
+def load_room(path, spacing, height):
+    """
+    Read the room outline and its candidate mounting points. Without
+    candidates, points are generated along the walls every `spacing` meters.
+
+    Args:
+        path (str) : path to the JSON room file
+        spacing (float) : distance between generated candidates
+        height (float) : height of the generated candidates
+
+    Returns:
+        outline (numpy.ndarray) : shape (m, 2) polygon
+        candidates (numpy.ndarray) : shape (n, 3) x, y, z of each candidate
+    """
+    with open(path, "r") as f:
+        data = json.load(f)
+
+    outline = np.asarray(data["outline"], dtype=float)[:, :2]
+    if "candidates" in data:
+        candidates = [list(c) + [height] * (3 - len(c)) for c in data["candidates"]]
+        return outline, np.asarray(candidates, dtype=float)
+
+    candidates = []
+    for start, end in zip(outline, np.roll(outline, -1, axis=0)):
+        steps = max(1, int(np.ceil(np.linalg.norm(end - start) / spacing)))
+        for t in np.arange(steps) / steps:
+            candidates.append([*(start + t * (end - start)), height])
+    return outline, np.asarray(candidates, dtype=float)
+
+
+def room_points(outline, cell=eval_cell):
+    """
+    Centers of the cells of a grid inside the room
+
+    Args:
+        outline (numpy.ndarray) : shape (m, 2) polygon
+        cell (float, optional) : size of the cells
+
+    Returns:
+        points (numpy.ndarray) : shape (n, 2)
+    """
+    low, high = outline.min(axis=0), outline.max(axis=0)
+    xs = np.arange(low[0] + cell / 2, high[0], cell)
+    ys = np.arange(low[1] + cell / 2, high[1], cell)
+    points = np.stack(np.meshgrid(xs, ys, indexing="ij"), axis=-1).reshape(-1, 2)
+    return points[zones.points_in_polygon(points, outline)]
+
+
+class Problem:
+    """
+    Scores layouts (sets of candidates) on the room grid. The unit vector
+    terms of every candidate are computed once, a batch of layouts is then
+    a few matrix products (see gdop.dilution_of_precision).
+    """
+
+    def __init__(self, candidates_xy, points, objective, sigma=gdop.range_sigma):
+        """
+        Args:
+            candidates_xy (numpy.ndarray) : shape (nb_candidates, 2)
+            points (numpy.ndarray) : shape (nb_points, 2) cells of the room
+            objective (str) : "mean" or "worst"
+            sigma (float, optional) : standard deviation of one range
+        """
+        self.candidates_xy = candidates_xy
+        self.points = points
+        self.objective = objective
+        self.sigma = sigma
+        self.terms = gdop.unit_terms(candidates_xy, points)
+
+    def score(self, layouts):
+        """
+        Args:
+            layouts (numpy.ndarray) : shape (nb_layouts, nb_anchors) candidate
+                                      indexes of each layout
+
+        Returns:
+            scores (numpy.ndarray) : shape (nb_layouts,) lower is better. The
+                error is capped so a hole counts once, in the hole penalty.
+        """
+        layouts = np.asarray(layouts).reshape(len(layouts), -1)
+        masks = np.zeros((len(layouts), len(self.candidates_xy)), dtype=bool)
+        masks[np.arange(len(layouts))[:, None], layouts] = True
+
+        error = self.sigma * gdop.dilution_of_precision(self.candidates_xy, masks,
+                                                        self.points, self.terms)
+        holes = error > utils.low_confidence_error
+        capped = np.minimum(error, 2 * utils.low_confidence_error)
+        summary = capped.mean(axis=1) if self.objective == "mean" else capped.max(axis=1)
+        return summary + hole_weight * holes.mean(axis=1)
+
+    def summary(self, layout):
+        """
+        Args:
+            layout (iterable of int) : candidate indexes
+
+        Returns:
+            summary (dict) : mean and worst expected errors, part of the room
+                             that is a coverage hole
+        """
+        masks = np.zeros((1, len(self.candidates_xy)), dtype=bool)
+        masks[0, list(layout)] = True
+        error = self.sigma * gdop.dilution_of_precision(self.candidates_xy, masks,
+                                                        self.points, self.terms)[0]
+        holes = error > utils.low_confidence_error
+        usable = error[~holes]
+        return {
+            "mean": float(usable.mean()) if len(usable) else math.inf,
+            "worst": float(error.max()),
+            "holes": float(holes.mean()),
+        }
+
+
+def _init_worker(candidates_xy, points, objective):
+    """ Build the problem once per worker process instead of once per task """
+    global _problem
+    _problem = Problem(candidates_xy, points, objective)
+
+
+def _best_of_chunk(layouts):
+    """
+    Args:
+        layouts (list of tuple) : layouts to score
+
+    Returns:
+        score (float), layout (tuple) : best layout of the chunk
+    """
+    scores = _problem.score(np.array(layouts))
+    best = int(np.argmin(scores))
+    return float(scores[best]), tuple(layouts[best])
+
+
+def _anneal(start, seed):
+    """
+    Simulated annealing: move one anchor to a free candidate, keep the move
+    if it is better or, less and less often, if it is worse.
+
+    Args:
+        start (tuple) : initial layout
+        seed (int) : seed of this run
+
+    Returns:
+        score (float), layout (tuple) : best layout found
+    """
+    rng = np.random.default_rng(seed)
+    nb_candidates = len(_problem.candidates_xy)
+    layout = np.array(start)
+    score = float(_problem.score(layout[None])[0])
+    best_score, best_layout = score, layout.copy()
+    if nb_candidates == len(layout):
+        return best_score, tuple(best_layout)
+
+    decay = (anneal_end_temp / anneal_start_temp) ** (1 / anneal_iterations)
+    temp = anneal_start_temp
+    for _ in range(anneal_iterations):
+        free = np.setdiff1d(np.arange(nb_candidates), layout)
+        move = layout.copy()
+        move[rng.integers(len(move))] = rng.choice(free)
+        move_score = float(_problem.score(move[None])[0])
+        if move_score < score or rng.random() < math.exp((score - move_score) / temp):
+            layout, score = move, move_score
+            if score < best_score:
+                best_score, best_layout = score, layout.copy()
+        temp *= decay
+    return best_score, tuple(sorted(best_layout))
+
+
+def greedy(problem, nb_anchors):
+    """
+    Best 3 anchors (exhaustive), then add the best candidate one at a time.
+    Fewer than 3 anchors cannot be compared (they are all ambiguous).
+
+    Args:
+        problem (Problem)
+        nb_anchors (int) : size of the layout
+
+    Returns:
+        score (float), layout (tuple)
+    """
+    nb_candidates = len(problem.candidates_xy)
+    first = min(3, nb_anchors)
+    triples = np.array(list(combinations(range(nb_candidates), first)))
+    scores = np.concatenate([problem.score(triples[i:i + exhaustive_chunk])
+                             for i in range(0, len(triples), exhaustive_chunk)])
+    layout = list(triples[int(np.argmin(scores))])
+    score = float(scores.min())
+
+    while len(layout) < nb_anchors:
+        free = np.setdiff1d(np.arange(nb_candidates), layout)
+        layouts = np.column_stack([np.tile(layout, (len(free), 1)), free])
+        scores = problem.score(layouts)
+        layout.append(int(free[np.argmin(scores)]))
+        score = float(scores.min())
+    return score, tuple(sorted(layout))
+
+
+def search(candidates_xy, points, nb_anchors, objective, method, restarts, workers, seed):
+    """
+    Best layout of nb_anchors anchors among the candidates
+
+    Args:
+        candidates_xy (numpy.ndarray) : shape (nb_candidates, 2)
+        points (numpy.ndarray) : shape (nb_points, 2) cells of the room
+        nb_anchors (int) : size of the layout
+        objective (str) : "mean" or "worst"
+        method (str) : "auto", "exhaustive", "greedy" or "anneal"
+        restarts (int) : number of annealing runs
+        workers (int) : number of processes
+        seed (int) : seed of the first annealing run
+
+    Returns:
+        score (float), layout (tuple of int) : best layout found
+    """
+    nb_layouts = math.comb(len(candidates_xy), nb_anchors)
+    if method == "auto":
+        method = "exhaustive" if nb_layouts <= exhaustive_limit else "anneal"
+    utils.logger.debug(f"{nb_layouts} layouts, {method} search")
+
+    problem = Problem(candidates_xy, points, objective)
+    if method == "greedy":
+        return greedy(problem, nb_anchors)
+
+    init = (candidates_xy, points, objective)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=init) as pool:
+        if method == "exhaustive":
+            layouts = combinations(range(len(candidates_xy)), nb_anchors)
+            chunks = iter(lambda: list(islice(layouts, exhaustive_chunk)), [])
+            return min(pool.map(_best_of_chunk, chunks))
+
+        # Annealing runs from the greedy layout, each with its own seed
+        start = greedy(problem, nb_anchors)
+        runs = pool.map(_anneal, [start[1]] * restarts, range(seed, seed + restarts))
+        return min([start, *runs])
+
+
+def write_config(path, candidates, layout):
+    """
+    Write a config file usable by the server and the visualizer
+
+    Args:
+        path (str) : output file
+        candidates (numpy.ndarray) : shape (n, 3) candidate positions
+        layout (tuple of int) : chosen candidates
+    """
+    anchors = {f"AAA{i + 1}": [round(float(c), 4) for c in candidates[index]]
+               for i, index in enumerate(layout)}
+    with open(path, "w") as f:
+        json.dump({"anchors": anchors}, f, indent=2)
+
+
+def main():
+    parser = build_arg_parser()
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO) # To see the results
+
+    outline, candidates = load_room(args.room, args.spacing, args.height)
+    points = room_points(outline)
+    if len(candidates) < args.anchors or args.anchors < 3:
+        logging.error(f"Cannot place {args.anchors} anchors on {len(candidates)} " \
+                      "candidates (3 anchors at least)")
+        return
+    if len(points) == 0:
+        logging.error("The room outline is empty.")
+        return
+
+    logging.info(f"{len(candidates)} candidates, {len(points)} cells, " \
+                 f"{math.comb(len(candidates), args.anchors)} layouts")
+    score, layout = search(candidates[:, :2], points, args.anchors, args.objective,
+                           args.method, args.restarts, args.workers, args.seed)
+
+    summary = Problem(candidates[:, :2], points, args.objective).summary(layout)
+    logging.info(f"Best layout (score {score:.3f}):")
+    for i, index in enumerate(layout):
+        logging.info(f"  AAA{i + 1}: {candidates[index].tolist()}")
+    logging.info(f"Expected error: mean {summary['mean']:.3f} m, worst " \
+                 f"{summary['worst']:.3f} m, holes {summary['holes'] * 100:.1f} % of the room")
+
+    write_config(args.output, candidates, layout)
+    logging.info(f"Config written in {args.output}")
+
+
+if __name__ == '__main__':
+    main()
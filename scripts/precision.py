@@ -0,0 +1,220 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import json
+import logging
+import os
+
+import numpy as np
+
+from meanRange import open_log
+import utils
+
+bootstrap_batch = 5_000_000    # max values resampled at once (memory bound)
+
+
+def build_arg_parser():
+    """Build argument parser."""
+    p = argparse.ArgumentParser(
+        description="Precision of many static captures against their ground " \
+                    "truth: bias, std, CEP50/CEP95 with bootstrap confidence intervals"
+    )
+    p.add_argument('--manifest', type=str, required=True,
+                    help='JSON file listing the captures and their truth, ex: ' \
+                         '{"captures": [{"csv": "a.csv", "truth": [2.36, 1.90], ' \
+                         '"label": "delay 81"}, {"csv": "b.csv", "truth_range": 3.37}]}')
+    p.add_argument('--bootstrap', type=int, default=1000,
+                    help='Number of bootstrap resamples')
+    p.add_argument('--confidence', type=float, default=95.0,
+                    help='Confidence level of the intervals, in percent')
+    p.add_argument('--workers', type=int, default=os.cpu_count(),
+                    help='Number of captures analysed in parallel')
+    p.add_argument('--seed', type=int, default=0,
+                    help='Seed of the resampling (results are reproducible)')
+    p.add_argument('--output', type=str,
+                    help='Optional CSV file to save the results')
+    return p
+
+
+def load_manifest(path):
+    """
+    Read the manifest, capture paths are relative to the manifest
+
+    Args:
+        path (str) : path to the JSON manifest
+
+    Returns:
+        captures (list of dict) : csv, label and truth (or truth_range) of
+                                  each capture
+    """
+    with open(path, "r") as f:
+        data = json.load(f)
+
+    base = os.path.dirname(os.path.abspath(path))
+    captures = []
+    for capture in data["captures"]:
+        capture = dict(capture)
+        capture["csv"] = os.path.join(base, capture["csv"])
+        capture.setdefault("label", os.path.basename(capture["csv"]))
+        captures.append(capture)
+    return captures
+
+
+def read_capture(csv_filename, one_dimension):
+    """
+    Read the measures of a static capture
+
+    Args:
+        csv_filename (str) : path to the CSV file
+        one_dimension (bool) : read the single range d1 instead of the position
+
+    Returns:
+        values (numpy.ndarray) : shape (n,) ranges or (n, 2) positions
+    """
+    values = []
+    with open_log(csv_filename) as file:
+        for row in utils.read_log(file):   # the server log has no header row
+            try:
+                if one_dimension:
+                    values.append(float(row["d1"]))
+                else:
+                    values.append((float(row.get("x_transformed", row.get("pos_x"))),
+                                   float(row.get("y_transformed", row.get("pos_y")))))
+            except (ValueError, TypeError, KeyError):
+                continue  # skip invalid rows
+    return np.array(values, dtype=float)
+
+
+def metrics(errors, radial):
+    """
+    Precision metrics of one or many sets of errors (vectorized on the rows)
+
+    Args:
+        errors (numpy.ndarray) : shape (..., n, d) errors to the truth
+        radial (numpy.ndarray) : shape (..., n) norm of each error
+
+    Returns:
+        metrics (dictionary{k: name, v: numpy.ndarray}) : shape (...) each
+    """
+    bias = errors.mean(axis=-2)
+    result = {
+        "bias": np.linalg.norm(bias, axis=-1),
+        "std": np.sqrt(errors.var(axis=-2).sum(axis=-1)),
+    }
+    result["cep50"], result["cep95"] = np.percentile(radial, [50, 95], axis=-1)
+    return result
+
+
+def bootstrap(errors, radial, resamples, confidence, rng):
+    """
+    Percentile bootstrap confidence intervals of the metrics. The resamples
+    are drawn as index matrices, in batches so memory stays bounded.
+
+    Args:
+        errors (numpy.ndarray) : shape (n, d) errors to the truth
+        radial (numpy.ndarray) : shape (n,) norm of each error
+        resamples (int) : number of bootstrap resamples
+        confidence (float) : confidence level in percent
+        rng (numpy.random.Generator) : random generator
+
+    Returns:
+        intervals (dictionary{k: name, v: tuple(low, high)})
+    """
+    n = len(radial)
+    batch = max(1, bootstrap_batch // n)
+    samples = {}
+    for start in range(0, resamples, batch):
+        idx = rng.integers(0, n, size=(min(batch, resamples - start), n))
+        for name, values in metrics(errors[idx], radial[idx]).items():
+            samples.setdefault(name, []).append(values)
+
+    alpha = (100.0 - confidence) / 2
+    return {
+        name: tuple(np.percentile(np.concatenate(values), [alpha, 100.0 - alpha]))
+        for name, values in samples.items()
+    }
+
+
+def analyse_capture(capture, resamples, confidence, seed):
+    """
+    Precision of one capture, run in a worker process
+
+    Args:
+        capture (dict) : entry of the manifest
+        resamples (int) : number of bootstrap resamples
+        confidence (float) : confidence level in percent
+        seed (int) : seed of the resampling for this capture
+
+    Returns:
+        result (dict) : label, number of measures, metrics and their intervals
+    """
+    one_dimension = "truth_range" in capture
+    values = read_capture(capture["csv"], one_dimension)
+    result = {"label": capture["label"], "n": len(values)}
+    if len(values) == 0:
+        return result
+
+    if one_dimension:
+        errors = (values - capture["truth_range"])[:, None]
+    else:
+        errors = values - np.asarray(capture["truth"], dtype=float)
+    radial = np.linalg.norm(errors, axis=1)
+
+    result["mean_error"] = errors.mean(axis=0).tolist()
+    result.update({k: float(v) for k, v in metrics(errors, radial).items()})
+    if resamples > 0:
+        rng = np.random.default_rng(seed)
+        result["ci"] = bootstrap(errors, radial, resamples, confidence, rng)
+    return result
+
+
+def main():
+    parser = build_arg_parser()
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO) # To see the results
+
+    captures = load_manifest(args.manifest)
+    for capture in captures:
+        if not os.path.exists(capture["csv"]):
+            logging.error(f"File {capture['csv']} does not exist.")
+    captures = [c for c in captures if os.path.exists(c["csv"])]
+    if not captures:
+        return
+
+    jobs = [(c, args.bootstrap, args.confidence, args.seed + i)
+            for i, c in enumerate(captures)]
+    if args.workers > 1 and len(captures) > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            results = list(pool.map(analyse_capture, *zip(*jobs)))
+    else:
+        results = [analyse_capture(*job) for job in jobs]
+
+    names = ["bias", "std", "cep50", "cep95"]
+    rows = []
+    for result in results:
+        if result["n"] == 0:
+            logging.warning(f"{result['label']}: no valid measure")
+            continue
+        mean_error = ", ".join(f"{e:+.3f}" for e in result["mean_error"])
+        line = f"{result['label']} (n={result['n']}, mean error ({mean_error})):"
+        row = {"label": result["label"], "n": result["n"], "mean_error": mean_error}
+        for name in names:
+            line += f"  {name} {result[name]:.3f}"
+            row[name] = result[name]
+            if "ci" in result:
+                low, high = result["ci"][name]
+                line += f" [{low:.3f}, {high:.3f}]"
+                row[f"{name}_low"], row[f"{name}_high"] = low, high
+        logging.info(line)
+        rows.append(row)
+
+    if args.output and rows:
+        with open(args.output, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
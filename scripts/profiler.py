@@ -0,0 +1,208 @@
+import argparse
+import collections
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+
+import utils
+
+# On-demand profiling of the running server. Nothing runs until a profile is
+# asked (SIGUSR1, ex: `python profiler.py --seconds 20`), then for N seconds:
+#   - a thread samples the stacks of every thread (statistical profiler)
+#   - tracemalloc traces the allocations
+# and the reports are written in report_dir:
+#   <time>_stacks.txt  collapsed stacks, for flamegraph.pl or speedscope.app
+#   <time>_summary.txt functions on top of the stacks (self time) and the
+#                      allocations that grew the most during the profile
+
+report_dir = "../logs/profiles"
+pid_file = "../logs/server.pid"
+request_file = "../logs/profile_request.json"  # duration asked by the CLI
+default_seconds = 30.0
+sample_interval = 0.01      # s, 100 stacks per second and per thread
+memory_frames = 10          # frames kept by tracemalloc for each allocation
+memory_top = 30             # allocations listed in the report
+
+_running = threading.Lock()
+
+
+def build_arg_parser():
+    """Build argument parser."""
+    p = argparse.ArgumentParser(
+        description="Ask the running server for a profile (CPU stacks and " \
+                    "allocations), written in " + report_dir
+    )
+    p.add_argument('--seconds', type=float, default=default_seconds,
+                    help='Duration of the profile')
+    p.add_argument('--pid', type=int,
+                    help='Process id of the server. Defaults to ' + pid_file)
+    return p
+
+
+def install(seconds=default_seconds):
+    """
+    Make the process profile itself when it receives SIGUSR1. No cost until
+    then: only a signal handler is installed.
+
+    Args:
+        seconds (float, optional) : duration of a profile when no duration
+                                    was asked with request_file
+    """
+    if not hasattr(signal, "SIGUSR1"):
+        utils.logger.warning("No SIGUSR1 here, on-demand profiling disabled")
+        return
+
+    def on_signal(signum, frame):
+        duration = seconds
+        try:
+            with open(request_file, "r") as f:
+                duration = float(json.load(f)["seconds"])
+            os.remove(request_file)
+        except (OSError, ValueError, KeyError):
+            pass
+        start(duration)
+
+    signal.signal(signal.SIGUSR1, on_signal)
+    try:
+        os.makedirs(os.path.dirname(pid_file), exist_ok=True)
+        with open(pid_file, "w") as f:
+            f.write(str(os.getpid()))
+    except OSError:
+        pass
+
+
+def start(seconds):
+    """
+    Profile the process in a background thread for some time
+
+    Args:
+        seconds (float) : duration of the profile
+
+    Returns:
+        started (bool) : False if a profile is already running
+    """
+    if not _running.acquire(blocking=False):
+        utils.logger.warning("A profile is already running")
+        return False
+    threading.Thread(target=_profile, args=(seconds,), daemon=True,
+                     name="profiler").start()
+    return True
+
+
+def _stack(frame):
+    """ Collapsed stack of a frame, root first: file:function;file:function """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def _profile(seconds):
+    """ Sample the stacks and trace the allocations, then write the reports """
+    logger = utils.logger
+    try:
+        logger.warning(f"Profiling for {seconds:.0f} s")
+        tracing = not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start(memory_frames)
+        before = tracemalloc.take_snapshot()
+
+        me = threading.get_ident()
+        counts = collections.Counter()
+        nb_samples = 0
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    counts[f"{names.get(ident, ident)};{_stack(frame)}"] += 1
+            nb_samples += 1
+            time.sleep(sample_interval)
+
+        after = tracemalloc.take_snapshot()
+        if tracing:
+            tracemalloc.stop()
+
+        stacks_path, summary_path = write_reports(counts, after.compare_to(before, "traceback"),
+                                                  nb_samples, seconds)
+        logger.warning(f"Profile written in {stacks_path} and {summary_path}")
+    except Exception:
+        logger.exception("Profile failed")
+    finally:
+        _running.release()
+
+
+def write_reports(counts, memory_diff, nb_samples, seconds):
+    """
+    Args:
+        counts (collections.Counter) : collapsed stack -> number of samples
+        memory_diff (list of tracemalloc.StatisticDiff) : sorted by growth
+        nb_samples (int) : number of sampling rounds
+        seconds (float) : duration of the profile
+
+    Returns:
+        stacks_path (str), summary_path (str) : reports written
+    """
+    os.makedirs(report_dir, exist_ok=True)
+    prefix = os.path.join(report_dir, time.strftime("%Y%m%d_%H%M%S"))
+
+    stacks_path = prefix + "_stacks.txt"
+    with open(stacks_path, "w") as f:
+        for stack, count in counts.most_common():
+            f.write(f"{stack} {count}\n")
+
+    # Self time: the function on top of the stacks
+    leaves = collections.Counter()
+    for stack, count in counts.items():
+        leaves[stack.rsplit(";", 1)[-1]] += count
+
+    summary_path = prefix + "_summary.txt"
+    with open(summary_path, "w") as f:
+        f.write(f"{nb_samples} samples in {seconds:.0f} s\n\n")
+        f.write("Top functions (samples on top of the stack, every thread):\n")
+        for name, count in leaves.most_common(memory_top):
+            f.write(f"  {count:8d}  {name}\n")
+        f.write("\nAllocations that grew the most:\n")
+        for stat in memory_diff[:memory_top]:
+            f.write(f"  {stat.size_diff / 1024:+10.1f} KiB  {stat.count_diff:+8d} blocks  " \
+                    f"(now {stat.size / 1024:.1f} KiB)\n")
+            for line in stat.traceback.format(limit=memory_frames, most_recent_first=True):
+                f.write(f"      {line}\n")
+    return stacks_path, summary_path
+
+
+def main():
+    parser = build_arg_parser()
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO) # To see the results
+
+    pid = args.pid
+    if pid is None:
+        try:
+            with open(pid_file, "r") as f:
+                pid = int(f.read())
+        except (OSError, ValueError):
+            logging.error(f"No server pid in {pid_file}, use --pid")
+            return
+
+    with open(request_file, "w") as f:
+        json.dump({"seconds": args.seconds}, f)
+    try:
+        os.kill(pid, signal.SIGUSR1)
+    except (OSError, AttributeError) as e:
+        logging.error(f"Cannot signal the server {pid}: {e}")
+        return
+    logging.info(f"Profiling the server {pid} for {args.seconds:.0f} s, " \
+                 f"reports in {report_dir}")
+
+
+if __name__ == '__main__':
+    main()
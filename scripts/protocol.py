@@ -0,0 +1,378 @@
+import binascii
+import json
+import logging
+import re
+import struct
+
+import numpy as np
+
+# utils.logger, without importing utils (it imports this module)
+logger = logging.getLogger("utils")
+
+# Binary frame sent by the Tag (see make_link_frame in src/main.cpp).
+# Everything is little endian.
+#
+#   header  : magic "SP" | version u8 | type u8 | body length u16
+#
+#   type 1, snapshot (median filtered range of each anchor) :
+#   body    : tag id u16 | sequence u32 | device time (ms) u32 | nb links u8
+#             nb links * (anchor addr u16 | range (mm) u16 | RX power (cdBm) i16
+#                         | first path power (cdBm) i16)
+#
+#   type 2, raw samples (every range measured since the last frame) :
+#   body    : tag id u16 | sequence u32 | device time (ms) u32 | nb samples u16
+#             nb samples * (anchor addr u16 | range (mm) u16 | RX power (cdBm) i16
+#                           | first path power (cdBm) i16 | age (ms) u16)
+#   the age of a sample is the device time of the frame minus the time of
+#   the measure
+#
+#   type 3, heartbeat (between the data frames, see liveness.py) :
+#   body    : tag id u16 | sequence u32 | device time (ms) u32 | nb anchors in range u8
+#
+#   trailer : CRC-16/CCITT (init 0xFFFF) of header + body, u16
+#
+# Version 1 (older firmwares, still accepted) had no first path power and
+# no heartbeat.
+FRAME_MAGIC = b"SP"
+FRAME_VERSION = 2
+FRAME_TYPE_SNAPSHOT = 1
+FRAME_TYPE_SAMPLES = 2
+FRAME_TYPE_HEARTBEAT = 3
+
+HEADER = struct.Struct("<2sBBH")
+BODY = struct.Struct("<HIIB")
+SAMPLES_BODY = struct.Struct("<HIIH")
+CRC = struct.Struct("<H")
+LINK_DTYPE = np.dtype([("addr", "<u2"), ("range_mm", "<u2"), ("rx_power", "<i2"),
+                       ("fp_power", "<i2")])
+SAMPLE_DTYPE = np.dtype([("addr", "<u2"), ("range_mm", "<u2"), ("rx_power", "<i2"),
+                         ("fp_power", "<i2"), ("age_ms", "<u2")])
+V1_LINK_DTYPE = np.dtype([("addr", "<u2"), ("range_mm", "<u2"), ("rx_power", "<i2")])
+V1_SAMPLE_DTYPE = np.dtype([("addr", "<u2"), ("range_mm", "<u2"), ("rx_power", "<i2"),
+                            ("age_ms", "<u2")])
+
+max_body_length = 1024   # Anything bigger is a corrupted length
+
+# Old JSON format, still accepted (firmware compiled without USE_BINARY_FRAMES)
+json_pattern = re.compile(rb'\{"links":\s*\[.*?\]\}')
+
+
+class Frame:
+    """
+    One message of the Tag. `links` is a NumPy structured array (LINK_DTYPE,
+    or SAMPLE_DTYPE for raw samples) that points directly into the received
+    bytes for binary frames. tag, seq and device_time are None for JSON frames.
+    A heartbeat has no links, only the number of anchors in range.
+    """
+    __slots__ = ("tag", "seq", "device_time", "links", "frame_type", "in_range")
+
+    def __init__(self, tag, seq, device_time, links, frame_type=FRAME_TYPE_SNAPSHOT,
+                 in_range=None):
+        self.tag = tag
+        self.seq = seq
+        self.device_time = device_time
+        self.links = links
+        self.frame_type = frame_type
+        self.in_range = in_range
+
+    def sample_times(self):
+        """
+        Returns:
+            times (numpy.ndarray) : device time (ms) of each raw sample
+        """
+        return self.device_time - self.links["age_ms"].astype(np.int64)
+
+    def ranges(self):
+        """
+        Returns:
+            ranges (dictionary{k: anchor id, v: distance float}) : range of
+                                                    each anchor in meters
+        """
+        return {f"{addr:X}": r / 1000.0 for addr, r in
+                zip(self.links["addr"].tolist(), self.links["range_mm"].tolist())}
+
+    def rx_powers(self):
+        """
+        Returns:
+            powers (dictionary{k: anchor id, v: dBm float}) : RX power of each
+                                        anchor (0.0 if the Tag didn't send it)
+        """
+        return {f"{addr:X}": p / 100.0 for addr, p in
+                zip(self.links["addr"].tolist(), self.links["rx_power"].tolist())}
+
+    def powers(self):
+        """
+        Returns:
+            powers (dictionary{k: anchor id, v: tuple(rx dBm, first path dBm)}) :
+                    RX and first path power of each anchor, 0.0 if not sent
+        """
+        fp = (self.links["fp_power"].tolist() if "fp_power" in self.links.dtype.names
+              else [0] * len(self.links))
+        return {f"{addr:X}": (p / 100.0, f / 100.0) for addr, p, f in
+                zip(self.links["addr"].tolist(), self.links["rx_power"].tolist(), fp)}
+
+
+def crc16(data):
+    """
+    CRC-16/CCITT-FALSE, same as crc16 in src/main.cpp
+
+    Args:
+        data (bytes-like) : data to check
+
+    Returns:
+        crc (int) : 16 bits checksum
+    """
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+def encode_frame(tag, seq, device_time, links):
+    """
+    Build a binary frame, like the firmware does (useful for tests and replays)
+
+    Args:
+        tag (int) : short address of the Tag
+        seq (int) : sequence number
+        device_time (int) : millis() of the Tag
+        links (list of tuple(addr int, range float m, rx power float dBm
+                             [, first path power float dBm]))
+
+    Returns:
+        frame (bytes) : the encoded frame
+    """
+    body = BODY.pack(tag, seq & 0xFFFFFFFF, device_time & 0xFFFFFFFF, len(links))
+    body += b"".join(
+        struct.pack("<HHhh", addr, int(round(r * 1000)), int(round(p * 100)),
+                    int(round(fp[0] * 100)) if fp else 0)
+        for addr, r, p, *fp in links
+    )
+    data = HEADER.pack(FRAME_MAGIC, FRAME_VERSION, FRAME_TYPE_SNAPSHOT, len(body)) + body
+    return data + CRC.pack(crc16(data))
+
+
+def encode_samples(tag, seq, device_time, samples):
+    """
+    Build a raw samples frame, like the firmware does with SEND_RAW_SAMPLES
+
+    Args:
+        tag (int) : short address of the Tag
+        seq (int) : sequence number
+        device_time (int) : millis() of the Tag when sending
+        samples (list of tuple(addr int, range float m, rx power float dBm,
+                               device time int ms [, first path power float dBm]))
+
+    Returns:
+        frame (bytes) : the encoded frame
+    """
+    body = SAMPLES_BODY.pack(tag, seq & 0xFFFFFFFF, device_time & 0xFFFFFFFF, len(samples))
+    body += b"".join(
+        struct.pack("<HHhhH", addr, int(round(r * 1000)), int(round(p * 100)),
+                    int(round(fp[0] * 100)) if fp else 0, device_time - t)
+        for addr, r, p, t, *fp in samples
+    )
+    data = HEADER.pack(FRAME_MAGIC, FRAME_VERSION, FRAME_TYPE_SAMPLES, len(body)) + body
+    return data + CRC.pack(crc16(data))
+
+
+def encode_heartbeat(tag, seq, device_time, in_range):
+    """
+    Build a heartbeat frame, like the firmware does between its data frames
+
+    Args:
+        tag (int) : short address of the Tag
+        seq (int) : sequence number
+        device_time (int) : millis() of the Tag
+        in_range (int) : number of anchors the Tag is ranging with
+
+    Returns:
+        frame (bytes) : the encoded frame
+    """
+    body = BODY.pack(tag, seq & 0xFFFFFFFF, device_time & 0xFFFFFFFF, in_range)
+    data = HEADER.pack(FRAME_MAGIC, FRAME_VERSION, FRAME_TYPE_HEARTBEAT, len(body)) + body
+    return data + CRC.pack(crc16(data))
+
+
+def json_frame(text):
+    """
+    Convert an old JSON message ({"links":[{"A":"AAA1","R":"3.181"}, ...]}),
+    "P" (RX power) and "F" (first path power) are optional. A link that
+    doesn't fit the binary fields (negative range, range over 65.535 m...)
+    is skipped, the other links of the message are kept.
+
+    Args:
+        text (bytes) : one complete JSON object
+
+    Returns:
+        frame (Frame or None) : None if the JSON is invalid
+    """
+    try:
+        links = json.loads(text).get("links", [])
+        if not isinstance(links, list):
+            raise TypeError("links is not a list")
+    except (ValueError, AttributeError, TypeError) as e:
+        logger.error(f"Invalid JSON frame {text!r}: {e}")
+        return None
+
+    rows = []
+    for link in links:
+        try:
+            row = (int(link["A"], 16), int(round(float(link["R"]) * 1000)),
+                   int(round(float(link.get("P", 0.0)) * 100)),
+                   int(round(float(link.get("F", 0.0)) * 100)))
+        except (ValueError, KeyError, TypeError, AttributeError, OverflowError) as e:
+            logger.debug(f"Invalid link {link!r} skipped: {e}")
+            continue
+        if not (0 <= row[0] <= 0xFFFF and 0 <= row[1] <= 0xFFFF
+                and all(-0x8000 <= power <= 0x7FFF for power in row[2:])):
+            logger.debug(f"Link out of range {link!r} skipped")
+            continue
+        rows.append(row)
+    return Frame(None, None, None, np.array(rows, dtype=LINK_DTYPE))
+
+
+class StreamDecoder:
+    """
+    Cuts the TCP byte stream of one connection into Frames. Binary frames
+    and JSON messages are both accepted, garbage is skipped until the next
+    frame start. Keeps track of the sequence numbers to count lost frames.
+    """
+
+    def __init__(self):
+        self.buffer = b""
+        self.last_seq = None
+        self.lost = 0
+        self.corrupted = 0
+
+    def feed(self, data):
+        """
+        Add received bytes and decode every complete frame
+
+        Args:
+            data (bytes) : bytes received from the socket
+
+        Returns:
+            frames (list of Frame) : complete frames in reception order
+        """
+        buf = self.buffer + data if self.buffer else data
+        frames = []
+        pos = 0
+        end = len(buf)
+
+        while pos < end:
+            if buf.startswith(FRAME_MAGIC, pos):
+                if end - pos < HEADER.size:
+                    break
+                magic, version, frame_type, length = HEADER.unpack_from(buf, pos)
+                if version not in (1, FRAME_VERSION) or length > max_body_length:
+                    self.corrupted += 1
+                    pos = self.resync(buf, pos + 1)
+                    continue
+                total = HEADER.size + length + CRC.size
+                if end - pos < total:
+                    break
+                frame = self.decode_binary(buf, pos, frame_type, length, version)
+                if frame is None:
+                    pos = self.resync(buf, pos + 1)
+                    continue
+                frames.append(frame)
+                pos += total
+
+            elif buf.startswith(b"{", pos):
+                match = json_pattern.match(buf, pos)
+                if match is None:
+                    # Incomplete message, or garbage starting with {
+                    if buf.find(b"]}", pos) == -1 and end - pos < max_body_length:
+                        break
+                    pos = self.resync(buf, pos + 1)
+                    continue
+                frame = json_frame(match.group())
+                if frame is not None:
+                    frames.append(frame)
+                pos = match.end()
+
+            else:
+                start = self.resync(buf, pos)
+                if start == pos:
+                    break   # Only the beginning of a magic, wait for more
+                pos = start
+
+        self.buffer = buf[pos:]
+        return frames
+
+    def resync(self, buf, pos):
+        """
+        Position of the next possible frame start
+
+        Args:
+            buf (bytes) : buffer being decoded
+            pos (int) : where to start looking
+
+        Returns:
+            pos (int) : index of the next frame start, or len(buf)
+        """
+        starts = [i for i in (buf.find(FRAME_MAGIC, pos), buf.find(b"{", pos)) if i != -1]
+        if starts:
+            return min(starts)
+        # Keep a last "S" in case the magic was cut in 2 chunks
+        return len(buf) - 1 if buf.endswith(FRAME_MAGIC[:1]) else len(buf)
+
+    def decode_binary(self, buf, pos, frame_type, length, version=FRAME_VERSION):
+        """
+        Decode a complete binary frame
+
+        Args:
+            buf (bytes) : buffer being decoded
+            pos (int) : index of the frame start
+            frame_type (int) : type read in the header
+            length (int) : body length read in the header
+            version (int, optional) : version read in the header
+
+        Returns:
+            frame (Frame or None) : None if the frame is corrupted or unknown
+        """
+        body_start = pos + HEADER.size
+        (crc,) = CRC.unpack_from(buf, body_start + length)
+        if crc16(memoryview(buf)[pos:body_start + length]) != crc:
+            self.corrupted += 1
+            logger.warning("Corrupted frame (bad checksum)")
+            return None
+
+        if frame_type == FRAME_TYPE_HEARTBEAT and length == BODY.size:
+            tag, seq, device_time, in_range = BODY.unpack_from(buf, body_start)
+            self.check_sequence(seq)
+            return Frame(tag, seq, device_time, np.empty(0, dtype=LINK_DTYPE),
+                         FRAME_TYPE_HEARTBEAT, in_range)
+        if frame_type == FRAME_TYPE_SNAPSHOT:
+            body, dtype = BODY, LINK_DTYPE if version == FRAME_VERSION else V1_LINK_DTYPE
+        elif frame_type == FRAME_TYPE_SAMPLES:
+            body, dtype = SAMPLES_BODY, SAMPLE_DTYPE if version == FRAME_VERSION else V1_SAMPLE_DTYPE
+        else:
+            self.corrupted += 1
+            logger.warning(f"Unknown frame type {frame_type}")
+            return None
+
+        if length < body.size:
+            self.corrupted += 1
+            return None
+        tag, seq, device_time, count = body.unpack_from(buf, body_start)
+        if body.size + count * dtype.itemsize != length:
+            self.corrupted += 1
+            return None
+
+        links = np.frombuffer(buf, dtype=dtype, count=count,
+                              offset=body_start + body.size)
+        self.check_sequence(seq)
+        return Frame(tag, seq, device_time, links, frame_type)
+
+    def check_sequence(self, seq):
+        """
+        Count the frames lost between the last sequence number and this one
+
+        Args:
+            seq (int) : sequence number of the received frame
+        """
+        if self.last_seq is not None:
+            gap = (seq - self.last_seq - 1) & 0xFFFFFFFF
+            if 0 < gap < 0x80000000:
+                self.lost += gap
+                logger.warning(f"{gap} frame(s) lost (total {self.lost})")
+        self.last_seq = seq
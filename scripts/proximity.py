@@ -0,0 +1,410 @@
+import argparse
+import csv
+import logging
+import math
+import os
+
+import numpy as np
+
+from meanRange import open_log
+import utils
+
+proximity_radius = 1.0  # m, 2 tags closer than that are together
+time_step = 0.2         # s, the trajectories are aligned on this time grid
+max_hold = 2.0          # s, a position is valid that long after it was measured
+
+# Neighbor cells checked for each cell of the spatial hash: the cell itself and
+# half of its 8 neighbors, the other half finds the same pairs from the other side
+half_neighbors = [(0, 0), (1, -1), (1, 0), (1, 1), (0, 1)]
+
+
+def build_arg_parser():
+    """Build argument parser."""
+    p = argparse.ArgumentParser(
+        description="Proximity between tags: time spent together and groups, " \
+                    "from positions CSV (one per tag, or with a Tag column)"
+    )
+    p.add_argument('--csv', type=str, nargs='+', default=["../logs/positions.csv"],
+                    help='CSV file(s) we want to read from (.gz, .bz2, .xz accepted)')
+    p.add_argument('--radius', type=float, default=proximity_radius,
+                    help='Distance in meters under which 2 tags are together')
+    p.add_argument('--step', type=float, default=time_step,
+                    help='Time step in seconds of the aligned trajectories')
+    p.add_argument('--top', type=int, default=10,
+                    help='Number of pairs and groups printed')
+    p.add_argument('--output', type=str,
+                    help='Optional CSV file to save the time spent together per pair')
+    return p
+
+
+def read_tracks(paths):
+    """
+    Positions of every tag. A log with a Tag column can hold many tags,
+    otherwise each file is one tag named after the file. The log of the
+    server (no header row) is read too.
+
+    Args:
+        paths (list of str) : CSV logs
+
+    Returns:
+        tracks (dictionary{k: tag, v: tuple(times, xs, ys)}) : numpy arrays
+                                                               sorted by time
+    """
+    rows = {}
+    for path in paths:
+        default_tag = os.path.basename(path).split(".")[0]
+        with open_log(path) as file:
+            for row in utils.read_log(file):
+                x = row.get("x_transformed", row.get("pos_x"))
+                y = row.get("y_transformed", row.get("pos_y"))
+                if not x or not y or not row.get("Timestamp"):
+                    continue
+                try:
+                    x, y = float(x), float(y)
+                except ValueError:
+                    continue  # skip invalid rows
+                tag = row.get("Tag") or default_tag
+                rows.setdefault(tag, ([], [], []))
+                rows[tag][0].append(row["Timestamp"])
+                rows[tag][1].append(x)
+                rows[tag][2].append(y)
+
+    tracks = {}
+    for tag, (times, xs, ys) in rows.items():
+        times = utils.log_times(times)
+        valid = ~np.isnan(times)
+        if not valid.any():
+            continue
+        order = np.argsort(times[valid], kind="stable")
+        tracks[tag] = (times[valid][order], np.array(xs, dtype=float)[valid][order],
+                       np.array(ys, dtype=float)[valid][order])
+    return tracks
+
+
+def align(tracks, step=time_step):
+    """
+    Positions of every tag on a common time grid: the last position measured,
+    if it is recent enough (max_hold)
+
+    Args:
+        tracks (dictionary{k: tag, v: tuple(times, xs, ys)})
+        step (float, optional) : time step of the grid
+
+    Returns:
+        tags (list of str) : tag of each column
+        grid (numpy.ndarray) : shape (T,) times
+        xs (numpy.ndarray) : shape (T, N) NaN when the tag has no position
+        ys (numpy.ndarray) : shape (T, N)
+    """
+    tags = sorted(tracks)
+    start = min(tracks[t][0][0] for t in tags)
+    end = max(tracks[t][0][-1] for t in tags)
+    grid = start + np.arange(int((end - start) / step) + 1) * step
+
+    xs = np.full((len(grid), len(tags)), np.nan)
+    ys = np.full((len(grid), len(tags)), np.nan)
+    for column, tag in enumerate(tags):
+        times, tx, ty = tracks[tag]
+        last = np.searchsorted(times, grid, side="right") - 1
+        valid = last >= 0
+        valid[valid] = grid[valid] - times[last[valid]] <= max_hold
+        xs[valid, column] = tx[last[valid]]
+        ys[valid, column] = ty[last[valid]]
+    return tags, grid, xs, ys
+
+
+def close_pairs(xs, ys, radius=proximity_radius):
+    """
+    Every pair of tags closer than radius, at every time step. The positions
+    are hashed in cells of the radius size, only the tags of neighbor cells
+    are compared: no O(N^2) pairs per step, and all the steps at once.
+
+    Args:
+        xs (numpy.ndarray) : shape (T, N) NaN when the tag has no position
+        ys (numpy.ndarray) : shape (T, N)
+        radius (float, optional) : distance under which 2 tags are together
+
+    Returns:
+        steps (numpy.ndarray) : time step of each pair
+        a (numpy.ndarray) : first tag (column) of each pair
+        b (numpy.ndarray) : second tag of each pair, always a < b
+        distances (numpy.ndarray) : distance of each pair
+    """
+    step, tag = np.nonzero(~np.isnan(xs))
+    px, py = xs[step, tag], ys[step, tag]
+    cx = np.floor(px / radius).astype(np.int64)
+    cy = np.floor(py / radius).astype(np.int64)
+    cx -= cx.min(initial=0) - 1     # room for the -1 and +1 neighbors
+    cy -= cy.min(initial=0) - 1
+    width, height = cx.max(initial=0) + 2, cy.max(initial=0) + 2
+
+    def cell_key(s, x, y):
+        return (s * width + x) * height + y
+
+    keys = cell_key(step, cx, cy)
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    cells, starts, counts = np.unique(keys, return_index=True, return_counts=True)
+    cell_point = order[starts]  # one point of each cell, to know its coordinates
+
+    result = []
+    for dx, dy in half_neighbors:
+        # Cells that have a non empty neighbor at (dx, dy)
+        neighbor = cell_key(step[cell_point], cx[cell_point] + dx, cy[cell_point] + dy)
+        found = np.searchsorted(cells, neighbor)
+        found[found == len(cells)] = 0
+        hit = np.nonzero(cells[found] == neighbor)[0]
+        first, second = hit, found[hit]
+
+        # Every (point of the cell, point of the neighbor) pair, vectorized
+        sizes = counts[first] * counts[second]
+        pair = np.repeat(np.arange(len(first)), sizes)
+        k = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        i = order[starts[first][pair] + k // counts[second][pair]]
+        j = order[starts[second][pair] + k % counts[second][pair]]
+        if (dx, dy) == (0, 0):
+            keep = tag[i] < tag[j]  # each pair once, not with itself
+            i, j = i[keep], j[keep]
+
+        distance = np.hypot(px[i] - px[j], py[i] - py[j])
+        close = distance <= radius
+        result.append((step[i][close], tag[i][close], tag[j][close], distance[close]))
+
+    steps, a, b, distances = (np.concatenate(r) for r in zip(*result))
+    return steps, np.minimum(a, b), np.maximum(a, b), distances
+
+
+def connected_groups(steps, a, b, nb_tags):
+    """
+    Groups of tags at each time step: the connected components of the close
+    pairs (A close to B and B close to C is one group), by label propagation
+    on all the steps at once.
+
+    Args:
+        steps (numpy.ndarray), a (numpy.ndarray), b (numpy.ndarray) : close_pairs
+        nb_tags (int) : number of tags
+
+    Returns:
+        nodes (numpy.ndarray) : step * nb_tags + tag of each tag in a group
+        labels (numpy.ndarray) : group of each node (the smallest node of
+                                 the group), same label = same group
+    """
+    first, second = steps * nb_tags + a, steps * nb_tags + b
+    nodes, inverse = np.unique(np.concatenate([first, second]), return_inverse=True)
+    first, second = inverse[:len(first)], inverse[len(first):]
+
+    labels = np.arange(len(nodes))
+    while True:
+        smallest = np.minimum(labels[first], labels[second])
+        new = labels.copy()
+        np.minimum.at(new, first, smallest)
+        np.minimum.at(new, second, smallest)
+        new = new[new]  # jump to the label of the label
+        if np.array_equal(new, labels):
+            return nodes, nodes[labels]
+        labels = new
+
+
+def pair_summary(steps, a, b, nb_tags, step):
+    """
+    Time spent together and number of meetings of every pair
+
+    Args:
+        steps (numpy.ndarray), a (numpy.ndarray), b (numpy.ndarray) : close_pairs
+        nb_tags (int) : number of tags
+        step (float) : time step of the grid
+
+    Returns:
+        together (numpy.ndarray) : shape (N, N) seconds, upper triangle
+        meetings (numpy.ndarray) : shape (N, N) number of separate periods
+                                   spent together, upper triangle
+    """
+    code = a * nb_tags + b
+    together = np.bincount(code, minlength=nb_tags * nb_tags) * step
+
+    order = np.lexsort((steps, code))
+    code, steps = code[order], steps[order]
+    new_meeting = np.ones(len(code), dtype=bool)
+    new_meeting[1:] = (code[1:] != code[:-1]) | (steps[1:] != steps[:-1] + 1)
+    meetings = np.bincount(code[new_meeting], minlength=nb_tags * nb_tags)
+    return together.reshape(nb_tags, nb_tags), meetings.reshape(nb_tags, nb_tags)
+
+
+def group_summary(nodes, labels, nb_tags, step):
+    """
+    Time spent by each group of tags together (same members)
+
+    Args:
+        nodes (numpy.ndarray), labels (numpy.ndarray) : connected_groups
+        nb_tags (int) : number of tags
+        step (float) : time step of the grid
+
+    Returns:
+        groups (dictionary{k: tuple of tag columns, v: seconds})
+    """
+    if len(nodes) == 0:
+        return {}
+    order = np.lexsort((nodes, labels))
+    members = nodes[order] % nb_tags
+    boundaries = np.nonzero(np.diff(labels[order]))[0] + 1
+
+    groups = {}
+    for group in np.split(members, boundaries):
+        key = tuple(group.tolist())
+        groups[key] = groups.get(key, 0.0) + step
+    return groups
+
+
+class ProximityTracker:
+    """
+    Live proximity of the tags: each new position is compared with the tags
+    of the 9 cells around it only (spatial hash), so a position costs the
+    same with 2 or 40 tags in the room.
+    """
+
+    def __init__(self, radius=proximity_radius):
+        self.radius = radius
+        self.cells = {}         # cell -> set of tags
+        self.positions = {}     # tag -> (x, y, t, cell)
+        self.partners = {}      # tag -> set of tags close to it
+        self.close_since = {}   # (a, b) -> last time they were seen close
+        self.together = {}      # (a, b) -> seconds
+        self.meetings = {}      # (a, b) -> number of periods together
+
+    def update(self, tag, x, y, t):
+        """
+        Add a position
+
+        Args:
+            tag (str) : identifier of the tag
+            x (float) : x coordinate of the tag
+            y (float) : y coordinate of the tag
+            t (float) : time of the position in seconds
+        """
+        cell = (math.floor(x / self.radius), math.floor(y / self.radius))
+        previous = self.positions.get(tag)
+        if previous is not None and previous[3] != cell:
+            self.cells[previous[3]].discard(tag)
+        self.cells.setdefault(cell, set()).add(tag)
+        self.positions[tag] = (x, y, t, cell)
+
+        close = set()
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for other in self.cells.get((cell[0] + dx, cell[1] + dy), ()):
+                    if other == tag:
+                        continue
+                    ox, oy, ot, _ = self.positions[other]
+                    if t - ot <= max_hold and math.hypot(x - ox, y - oy) <= self.radius:
+                        close.add(other)
+
+        for other in close:
+            pair = (min(tag, other), max(tag, other))
+            last = self.close_since.get(pair)
+            if last is not None and 0 < t - last <= max_hold:
+                self.together[pair] = self.together.get(pair, 0.0) + t - last
+            elif last is None or t - last > max_hold:
+                self.meetings[pair] = self.meetings.get(pair, 0) + 1
+            self.close_since[pair] = t
+        for other in self.partners.get(tag, set()) - close:
+            self._separate(tag, other)
+        self.partners[tag] = close
+        for other in close:
+            self.partners.setdefault(other, set()).add(tag)
+
+    def _separate(self, tag, other):
+        self.close_since.pop((min(tag, other), max(tag, other)), None)
+        self.partners.get(other, set()).discard(tag)
+
+    def remove(self, tag):
+        """
+        Forget a tag (ex: its connection was closed)
+
+        Args:
+            tag (str) : identifier of the tag
+        """
+        position = self.positions.pop(tag, None)
+        if position is not None:
+            self.cells[position[3]].discard(tag)
+        for other in self.partners.pop(tag, set()):
+            self._separate(tag, other)
+
+    def groups(self):
+        """
+        Returns:
+            groups (list of list of str) : tags that are together now
+        """
+        seen = set()
+        groups = []
+        for tag in sorted(self.partners):
+            if tag in seen or not self.partners[tag]:
+                continue
+            group, todo = set(), [tag]
+            while todo:
+                current = todo.pop()
+                if current not in group:
+                    group.add(current)
+                    todo.extend(self.partners.get(current, ()))
+            seen |= group
+            groups.append(sorted(group))
+        return groups
+
+    def summary(self):
+        """
+        Returns:
+            summary (dict) : pairs close now, groups now, and seconds and
+                             meetings of every pair since the start
+        """
+        return {
+            "close": [list(pair) for pair in self.close_since],
+            "groups": self.groups(),
+            "pairs": [[a, b, round(seconds, 1), self.meetings.get((a, b), 0)]
+                      for (a, b), seconds in self.together.items()],
+        }
+
+
+def main():
+    parser = build_arg_parser()
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO) # To see the results
+
+    paths = [p for p in args.csv if os.path.exists(p)]
+    for missing in set(args.csv) - set(paths):
+        logging.error(f"File {missing} does not exist.")
+    if not paths:
+        return
+
+    tracks = read_tracks(paths)
+    if len(tracks) < 2:
+        logging.warning(f"{len(tracks)} tag found, at least 2 are needed.")
+        return
+
+    tags, grid, xs, ys = align(tracks, args.step)
+    steps, a, b, distances = close_pairs(xs, ys, args.radius)
+    together, meetings = pair_summary(steps, a, b, len(tags), args.step)
+    nodes, labels = connected_groups(steps, a, b, len(tags))
+    groups = group_summary(nodes, labels, len(tags), args.step)
+
+    logging.info(f"{len(tags)} tags over {grid[-1] - grid[0]:.0f} s, " \
+                 f"together = closer than {args.radius} m")
+    logging.info("Pairs most often together:")
+    pairs = sorted(zip(*np.nonzero(together)), key=lambda p: -together[p])
+    for i, j in pairs[:args.top]:
+        logging.info(f"  {tags[i]} - {tags[j]}: {together[i, j]:.1f} s " \
+                     f"in {meetings[i, j]} meetings")
+
+    logging.info("Groups most often together:")
+    for members, seconds in sorted(groups.items(), key=lambda g: -g[1])[:args.top]:
+        logging.info(f"  {', '.join(tags[m] for m in members)}: {seconds:.1f} s")
+
+    if args.output:
+        with open(args.output, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["tag_a", "tag_b", "seconds", "meetings"])
+            for i, j in pairs:
+                writer.writerow([tags[i], tags[j], round(together[i, j], 1), meetings[i, j]])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import numpy as np
+
+filter_window = 9       # raw ranges kept per anchor
+min_history = 3         # ranges needed before the Hampel test is applied
+hampel_k = 3.0          # outlier if further than k * sigma from the median
+mad_floor = 0.05        # m, sigma never considered smaller (UWB noise)
+max_range_rate = 3.0    # m/s, a walking student can't change a range faster
+rate_slack = 0.2        # m, allowed change whatever the time elapsed
+
+
+class RangeFilter:
+    """
+    Rejects the bad ranges of one tag before they reach the solver.
+
+    Keeps, for every anchor, a ring buffer of the last raw ranges in a fixed
+    NumPy array, so the memory per tag never grows. A range is rejected if
+    it is a Hampel outlier (too far from the median of its window, in MAD)
+    or if it changed faster than max_range_rate since the last accepted
+    range of the same anchor. All the anchors of a frame are tested at once.
+    """
+
+    def __init__(self, anchor_ids, window=filter_window):
+        """
+        Args:
+            anchor_ids (list of str) : every anchor that can be received
+            window (int, optional) : ranges kept per anchor
+        """
+        self.index = {a: i for i, a in enumerate(anchor_ids)}
+        n = len(anchor_ids)
+        self.window = window
+        self.history = np.full((n, window), np.nan)
+        self.pos = np.zeros(n, dtype=np.intp)
+        self.count = np.zeros(n, dtype=np.intp)
+        self.last_range = np.full(n, np.nan)
+        self.last_time = np.full(n, -np.inf)
+        self.rejected = 0
+
+    def filter(self, ranges, timestamp):
+        """
+        Add the ranges of a frame and keep only the trustworthy ones
+
+        Args:
+            ranges (dictionary{k: anchor id, v: distance float}) : ranges measured
+            timestamp (float) : time of the measure in seconds
+
+        Returns:
+            ranges (dictionary{k: anchor id, v: distance float}) : accepted ranges
+        """
+        ids = [a for a in ranges if a in self.index]
+        if not ids:
+            return {}
+        idx = np.fromiter((self.index[a] for a in ids), dtype=np.intp, count=len(ids))
+        r = np.fromiter((ranges[a] for a in ids), dtype=float, count=len(ids))
+
+        keep = np.ones(len(ids), dtype=bool)
+
+        # Hampel test against the window of each anchor
+        ready = self.count[idx] >= min_history
+        if ready.any():
+            rows = self.history[idx[ready]]
+            # Sorting puts the NaN of a window not full yet at the end, so the
+            # median is at n // 2 of the n valid values (like median_filter
+            # in main.cpp). Much cheaper than np.median / np.nanmedian.
+            n = np.minimum(self.count[idx[ready]], self.window)
+            lines = np.arange(len(rows))
+            median = np.sort(rows, axis=1)[lines, n // 2]
+            mad = np.sort(np.abs(rows - median[:, None]), axis=1)[lines, n // 2]
+            sigma = np.maximum(1.4826 * mad, mad_floor)
+            keep[ready] = np.abs(r[ready] - median) <= hampel_k * sigma
+
+        # Rate of change since the last accepted range (NaN = never accepted).
+        # dt < 0 when the clock offset of the Tag was refined downwards or
+        # the samples arrive out of order: only the slack is then allowed
+        dt = np.maximum(timestamp - self.last_time[idx], 0.0)
+        too_fast = np.abs(r - self.last_range[idx]) > rate_slack + max_range_rate * dt
+        keep &= ~too_fast
+
+        # The window holds the raw ranges so a real jump is accepted once
+        # the median followed it
+        self.history[idx, self.pos[idx]] = r
+        self.pos[idx] = (self.pos[idx] + 1) % self.window
+        self.count[idx] += 1
+
+        self.last_range[idx[keep]] = r[keep]
+        self.last_time[idx[keep]] = timestamp
+        self.rejected += len(ids) - int(keep.sum())
+
+        return {a: ranges[a] for a, k in zip(ids, keep.tolist()) if k}
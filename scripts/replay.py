@@ -0,0 +1,187 @@
+import argparse
+import heapq
+import logging
+import os
+import time
+
+import capture
+import gdop
+import nlos
+import protocol
+from session import TagSession
+import utils
+
+
+def build_arg_parser():
+    """Build argument parser."""
+    p = argparse.ArgumentParser(
+        description="Replay raw captures of the server (--capture) through " \
+                    "the whole ingestion: decoding, filtering, solving, CSV"
+    )
+    p.add_argument('--capture', type=str, nargs='+', required=True,
+                    help='Capture file(s), replayed together in receive time order')
+    p.add_argument('--speed', type=float, default=0.0,
+                    help='Replay speed: 1 is real time, 10 is 10x faster, ' \
+                         '0 is as fast as possible')
+    p.add_argument('--config', type=str, default="../config.json",
+                    help='Config file with the anchors')
+    p.add_argument('--output', type=str, default="../logs/replay.csv",
+                    help='CSV file written, like the server positions.csv')
+    p.add_argument('--workers', type=int, default=0,
+                    help='Solve in that many processes, like the server --workers')
+    p.add_argument('--range_model', type=str, default="../calibration/range_model.json",
+                    help='Range weights like the server --range_model (see nlos.py)')
+    p.add_argument('--rooms', type=str,
+                    help='Config files of every room (glob, ex: "../config*.json"): ' \
+                         'the room of each Tag is chosen from its ranges (see rooms.py)')
+    p.add_argument('--shm', type=str, nargs='?', const="spatialPedagogy",
+                    help='Publish the positions in that shared memory like the ' \
+                         'server --shm, to test the live readers (with --speed 1)')
+    p.add_argument('--db', type=str,
+                    help='Also write the positions in that SQLite file, as a ' \
+                         'new session (see store.py)')
+    return p
+
+
+def _records(reader, index):
+    """ Records of one capture, then None when its connection was closed """
+    recv_time = 0.0
+    for recv_time, chunk in reader:
+        yield recv_time, index, chunk
+    yield recv_time, index, None
+
+
+def chunks(readers):
+    """
+    Chunks of every capture merged in receive time order. Equal times keep
+    the order of the captures, so the replay is deterministic.
+
+    Args:
+        readers (list of capture.CaptureReader)
+
+    Yields:
+        recv_time (float), index (int), chunk (bytes or None) : index of the
+                capture the chunk comes from, chunk None at the end of a capture
+    """
+    streams = [_records(reader, i) for i, reader in enumerate(readers)]
+    yield from heapq.merge(*streams, key=lambda record: (record[0], record[1]))
+
+
+def replay(readers, speed=0.0, pool=None, live_state=None):
+    """
+    Feed captures to the ingestion as the server received them: the receive
+    times of the capture are used, never the clock of the replay.
+
+    Args:
+        readers (list of capture.CaptureReader)
+        speed (float, optional) : 1 for real time, 0 for as fast as possible
+        pool (pipeline.SolverPool, optional) : solver processes, else the
+                                frames are solved here like utils.main_loop
+        live_state (LiveState, optional) : state shared with the live views
+
+    Returns:
+        nb_frames (int) : number of frames decoded
+    """
+    decoders = [protocol.StreamDecoder() for _ in readers]
+    sessions = [None] * len(readers)
+    tags = [set() for _ in readers]
+
+    nb_frames = 0
+    first_time = None
+    start = time.monotonic()
+    for recv_time, index, chunk in chunks(readers):
+        if speed > 0:
+            if first_time is None:
+                first_time = recv_time
+            delay = (recv_time - first_time) / speed - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+        if chunk is None:   # the connection was closed
+            for tag_id in tags[index]:
+                if pool is not None:
+                    pool.disconnect(tag_id)
+                    continue
+                if utils.live_ring is not None:
+                    utils.live_ring.remove(tag_id)
+                if live_state is not None:
+                    live_state.remove(tag_id)
+            continue
+
+        # Heartbeats go to the session like in the server: they refine its
+        # clock, so the timestamps are the same as live
+        for frame in decoders[index].feed(chunk):
+            nb_frames += 1
+            # Old firmwares (JSON) don't send their id
+            tag_id = f"{frame.tag:X}" if frame.tag is not None else readers[index].addr[0]
+            tags[index].add(tag_id)
+            if pool is not None:
+                pool.submit(tag_id, frame, recv_time)
+                continue
+            if sessions[index] is None or sessions[index].tag_id != tag_id:
+                sessions[index] = TagSession(tag_id, utils.session_anchor_ids())
+            utils.process_frame(frame, sessions[index], recv_time, live_state)
+
+    if pool is not None:
+        pool.drain()
+    return nb_frames
+
+
+def main():
+    parser = build_arg_parser()
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO) # To see the results
+    utils.setup_logging()
+
+    anchors = utils.load_anchors(args.config)
+    if not anchors:
+        return
+    utils.precision_map = gdop.PrecisionMap.load(anchors)
+    utils.range_model = nlos.RangeModel.load(args.range_model)
+    if args.rooms:
+        import rooms
+        utils.rooms = rooms.RoomRegistry(args.rooms)
+    utils.filename = args.output
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    utils.clear_file()
+    if args.db:
+        import store
+        utils.store = store.PositionStore(args.db, os.path.basename(args.capture[0]).split(".")[0])
+
+    if args.shm:
+        import live_ring
+        utils.live_ring = live_ring.LiveRing(args.shm)
+
+    readers = []
+    for path in args.capture:
+        try:
+            readers.append(capture.CaptureReader(path))
+        except (OSError, ValueError) as e:
+            logging.error(f"Cannot read {path}: {e}")
+    if not readers:
+        return
+
+    pool = None
+    if args.workers > 0:
+        import pipeline
+        pool = pipeline.SolverPool(args.workers, anchors, room_configs=args.rooms)
+
+    start = time.perf_counter()
+    nb_frames = replay(readers, args.speed, pool)
+    elapsed = time.perf_counter() - start
+    if pool is not None:
+        pool.close()
+    if utils.store is not None:
+        utils.store.close()
+    if utils.live_ring is not None:
+        utils.live_ring.close()
+
+    with open(args.output, "r") as f:
+        nb_positions = sum(1 for _ in f) - 1
+    logging.info(f"{nb_frames} frames, {nb_positions} positions in {elapsed:.2f} s " \
+                 f"({nb_frames / max(elapsed, 1e-9):.0f} frames/s), written in {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,356 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+import anchor_health
+import gdop
+from range_filter import RangeFilter
+import utils
+import zones
+
+default_pattern = "../config*.json"
+reload_interval = 2.0   # s between 2 checks of the config files
+selection_frames = 20   # measurements compared at most before the room of a Tag is fixed
+min_selection_frames = 3    # measurements compared at least
+selection_ratio = 10.0  # the room is fixed once the next one fits that much worse
+
+
+def build_arg_parser():
+    """Build argument parser."""
+    p = argparse.ArgumentParser(
+        description="Rooms known by the server (one config file each) and " \
+                    "the room matching a positions CSV"
+    )
+    p.add_argument('--rooms', type=str, default=default_pattern,
+                    help='Config files of the rooms (glob pattern)')
+    p.add_argument('--csv', type=str,
+                    help='Optional CSV file: prints the room its ranges match')
+    return p
+
+
+def room_name(path):
+    """
+    Name of a room from its config file: config_square.json -> square,
+    config.json -> default
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if stem == "config":
+        return "default"
+    return stem[len("config_"):] if stem.startswith("config_") else stem
+
+
+class Room:
+    """
+    One room config with everything the solver needs, computed once at load.
+    Never modified: a changed config gives a new Room.
+    """
+
+    def __init__(self, name, path, signature, anchors, room_zones, monitor=False):
+        """
+        Args:
+            name (str) : name of the room
+            path (str) : config file
+            signature (tuple) : (mtime, size) of the file when it was read
+            anchors (dictionary{key: anchor id, value: tuple(x, y, z)})
+            room_zones (dictionary{key: zone name, value: numpy.ndarray (n, 2)})
+            monitor (bool, optional) : track the health of the anchors
+        """
+        self.name = name
+        self.path = path
+        self.signature = signature
+        self.anchors = anchors
+        self.ids = frozenset(anchors)
+        self.geometry = tuple(sorted(anchors.items()))  # same for copies of a room
+        self.coords = np.array(list(anchors.values()), dtype=float)
+        self.zones = room_zones
+        self.zone_grid = zones.ZoneGrid(room_zones) if room_zones else None
+        self.precision_map = gdop.PrecisionMap.load(anchors) if anchors else None
+        self.monitor = anchor_health.AnchorMonitor(anchors) if monitor else None
+
+    @classmethod
+    def load(cls, path, monitor=False):
+        """
+        Args:
+            path (str) : config file
+            monitor (bool, optional) : track the health of the anchors
+
+        Returns:
+            room (Room)
+
+        Raises:
+            OSError, ValueError, KeyError : unreadable or invalid config
+        """
+        stat = os.stat(path)
+        with open(path, "r") as f:
+            data = json.load(f)
+        anchors = {k: tuple(v) for k, v in data["anchors"].items()}
+        room_zones = {name: np.asarray(polygon, dtype=float)[:, :2]
+                      for name, polygon in data.get("zones", {}).items()}
+        return cls(data.get("name", room_name(path)), path,
+                   (stat.st_mtime_ns, stat.st_size), anchors, room_zones, monitor)
+
+    def fit_error(self, ranges):
+        """
+        How well ranges fit the anchors of the room: mean squared residual
+        of the least squares position, as solved by utils.tag_pos
+
+        Args:
+            ranges (dictionary{k: anchor id, v: distance float})
+
+        Returns:
+            error (float) : in m^2, inf if the ranges cannot be solved here
+        """
+        keys = [k for k in ranges if k in self.anchors]
+        if len(keys) < 3:
+            return np.inf
+        from scipy.optimize import minimize
+
+        coords = np.array([self.anchors[k] for k in keys], dtype=float)
+        dists = np.array([ranges[k] for k in keys])
+
+        def error(pos):
+            est = np.sqrt(((coords - pos) ** 2).sum(axis=1))
+            return np.sum((est - dists) ** 2)
+
+        return float(minimize(error, x0=coords.mean(axis=0)).fun) / len(keys)
+
+
+class RoomChoice:
+    """
+    Room of one Tag connection, kept in its TagSession. The anchors seen
+    choose the candidate rooms, and when several rooms have the same
+    anchors the ranges of the first measurements choose the one they fit.
+    """
+
+    def __init__(self):
+        self.seen = set()
+        self.errors = {}    # room name -> summed fit_error
+        self.count = 0
+        self.best = None    # best room so far
+        self.name = None    # fixed after selection_frames measurements
+
+
+class RoomRegistry:
+    """
+    Every room config, loaded and precomputed at startup. The rooms are a
+    dictionary that is never modified: a reload builds the changed rooms
+    aside and swaps the whole dictionary in one assignment, so readers
+    never lock, never wait and never see half a config.
+    """
+
+    def __init__(self, pattern=default_pattern, default=None, monitor=False):
+        """
+        Args:
+            pattern (str, optional) : glob of the config files
+            default (str, optional) : room used before any selection and by
+                                      the live views. Defaults to "default",
+                                      else the first room
+            monitor (bool, optional) : track the health of the anchors of
+                                       every room (see anchor_health.py)
+        """
+        self.pattern = pattern
+        self.default_name = default
+        self.monitor = monitor
+        self._rooms = {}
+        self._reload_lock = threading.Lock()   # only between 2 reloads
+        self._failed = {}   # config path -> signature of the version that failed
+        self.reload()
+        if not self._rooms:
+            utils.logger.error(f"No room config found in {pattern}")
+
+    @property
+    def rooms(self):
+        """ dictionary{k: room name, v: Room} of the current configs """
+        return self._rooms
+
+    def get(self, name):
+        return self._rooms.get(name)
+
+    @property
+    def default(self):
+        rooms = self._rooms
+        if self.default_name in rooms:
+            return rooms[self.default_name]
+        if "default" in rooms:
+            return rooms["default"]
+        return next(iter(rooms.values()), None)
+
+    def anchor_ids(self):
+        """
+        Returns:
+            ids (list of str) : anchors of every room, for the range filters
+        """
+        return sorted(set().union(*(room.ids for room in self._rooms.values())))
+
+    def reload(self):
+        """
+        Read the new and changed config files and swap them in
+
+        Returns:
+            changed (list of str) : names of the rooms added, changed or removed
+        """
+        with self._reload_lock:
+            current = {room.path: room for room in self._rooms.values()}
+            rooms, changed = {}, []
+            for path in sorted(glob.glob(self.pattern)):
+                room, signature = current.get(path), None
+                try:
+                    stat = os.stat(path)
+                    signature = (stat.st_mtime_ns, stat.st_size)
+                    if (room is None or room.signature != signature) \
+                            and self._failed.get(path) != signature:
+                        previous, room = room, Room.load(path, self.monitor)
+                        if previous is not None and previous.anchors == room.anchors:
+                            room.monitor = previous.monitor     # same anchors, same health
+                        self._failed.pop(path, None)
+                        changed.append(room.name)
+                except (OSError, ValueError, KeyError, TypeError) as e:
+                    # Often a file being saved: keep the previous version and
+                    # try again once the file changes
+                    utils.logger.error(f"Cannot load the room config {path}: {e}")
+                    self._failed[path] = signature
+                if room is None:
+                    continue
+                if room.name in rooms:
+                    utils.logger.warning(f"Room {room.name} defined twice, {path} ignored")
+                    continue
+                rooms[room.name] = room
+            removed = [room.name for path, room in current.items() if room.name not in rooms]
+            changed += removed
+            if changed:
+                self._rooms = rooms     # atomic swap, readers keep the old one
+                utils.logger.info(f"Rooms updated: {', '.join(sorted(changed))}")
+            return changed
+
+    def watch(self, interval=reload_interval):
+        """
+        Reload the configs when they change, in a daemon thread
+
+        Args:
+            interval (float, optional) : seconds between 2 checks
+        """
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reload()
+                except Exception:
+                    utils.logger.exception("Room configs reload failed")
+
+        threading.Thread(target=run, daemon=True, name="rooms-reload").start()
+
+    def room_for(self, session, ranges):
+        """
+        Room of the Tag of a session, chosen on its first measurements
+
+        Args:
+            session (TagSession) : state of the tag, keeps its RoomChoice
+            ranges (dictionary{k: anchor id, v: distance float}) : ranges received
+
+        Returns:
+            room (Room or None) : None if no room is loaded
+        """
+        rooms = self._rooms
+        choice = session.room
+        if choice is None:
+            choice = session.room = RoomChoice()
+
+        if choice.name is None or choice.name not in rooms:
+            if choice.name is not None:     # removed by a reload
+                choice.__init__()
+            self.select(choice, ranges, rooms)
+
+        room = rooms.get(choice.name or choice.best) or self.default
+        if room is not None and not room.ids.issubset(session.range_filter.index):
+            # New anchors after a reload: the range filter starts over
+            session.range_filter = RangeFilter(sorted(room.ids | session.range_filter.index.keys()))
+        return room
+
+    def select(self, choice, ranges, rooms):
+        """
+        Add a measurement to a RoomChoice, and fix its room once the
+        ranges clearly fit one room (or after selection_frames measurements)
+
+        Args:
+            choice (RoomChoice) : selection of a Tag
+            ranges (dictionary{k: anchor id, v: distance float}) : ranges received
+            rooms (dictionary{k: room name, v: Room}) : rooms to choose from
+        """
+        choice.seen.update(ranges)
+        # Rooms with the most anchors seen and the fewest unknown anchors
+        scores = {name: len(choice.seen & room.ids) - len(choice.seen - room.ids)
+                  for name, room in rooms.items()}
+        if not scores:
+            return
+        best = max(scores.values())
+        candidates = [name for name, score in scores.items() if score == best]
+
+        # Same anchor ids: the room the ranges fit best. Copies of a room
+        # (same anchors) can't be told apart, they are solved once
+        geometries = {}
+        for name in candidates:
+            geometries.setdefault(rooms[name].geometry, []).append(name)
+        errors = []
+        if len(geometries) > 1:
+            for names in geometries.values():
+                error = rooms[names[0]].fit_error(ranges)
+                for name in names:
+                    choice.errors[name] = choice.errors.get(name, 0.0) + error
+                errors.append(choice.errors[names[0]])
+            errors.sort()
+        default = self.default
+        candidates.sort(key=lambda name: (choice.errors.get(name, 0.0),
+                                          default is None or name != default.name))
+        choice.best = candidates[0]
+        choice.count += 1
+        if (len(geometries) == 1 or choice.count >= selection_frames
+                or (choice.count >= min_selection_frames
+                    and errors[1] > selection_ratio * errors[0])):
+            choice.name = candidates[0]
+            utils.logger.info(f"Room {choice.name} selected, anchors seen: "
+                              f"{', '.join(sorted(choice.seen))}")
+
+
+def main():
+    parser = build_arg_parser()
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO) # To see the results
+    utils.setup_logging()
+
+    registry = RoomRegistry(args.rooms)
+    for name, room in registry.rooms.items():
+        logging.info(f"{name:<16}{len(room.anchors):>3} anchors {len(room.zones):>3} zones  "
+                     f"{room.path}")
+
+    if args.csv:
+        from meanRange import open_log
+        from session import TagSession
+
+        session = TagSession("csv", registry.anchor_ids())
+        with open_log(args.csv) as file:
+            for row in utils.read_log(file):
+                try:
+                    ranges = {row[f"id_{i}"]: float(row[f"d{i}"]) for i in range(1, 5)
+                              if row.get(f"id_{i}") and row.get(f"d{i}")}
+                except (KeyError, ValueError):
+                    continue
+                if ranges:
+                    registry.room_for(session, ranges)
+                if session.room is not None and session.room.name is not None:
+                    break
+        if session.room is not None:
+            for name, error in sorted(session.room.errors.items(), key=lambda e: e[1]):
+                logging.info(f"{name:<16}fit error "
+                             f"{error / max(session.room.count, 1):.4f} m^2")
+            logging.info(f"Room: {session.room.name or registry.default.name}")
+
+
+if __name__ == '__main__':
+    main()
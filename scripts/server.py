@@ -1,34 +1,176 @@
 import argparse
+import threading
+
+import anchor_health
+import gdop
+import nlos
+import profiler
 import utils
+from live_state import LiveState
+import zones
 
 def build_arg_parser():
     """Build argument parser."""
     p = argparse.ArgumentParser(
         description="Server to receive the data from the Tag, compute its" \
                     "position and write it in a CSV file."
-    )    
+    )
     p.add_argument('--display', action='store_true',
                     help='Display real time graphic of position and Anchors')
+    p.add_argument('--fps', type=int, default=10,
+                    help='Maximum refresh rate of the --display window')
+    p.add_argument('--dashboard', action='store_true',
+                    help='Serve a live web page on localhost (see --dashboard_port)')
+    p.add_argument('--dashboard_port', type=int, default=8000,
+                    help='Port of the --dashboard page')
+    p.add_argument('--workers', type=int, default=0,
+                    help='Solve the positions in that many processes, reading ' \
+                         'many Tags at once (0: solve in the reception loop)')
+    p.add_argument('--queue_size', type=int, default=256,
+                    help='Frames waiting per --workers process')
+    p.add_argument('--capture', type=str,
+                    help='Record the raw stream of each Tag connection in that ' \
+                         'folder, to replay it later (see replay.py)')
+    p.add_argument('--overload', choices=["block", "drop"], default="block",
+                    help='When the --workers are late: stop reading the Tags ' \
+                         'until they catch up, or drop the new frames')
+    p.add_argument('--storage', choices=["csv", "sqlite", "both"], default="csv",
+                    help='Where the positions are written: the CSV, the SQLite ' \
+                         '--db (indexed, see store.py) or both')
+    p.add_argument('--db', type=str, default="../logs/positions.db",
+                    help='SQLite file of --storage sqlite/both')
+    p.add_argument('--session', type=str,
+                    help='Name of this session in the --db (ex: the lesson)')
+    p.add_argument('--rooms', type=str,
+                    help='Config files of every room (glob, ex: "../config*.json"): ' \
+                         'the room of each Tag is chosen from its anchors and ' \
+                         'ranges, and the configs are reloaded when they change')
+    p.add_argument('--range_model', type=str, default="../calibration/range_model.json",
+                    help='NLOS classifier and range weights learned by nlos.py. ' \
+                         'Without it, the RX and first path powers rule is used')
+    p.add_argument('--room', type=str,
+                    help='Room of the live views with --rooms. Defaults to ' \
+                         'config.json, else the first room')
+    p.add_argument('--shm', type=str, nargs='?', const="spatialPedagogy",
+                    help='Publish the live positions in that shared memory for ' \
+                         'the local programs (see live_ring.py)')
     return p
 
 
+def serve_forever(sock, live_state=None, pool=None):
+    """
+    Accept the Tag connections one after the other, forever
+
+    Args:
+        sock (socket.socket instance): Listening socke, accepts connections
+        live_state (LiveState, optional) : state shared with the live views
+        pool (pipeline.SolverPool, optional) : solver processes, the Tags are
+                                    then read at once by pipeline.serve_forever
+    """
+    if pool is not None:
+        import pipeline
+        pipeline.serve_forever(sock, pool)
+    else:
+        while True:
+            utils.main_loop(sock, live_state)
+
+
 def main():
 
     parser = build_arg_parser()
     args = parser.parse_args()
 
     sock = utils.connect_wifi()
-    args.display and utils.screen_init()
     # utils.clear_file()
-    utils.load_anchors()
+    anchors = utils.load_anchors() or {}   # [] without config: no anchors
     utils.setup_logging()
 
+    # Computed once per anchors config (then cached): each position then gets
+    # its expected error with a lookup, no computation per frame
+    if args.rooms:
+        # Every room precomputed now, then swapped in when its file changes
+        import rooms
+        utils.rooms = rooms.RoomRegistry(args.rooms, args.room, monitor=True)
+        utils.rooms.watch()
+        if utils.rooms.default is not None:
+            anchors = utils.anchors = utils.rooms.default.anchors
+    if anchors:
+        utils.precision_map = gdop.PrecisionMap.load(anchors)
+        # Flags the anchors that drift, drop out or stop answering, live
+        utils.anchor_monitor = anchor_health.AnchorMonitor(anchors)
+    utils.capture_dir = args.capture
+    # Each range weighs in the solve by how much its powers can be trusted
+    utils.range_model = nlos.RangeModel.load(args.range_model)
+    if args.storage != "csv":
+        import store
+        utils.store = store.PositionStore(args.db, args.session)
+        utils.write_csv = args.storage == "both"
+
+    if args.shm:
+        # Local readers follow the positions without touching the CSV
+        import live_ring
+        try:
+            utils.live_ring = live_ring.LiveRing(args.shm)
+        except OSError as e:
+            utils.logger.error(f"No shared memory {args.shm} ({e}), positions not published")
+
+    # Idle until asked: `python profiler.py --seconds 20` (SIGUSR1)
+    profiler.install()
+
+    live_state = None
+    if args.display or args.dashboard:
+        # The ingestion never waits on the live views: it only publishes the
+        # last positions, the views read them at their own pace
+        if utils.rooms is not None and utils.rooms.default is not None:
+            room_zones = utils.rooms.default.zones
+        else:
+            room_zones = zones.load_zones()
+        zone_grid = zones.ZoneGrid(room_zones) if room_zones else None
+        live_state = LiveState(zone_grid)
+
+    pool = None
+    if args.workers > 0:
+        import pipeline
+        pool = pipeline.SolverPool(args.workers, anchors, live_state,
+                                   args.queue_size, args.overload, args.rooms)
+
+    if args.dashboard:
+        import dashboard
+        monitor = utils.anchor_monitor
+        if utils.rooms is not None and utils.rooms.default is not None:
+            monitor = utils.rooms.default.monitor
+        dashboard.start(live_state, anchors, args.dashboard_port, room_zones, monitor)
+
     try:
-        while True:
-            utils.main_loop(sock, args.display)
+        if args.display:
+            try:
+                import display # Needs Tk, so only when asked
+            except ImportError as e:
+                utils.logger.error(f"Cannot open the display ({e}), running headless")
+                args.display = False
+
+        if args.display:
+            ingestion = threading.Thread(target=serve_forever,
+                                         args=(sock, live_state, pool), daemon=True)
+            ingestion.start()
+            display.run(live_state, anchors, args.fps)
+        else:
+            serve_forever(sock, live_state, pool)
     except KeyboardInterrupt:
         pass
+    finally:
+        if pool is not None:
+            # The writer thread writes the last positions before the outputs close
+            if not pool.drain(pipeline.shutdown_timeout):
+                utils.logger.warning("Positions still being solved were not written")
+            pool.close(pipeline.shutdown_timeout)
+        utils.recorders.close()
+        if utils.live_ring is not None:
+            ring, utils.live_ring = utils.live_ring, None
+            ring.close()
+        if utils.store is not None:
+            utils.store.close()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,233 @@
+import time
+
+import numpy as np
+
+import protocol
+from range_filter import RangeFilter
+import utils
+
+# A range is combined with the ranges of the other anchors measured at most
+# that long before it (raw samples mode)
+sample_max_age = 0.3    # s
+
+# If the Tag clock jumps by more than that, it rebooted: start over
+clock_reset_thresh = 5.0    # s
+
+# A Tag that reconnects within that delay resumes its session (range filter,
+# clock, room, capture file) instead of starting over
+resume_window = 120.0   # s
+
+
+class DeviceClock:
+    """
+    Converts the millis() of the Tag to server time. The offset kept is the
+    smallest (receive time - device time) seen: the frame that travelled the
+    fastest, so the Wi-Fi jitter is not added to the timestamps. Every
+    frame refines it, heartbeats included: the server, its workers and
+    replay.py all give them to TagSession.measurements, so a capture
+    replays to the same timestamps.
+    """
+
+    def __init__(self):
+        self.offset = None
+
+    def update(self, device_ms, recv_time):
+        """
+        Refine the offset with a received frame
+
+        Args:
+            device_ms (int) : millis() of the Tag when the frame was sent
+            recv_time (float) : server time when the frame was received
+        """
+        offset = recv_time - device_ms / 1000.0
+        if (self.offset is None or offset < self.offset
+                or offset - self.offset > clock_reset_thresh):
+            self.offset = offset
+
+    def to_time(self, device_ms):
+        """
+        Args:
+            device_ms (int or numpy.ndarray) : millis() of the Tag
+
+        Returns:
+            time (float or numpy.ndarray) : server time in seconds
+        """
+        return device_ms / 1000.0 + self.offset
+
+
+class TagSession:
+    """
+    State kept for one tag across its frames
+    """
+
+    def __init__(self, tag_id, anchor_ids):
+        """
+        Args:
+            tag_id (str) : identifier of the tag
+            anchor_ids (list of str) : every anchor that can be received
+        """
+        self.tag_id = tag_id
+        self.clock = DeviceClock()
+        self.range_filter = RangeFilter(anchor_ids)
+        self.latest = {}    # anchor id -> (range, time, powers), raw samples mode
+        self.room = None    # rooms.RoomChoice, when the server knows several rooms
+
+    def measurements(self, frame, recv_time, filter_ranges=True):
+        """
+        Turn a frame into time ordered sets of ranges to solve
+
+        A snapshot frame gives one set. A raw samples frame gives one set per
+        sample: the sample range plus the last range of every other anchor
+        measured less than sample_max_age before it. A heartbeat gives none.
+
+        Every raw range goes through the range filter once, when it arrives:
+        a set only combines ranges that passed it, and a rejected sample
+        gives no set (nothing new to solve).
+
+        Args:
+            frame (protocol.Frame) : frame received from the Tag
+            recv_time (float) : server time when the frame was received
+            filter_ranges (bool, optional) : apply the range filter. Defaults to True
+
+        Returns:
+            measurements (list of tuple(time float, ranges dict, powers dict)) :
+                    time of the measure, ranges {anchor id: distance} at that
+                    time and their powers {anchor id: (rx dBm, first path dBm)}
+        """
+        if frame.device_time is None:   # JSON, no device clock
+            return [self._filtered(recv_time, frame.ranges(), frame.powers(), filter_ranges)]
+
+        self.clock.update(frame.device_time, recv_time)
+        if frame.frame_type == protocol.FRAME_TYPE_HEARTBEAT:
+            return []
+
+        if frame.frame_type != protocol.FRAME_TYPE_SAMPLES:
+            return [self._filtered(self.clock.to_time(frame.device_time), frame.ranges(),
+                                   frame.powers(), filter_ranges)]
+
+        order = np.argsort(-frame.links["age_ms"].astype(np.int32), kind="stable")
+        times = self.clock.to_time(frame.sample_times()[order]).tolist()
+        addrs = frame.links["addr"][order].tolist()
+        ranges_mm = frame.links["range_mm"][order].tolist()
+        rx = frame.links["rx_power"][order].tolist()
+        fp = (frame.links["fp_power"][order].tolist() if "fp_power" in frame.links.dtype.names
+              else [0] * len(rx))
+
+        result = []
+        for t, addr, r, p, f in zip(times, addrs, ranges_mm, rx, fp):
+            anchor_id = f"{addr:X}"
+            r = r / 1000.0
+            if not valid_range(r):
+                continue
+            if filter_ranges and not self.range_filter.filter({anchor_id: r}, t):
+                continue
+            self.latest[anchor_id] = (r, t, (p / 100.0, f / 100.0))
+            recent = {a: s for a, s in self.latest.items() if t - s[1] <= sample_max_age}
+            result.append((t, {a: s[0] for a, s in recent.items()},
+                           {a: s[2] for a, s in recent.items()}))
+        return result
+
+    def _filtered(self, timestamp, ranges, powers, filter_ranges):
+        """ One set of ranges measured together, through the range filter """
+        ranges = {a: r for a, r in ranges.items() if valid_range(r)}
+        if filter_ranges:
+            ranges = self.range_filter.filter(ranges, timestamp)
+        return timestamp, ranges, {a: p for a, p in powers.items() if a in ranges}
+
+
+def valid_range(distance):
+    """
+    Args:
+        distance (float) : range received, in m
+
+    Returns:
+        valid (bool) : False for the ranges that can't be measured in a room
+    """
+    return 0.0 < distance < 15.0
+
+
+class ResumeCache:
+    """
+    State of the Tags (sessions, capture files...) kept for resume_window
+    after their connection is lost, so that a Tag that reconnects continues
+    where it was. A state is released once every connection that got it
+    released it, expired states are dropped on the next get or purge.
+    """
+
+    def __init__(self, factory, name="Session", window=resume_window, on_expire=None):
+        """
+        Args:
+            factory (callable) : factory(key, *args) builds the state of a new key
+            name (str, optional) : what is cached, for the logs
+            window (float, optional) : seconds a released state is kept
+            on_expire (callable, optional) : on_expire(state) when it is dropped
+        """
+        self.factory = factory
+        self.name = name
+        self.window = window
+        self.on_expire = on_expire
+        self._items = {}        # key -> state
+        self._users = {}        # key -> connections using the state
+        self._released = {}     # key -> time.monotonic() of the release
+
+    def get(self, key, *args):
+        """
+        State of a key: the one kept if it was released less than window
+        ago, else a new one
+
+        Args:
+            key (hashable) : tag id, address...
+            *args : passed to the factory
+
+        Returns:
+            state (object)
+        """
+        now = time.monotonic()
+        self.purge(now)
+        released = self._released.pop(key, None)
+        if released is not None:
+            utils.logger.info(f"{self.name} of {key} resumed after {now - released:.1f} s")
+        state = self._items.get(key)
+        if state is None:
+            state = self._items[key] = self.factory(key, *args)
+        self._users[key] = self._users.get(key, 0) + 1
+        return state
+
+    def release(self, key):
+        """
+        The connection of a key was lost: its state is kept for window seconds
+
+        Args:
+            key (hashable) : tag id, address...
+        """
+        users = self._users.get(key, 0) - 1
+        if users > 0:
+            self._users[key] = users
+        elif key in self._items:
+            self._users.pop(key, None)
+            self._released[key] = time.monotonic()
+
+    def purge(self, now=None):
+        """
+        Drop the states released more than window ago
+
+        Args:
+            now (float, optional) : time.monotonic()
+        """
+        if now is None:
+            now = time.monotonic()
+        for key, released in list(self._released.items()):
+            if now - released > self.window:
+                self._drop(key)
+
+    def close(self):
+        """ Drop every state (server exit) """
+        for key in list(self._items):
+            self._drop(key)
+
+    def _drop(self, key):
+        self._released.pop(key, None)
+        self._users.pop(key, None)
+        state = self._items.pop(key)
+        if self.on_expire is not None:
+            self.on_expire(state)
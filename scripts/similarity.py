@@ -0,0 +1,508 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import logging
+import math
+import os
+
+import numpy as np
+from scipy.ndimage import maximum_filter1d, minimum_filter1d
+
+import proximity
+import utils
+import zones
+
+resample_step = 1.0     # s, trajectories are compared with one position per second
+dtw_band = 0.1          # width of the warping band, fraction of the trajectory length
+max_length_ratio = 1.5  # candidates that walked much more or much less are skipped
+min_zone_visit = 3.0    # s, shorter visits are boundary jitter, not in the zone sequence
+max_zone_edits = 2      # zone sequence edits allowed between the query and a candidate
+index_path = "../logs/similarity_index.npz"
+index_format = 1
+
+_query = None           # (points, band) of a worker process (_init_worker)
+
+
+def build_arg_parser():
+    """Build argument parser."""
+    p = argparse.ArgumentParser(
+        description="Find the sessions whose trajectory is the most similar " \
+                    "to a query session (same route, same stations), with DTW"
+    )
+    p.add_argument('--csv', type=str, nargs='+', required=True,
+                    help='Positions CSV of the library (one per session, or with ' \
+                         'a Tag column, .gz, .bz2, .xz accepted)')
+    p.add_argument('--query', type=str, required=True,
+                    help='Session searched: a name printed in the results or a CSV')
+    p.add_argument('--tag', type=str,
+                    help='Tag of the query when its CSV has many tags')
+    p.add_argument('--top', type=int, default=10,
+                    help='Number of similar sessions printed')
+    p.add_argument('--step', type=float, default=resample_step,
+                    help='Seconds between 2 positions of the resampled trajectories')
+    p.add_argument('--band', type=float, default=dtw_band,
+                    help='DTW band, fraction of the length: how much the timing ' \
+                         'of 2 similar sessions may differ')
+    p.add_argument('--length_ratio', type=float, default=max_length_ratio,
+                    help='Skip the sessions whose path is that many times longer ' \
+                         'or shorter than the query')
+    p.add_argument('--zone_edits', type=int, default=max_zone_edits,
+                    help='Skip the sessions whose sequence of zones needs more ' \
+                         'edits to match the query (only with "zones" in the config)')
+    p.add_argument('--config', type=str, default="../config.json",
+                    help='Config file with the optional "zones" polygons')
+    p.add_argument('--index', type=str, default=index_path,
+                    help='Index file of the library, updated when the CSV change')
+    p.add_argument('--workers', type=int, default=os.cpu_count(),
+                    help='Number of processes computing the DTW')
+    return p
+
+
+def resample(times, xs, ys, step=resample_step):
+    """
+    Positions at a constant rate, linearly interpolated
+
+    Args:
+        times (numpy.ndarray) : time of each position in seconds, sorted
+        xs (numpy.ndarray) : x coordinates
+        ys (numpy.ndarray) : y coordinates
+        step (float, optional) : seconds between 2 positions
+
+    Returns:
+        points (numpy.ndarray) : shape (n, 2)
+    """
+    grid = times[0] + np.arange(int((times[-1] - times[0]) / step) + 1) * step
+    return np.column_stack([np.interp(grid, times, xs), np.interp(grid, times, ys)])
+
+
+def zone_sequence(points, zone_grid, step=resample_step):
+    """
+    Zones visited in order, without the short visits and the outside
+
+    Args:
+        points (numpy.ndarray) : shape (n, 2) resampled trajectory
+        zone_grid (zones.ZoneGrid)
+        step (float, optional) : seconds between 2 positions
+
+    Returns:
+        sequence (numpy.ndarray) : zone indexes
+    """
+    indexes = zone_grid.classify(points[:, 0], points[:, 1])
+    starts = np.flatnonzero(np.r_[True, indexes[1:] != indexes[:-1]])
+    durations = np.diff(np.r_[starts, len(indexes)]) * step
+    visits = indexes[starts][(indexes[starts] != zones.OUTSIDE) & (durations >= min_zone_visit)]
+    # A visit dropped between 2 visits of the same zone merges them
+    return visits[np.r_[True, visits[1:] != visits[:-1]]]
+
+
+def edit_distance(a, b):
+    """
+    Levenshtein distance of 2 short sequences
+
+    Args:
+        a (sequence), b (sequence)
+
+    Returns:
+        distance (int) : insertions, deletions and substitutions from a to b
+    """
+    previous = list(range(len(b) + 1))
+    for i, x in enumerate(a, 1):
+        current = [i]
+        for j, y in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (x != y)))
+        previous = current
+    return previous[-1]
+
+
+def box_lower_bounds(query, boxes):
+    """
+    Lower bound of the DTW cost between the query and many trajectories:
+    each query position is matched to at least one position of the other
+    trajectory, so it costs at least its distance to that bounding box.
+
+    Args:
+        query (numpy.ndarray) : shape (n, 2)
+        boxes (numpy.ndarray) : shape (M, 4) x min, x max, y min, y max
+
+    Returns:
+        bounds (numpy.ndarray) : shape (M,)
+    """
+    x, y = query[None, :, 0], query[None, :, 1]
+    dx = np.maximum(0.0, np.maximum(boxes[:, 0, None] - x, x - boxes[:, 1, None]))
+    dy = np.maximum(0.0, np.maximum(boxes[:, 2, None] - y, y - boxes[:, 3, None]))
+    return np.hypot(dx, dy).sum(axis=1)
+
+
+def band_width(n, m, band=dtw_band):
+    """
+    Half width of the DTW band, in positions of the second trajectory. It
+    follows the diagonal of the (n, m) matrix and is wide enough for the
+    path to go from a row to the next one.
+
+    Args:
+        n (int), m (int) : lengths of the 2 trajectories
+        band (float, optional) : fraction of m
+
+    Returns:
+        width (int)
+    """
+    return max(math.ceil(band * m), math.ceil(m / n))
+
+
+def band_lower_bound(query, points, band=dtw_band):
+    """
+    Tighter lower bound of the banded DTW cost, O(n): each query position is
+    matched inside its band window, so it costs at least its distance to the
+    bounding box of that window (the envelope of the trajectory).
+
+    Args:
+        query (numpy.ndarray) : shape (n, 2)
+        points (numpy.ndarray) : shape (m, 2)
+        band (float, optional) : DTW band
+
+    Returns:
+        bound (float)
+    """
+    n, m = len(query), len(points)
+    size = 2 * band_width(n, m, band) + 1
+    # Window of the query position i centered on the nearest j of the diagonal
+    centers = np.rint(np.arange(n) * (m / n)).astype(np.intp).clip(0, m - 1)
+    x, y = query[:, 0], query[:, 1]
+    low_x = minimum_filter1d(points[:, 0], size, mode="nearest")[centers]
+    high_x = maximum_filter1d(points[:, 0], size, mode="nearest")[centers]
+    low_y = minimum_filter1d(points[:, 1], size, mode="nearest")[centers]
+    high_y = maximum_filter1d(points[:, 1], size, mode="nearest")[centers]
+    dx = np.maximum(0.0, np.maximum(low_x - x, x - high_x))
+    dy = np.maximum(0.0, np.maximum(low_y - y, y - high_y))
+    return float(np.hypot(dx, dy).sum())
+
+
+def dtw(a, b, band=dtw_band, abandon=math.inf):
+    """
+    Dynamic time warping cost (sum of the distances of the matched positions)
+    constrained to a band around the diagonal. The cells of an anti-diagonal
+    only depend on the 2 previous anti-diagonals, so each one is computed
+    at once with numpy: n + m vectorized steps of the band width.
+
+    Args:
+        a (numpy.ndarray) : shape (n, 2)
+        b (numpy.ndarray) : shape (m, 2)
+        band (float, optional) : half width of the band, fraction of m
+        abandon (float, optional) : stop as soon as the cost is sure to be
+                                    higher (it is then inf)
+
+    Returns:
+        cost (float) : inf if abandoned
+    """
+    n, m = len(a), len(b)
+    slope = m / n
+    width = band_width(n, m, band)
+
+    # D[i, j] of the anti-diagonal i + j = k is at index i + 1, index 0 is
+    # the border (inf)
+    previous2, previous, current = (np.full(n + 1, math.inf) for _ in range(3))
+    used2 = used = used_current = (0, -1)     # range of i written in each buffer
+    previous_lowest = 0.0
+    for k in range(n + m - 1):
+        low = max(0, k - m + 1, math.ceil((k - width) / (1 + slope)))
+        high = min(n - 1, k, math.floor((k + width) / (1 + slope)))
+        current[used_current[0] + 1:used_current[1] + 2] = math.inf
+
+        d = np.hypot(a[low:high + 1, 0] - b[k - high:k - low + 1, 0][::-1],
+                     a[low:high + 1, 1] - b[k - high:k - low + 1, 1][::-1])
+        if k == 0:
+            cells = d
+        else:
+            cells = d + np.minimum(np.minimum(previous2[low:high + 1], previous[low:high + 1]),
+                                   previous[low + 1:high + 2])
+        if cells.size == 0:
+            return math.inf
+        # A path crosses one of 2 consecutive anti-diagonals at least (the
+        # diagonal moves skip one)
+        lowest = cells.min()
+        if lowest > abandon and previous_lowest > abandon:
+            return math.inf
+        previous_lowest = lowest
+        current[low + 1:high + 2] = cells
+
+        previous2, previous, current = previous, current, previous2
+        used2, used, used_current = used, (low, high), used2
+    cost = float(previous[n])
+    return cost if cost <= abandon else math.inf
+
+
+def _init_worker(query, band):
+    """ Send the query once per worker process instead of once per task """
+    global _query
+    _query = (query, band)
+
+
+def _dtw_task(points, abandon):
+    query, band = _query
+    if band_lower_bound(query, points, band) > abandon:
+        return math.inf
+    return dtw(query, points, band, abandon)
+
+
+class TrajectoryLibrary:
+    """
+    Resampled trajectories of the sessions and their prefilter features
+    (bounding box, path length, zone sequence). Saved in an index file so
+    only the new or modified logs are read again.
+    """
+
+    def __init__(self, step=resample_step, zone_grid=None):
+        """
+        Args:
+            step (float, optional) : seconds between 2 positions
+            zone_grid (zones.ZoneGrid, optional) : zones of the room
+        """
+        self.step = step
+        self.zone_grid = zone_grid
+        self.names = []
+        self.sources = []       # (path, mtime, size) of the log of each session
+        self.trajectories = []  # numpy.ndarray (n, 2)
+        self.boxes = []         # x min, x max, y min, y max
+        self.lengths = []       # m walked
+        self.zone_sequences = []
+
+    def key(self):
+        """ Identifies the settings the index was built with """
+        polygons = {}
+        if self.zone_grid is not None:
+            polygons = {"names": self.zone_grid.names, "grid": self.zone_grid.grid.tolist(),
+                        "origin": self.zone_grid.origin.tolist()}
+        text = json.dumps([index_format, self.step, polygons], sort_keys=True)
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def add(self, name, source, points, sequence=None):
+        """
+        Args:
+            name (str) : session name
+            source (tuple(path, mtime, size)) : log of the session
+            points (numpy.ndarray) : shape (n, 2) resampled trajectory
+            sequence (numpy.ndarray, optional) : zone sequence, if already known
+        """
+        if sequence is None:
+            sequence = np.empty(0, dtype=np.int16)
+            if self.zone_grid is not None:
+                sequence = zone_sequence(points, self.zone_grid, self.step)
+        self.names.append(name)
+        self.sources.append(source)
+        self.trajectories.append(points)
+        self.boxes.append((points[:, 0].min(), points[:, 0].max(),
+                           points[:, 1].min(), points[:, 1].max()))
+        self.lengths.append(float(np.hypot(*np.diff(points, axis=0).T).sum()))
+        self.zone_sequences.append(sequence)
+
+    def add_log(self, path):
+        """
+        Add every tag of a log, each one is a session
+
+        Args:
+            path (str) : positions CSV
+        """
+        stat = os.stat(path)
+        stem = os.path.basename(path).split(".")[0]
+        for tag, (times, xs, ys) in proximity.read_tracks([path]).items():
+            name = stem if tag == stem else f"{stem}:{tag}"
+            self.add(name, (path, stat.st_mtime, stat.st_size), resample(times, xs, ys, self.step))
+
+    def save(self, path):
+        """
+        Args:
+            path (str) : index file
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez_compressed(
+            tmp,
+            key=np.array(self.key()),
+            names=np.array(self.names, dtype=str),
+            paths=np.array([s[0] for s in self.sources], dtype=str),
+            mtimes=np.array([s[1] for s in self.sources], dtype=float),
+            sizes=np.array([s[2] for s in self.sources], dtype=np.int64),
+            offsets=np.cumsum([0] + [len(t) for t in self.trajectories]),
+            points=np.concatenate(self.trajectories) if self.trajectories else np.empty((0, 2)),
+            zone_offsets=np.cumsum([0] + [len(z) for z in self.zone_sequences]),
+            zone_values=np.concatenate(self.zone_sequences).astype(np.int16)
+                        if self.zone_sequences else np.empty(0, dtype=np.int16),
+        )
+        os.replace(tmp, path)   # never leave a half written index
+
+    @classmethod
+    def build(cls, paths, step=resample_step, zone_grid=None, path=None):
+        """
+        Library of the logs, reusing the index for the logs that did not change
+
+        Args:
+            paths (list of str) : positions CSV
+            step (float, optional) : seconds between 2 positions
+            zone_grid (zones.ZoneGrid, optional) : zones of the room
+            path (str, optional) : index file, read and updated
+
+        Returns:
+            library (TrajectoryLibrary)
+        """
+        library = cls(step, zone_grid)
+        indexed = {}    # path -> list of (name, source, points, zone sequence)
+        if path is not None and os.path.exists(path):
+            with np.load(path) as data:
+                if str(data["key"]) == library.key():
+                    offsets, points = data["offsets"], data["points"]
+                    zone_offsets, zone_values = data["zone_offsets"], data["zone_values"]
+                    for i, name in enumerate(data["names"].tolist()):
+                        source = (str(data["paths"][i]), float(data["mtimes"][i]),
+                                  int(data["sizes"][i]))
+                        indexed.setdefault(source[0], []).append((
+                            name, source, points[offsets[i]:offsets[i + 1]],
+                            zone_values[zone_offsets[i]:zone_offsets[i + 1]]))
+
+        nb_read = 0
+        for log in paths:
+            stat = os.stat(log)
+            sessions = indexed.get(log, [])
+            if sessions and all(s[1][1:] == (stat.st_mtime, stat.st_size) for s in sessions):
+                for session in sessions:
+                    library.add(*session)
+            else:
+                library.add_log(log)
+                nb_read += 1
+
+        if path is not None and (nb_read or set(indexed) - set(paths)):
+            try:
+                library.save(path)
+            except OSError as e:
+                utils.logger.warning(f"Cannot save the index ({e})")
+        utils.logger.debug(f"{len(library.names)} sessions, {nb_read} logs read")
+        return library
+
+    def search(self, query, top=10, band=dtw_band, length_ratio=max_length_ratio,
+               zone_edits=max_zone_edits, workers=1, exclude=None):
+        """
+        Most similar sessions: the features remove the sessions that cannot
+        match, then the sessions are compared by increasing lower bound,
+        and the search stops when no remaining session can enter the top.
+        Before its DTW, a session is skipped if its band lower bound is
+        already too high.
+
+        Args:
+            query (numpy.ndarray) : shape (n, 2) resampled trajectory
+            top (int, optional) : number of sessions returned
+            band (float, optional) : DTW band
+            length_ratio (float, optional) : path length tolerance
+            zone_edits (int, optional) : zone sequence tolerance
+            workers (int, optional) : processes computing the DTW
+            exclude (str, optional) : name of a session never returned (the query)
+
+        Returns:
+            results (list of tuple(name, cost)) : cost is the mean distance
+                                    in meters between matched positions
+            stats (dict) : number of sessions left by each stage
+        """
+        lengths = np.array(self.lengths)
+        query_length = float(np.hypot(*np.diff(query, axis=0).T).sum())
+        keep = np.array([name != exclude for name in self.names], dtype=bool)
+        stats = {"sessions": int(keep.sum())}
+
+        if query_length > 0:
+            ratio = lengths / query_length
+            keep &= (ratio <= length_ratio) & (ratio * length_ratio >= 1)
+        stats["length"] = int(keep.sum())
+
+        if self.zone_grid is not None:
+            sequence = zone_sequence(query, self.zone_grid, self.step)
+            for i in np.flatnonzero(keep):
+                keep[i] = edit_distance(sequence, self.zone_sequences[i]) <= zone_edits
+        stats["zones"] = int(keep.sum())
+
+        candidates = np.flatnonzero(keep)
+        bounds = box_lower_bounds(query, np.array(self.boxes).reshape(-1, 4)[candidates])
+        order = candidates[np.argsort(bounds, kind="stable")]
+        bounds = np.sort(bounds, kind="stable")
+
+        costs = {}
+        def threshold():
+            best = sorted(costs.values())
+            return best[top - 1] if len(best) >= top else math.inf
+
+        batch = max(1, workers) * 4
+        pool = None
+        if workers > 1 and len(order) > batch:
+            pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                       initargs=(query, band))
+        try:
+            for start in range(0, len(order), batch):
+                limit = threshold()
+                chunk = order[start:start + batch][bounds[start:start + batch] <= limit]
+                if len(chunk) == 0:
+                    break   # sorted bounds: nothing after can be better
+                points = [self.trajectories[i] for i in chunk]
+                if pool is not None:
+                    results = pool.map(_dtw_task, points, [limit] * len(chunk))
+                else:
+                    _init_worker(query, band)
+                    results = (_dtw_task(p, limit) for p in points)
+                costs.update(zip(chunk.tolist(), results))
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        stats["bounded"] = len(costs)
+        stats["dtw"] = sum(math.isfinite(cost) for cost in costs.values())
+
+        best = sorted((cost, i) for i, cost in costs.items() if math.isfinite(cost))[:top]
+        return [(self.names[i], cost / len(query)) for cost, i in best], stats
+
+
+def main():
+    parser = build_arg_parser()
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO) # To see the results
+
+    paths = [p for p in args.csv if os.path.exists(p)]
+    for missing in set(args.csv) - set(paths):
+        logging.error(f"File {missing} does not exist.")
+    if not paths:
+        return
+
+    zone_grid = None
+    if os.path.exists(args.config):
+        room_zones = zones.load_zones(args.config)
+        if room_zones:
+            zone_grid = zones.ZoneGrid(room_zones)
+
+    library = TrajectoryLibrary.build(paths, args.step, zone_grid, args.index)
+
+    exclude = None
+    if args.query in library.names:
+        exclude = args.query
+        query = library.trajectories[library.names.index(args.query)]
+    elif os.path.exists(args.query):
+        tracks = proximity.read_tracks([args.query])
+        tag = args.tag if args.tag is not None else next(iter(tracks), None)
+        if tag not in tracks:
+            logging.error(f"No tag {tag} in {args.query}, tags: {', '.join(tracks)}")
+            return
+        query = resample(*tracks[tag], args.step)
+        stem = os.path.basename(args.query).split(".")[0]
+        exclude = stem if tag == stem else f"{stem}:{tag}"
+    else:
+        logging.error(f"{args.query} is neither a session of the library nor a file.")
+        return
+
+    results, stats = library.search(query, args.top, args.band, args.length_ratio,
+                                    args.zone_edits, args.workers, exclude)
+
+    logging.info(f"{stats['sessions']} sessions, {stats['length']} with a similar path " \
+                 f"length, {stats['zones']} with similar zones, {stats['bounded']} " \
+                 f"bounded, {stats['dtw']} compared with DTW")
+    logging.info(f"Most similar to {args.query} (mean distance between matched positions):")
+    for name, cost in results:
+        logging.info(f"  {name}: {cost:.2f} m")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,469 @@
+import argparse
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from meanRange import open_log
+import utils
+
+# SQLite storage of the positions, next to (or instead of) the CSV log. One
+# session is one run of the server (or one imported CSV), a lesson for ex.
+# The analyses filter with SQL on the indexes instead of reading everything:
+#   frames (tag, time) and (session, time), ranges (anchor)
+
+batch_size = 500        # positions inserted per transaction
+flush_interval = 1.0    # s, pending positions are written at least that often
+max_pending = 50000     # positions kept while the database can't be written
+chunk_size = 10000      # rows fetched at once by the loaders
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    started REAL NOT NULL,
+    ended REAL
+);
+CREATE TABLE IF NOT EXISTS tags (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS anchors (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS frames (
+    id INTEGER PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES sessions(id),
+    tag_id INTEGER NOT NULL REFERENCES tags(id),
+    time REAL NOT NULL,
+    x REAL NOT NULL,
+    y REAL NOT NULL,
+    nb_anchors INTEGER NOT NULL,
+    expected_error REAL,
+    var_x REAL,
+    cov_xy REAL,
+    var_y REAL
+);
+CREATE TABLE IF NOT EXISTS ranges (
+    frame_id INTEGER NOT NULL REFERENCES frames(id),
+    anchor_id INTEGER NOT NULL REFERENCES anchors(id),
+    distance REAL NOT NULL,
+    PRIMARY KEY (frame_id, anchor_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS frames_tag_time ON frames(tag_id, time);
+CREATE INDEX IF NOT EXISTS frames_session_time ON frames(session_id, time);
+CREATE INDEX IF NOT EXISTS ranges_anchor ON ranges(anchor_id, frame_id);
+"""
+
+
+def build_arg_parser():
+    """Build argument parser."""
+    p = argparse.ArgumentParser(
+        description="Import positions CSV in the SQLite storage (one session " \
+                    "per file) or list its sessions"
+    )
+    p.add_argument('--db', type=str, default="../logs/positions.db",
+                    help='SQLite database, created if needed')
+    p.add_argument('--csv', type=str, nargs='*', default=[],
+                    help='CSV log(s) to import (.gz, .bz2, .xz accepted)')
+    return p
+
+
+def connect(path):
+    """
+    Open a database and create the tables if needed
+
+    Args:
+        path (str) : SQLite file
+
+    Returns:
+        connection (sqlite3.Connection)
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(path, check_same_thread=False)
+    # WAL: the analyses can read while the server writes
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(SCHEMA)
+    # Databases created before the covariance of the positions was stored
+    columns = {row[1] for row in connection.execute("PRAGMA table_info(frames)")}
+    with connection:
+        for column in ("var_x", "cov_xy", "var_y"):
+            if column not in columns:
+                connection.execute(f"ALTER TABLE frames ADD COLUMN {column} REAL")
+    return connection
+
+
+def is_database(path):
+    """
+    Args:
+        path (str) : log given to an analysis
+
+    Returns:
+        database (bool) : True for a SQLite file, False for a CSV
+    """
+    try:
+        with open(path, "rb") as f:
+            return f.read(16) == b"SQLite format 3\x00"
+    except OSError:
+        return False
+
+
+class PositionStore:
+    """
+    Writes the positions of one session. The positions are buffered and
+    inserted by batches, one transaction each, so a position costs tens of
+    microseconds instead of a commit.
+    """
+
+    def __init__(self, path, name=None, started=None):
+        """
+        Args:
+            path (str) : SQLite file
+            name (str, optional) : session name (ex: the lesson)
+            started (float, optional) : start of the session. Defaults to now
+        """
+        self.connection = connect(path)
+        self._lock = threading.Lock()   # the writer thread of pipeline.py may write
+        self.tag_ids = dict(self.connection.execute("SELECT name, id FROM tags"))
+        self.anchor_ids = dict(self.connection.execute("SELECT name, id FROM anchors"))
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO sessions (name, started) VALUES (?, ?)",
+                (name, time.time() if started is None else started))
+        self.session_id = cursor.lastrowid
+        self.frames = []    # (frame row, ranges) waiting for the next flush
+        # A quiet session still reaches the disk within flush_interval
+        self._closed = threading.Event()
+        threading.Thread(target=self._flush_periodically, daemon=True,
+                         name="store flush").start()
+
+    def _id(self, table, ids, name):
+        """ Id of a tag or anchor name, inserted the first time """
+        if name not in ids:
+            self.connection.execute(f"INSERT OR IGNORE INTO {table} (name) VALUES (?)", (name,))
+            ids[name] = self.connection.execute(
+                f"SELECT id FROM {table} WHERE name = ?", (name,)).fetchone()[0]
+        return ids[name]
+
+    def write(self, position):
+        """
+        Args:
+            position (dict) : result of utils.compute_position
+        """
+        with self._lock:
+            ranges = position["ranges"]
+            covariance = position.get("covariance") or (None, None, None)
+            self.frames.append(((self.session_id, str(position["tag"]), position["time"],
+                                 position["x"], position["y"], len(ranges),
+                                 position["expected_error"], *covariance),
+                                [(str(anchor), distance) for anchor, distance in ranges.items()]))
+            if len(self.frames) >= batch_size:
+                self._flush()
+
+    def flush(self):
+        """ Write the pending positions """
+        with self._lock:
+            self._flush()
+
+    def _flush_periodically(self):
+        while not self._closed.wait(flush_interval):
+            self.flush()
+
+    def _flush(self):
+        if self._closed.is_set() or not self.frames:
+            return
+        tag_ids, anchor_ids = dict(self.tag_ids), dict(self.anchor_ids)
+        try:
+            with self.connection:   # one transaction
+                ranges = []
+                for frame, frame_ranges in self.frames:
+                    # SQLite gives the frame id: other processes (another
+                    # server, replay.py --db) may write the same database
+                    cursor = self.connection.execute(
+                        "INSERT INTO frames (session_id, tag_id, time, x, y, nb_anchors, "
+                        "expected_error, var_x, cov_xy, var_y) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (frame[0], self._id("tags", tag_ids, frame[1]), *frame[2:]))
+                    ranges.extend((cursor.lastrowid, self._id("anchors", anchor_ids, anchor),
+                                   distance) for anchor, distance in frame_ranges)
+                self.connection.executemany("INSERT INTO ranges VALUES (?, ?, ?)", ranges)
+        except sqlite3.Error as e:
+            # Rolled back: the positions are written by the next flush
+            utils.logger.error(f"Cannot write {len(self.frames)} positions in the database: {e}")
+            if len(self.frames) > max_pending:
+                del self.frames[:len(self.frames) - max_pending]
+            return
+        self.tag_ids, self.anchor_ids = tag_ids, anchor_ids
+        self.frames = []
+
+    def close(self, ended=None):
+        """
+        Write the pending positions and the end of the session
+
+        Args:
+            ended (float, optional) : end of the session. Defaults to now
+        """
+        with self._lock:
+            if self._closed.is_set():
+                return
+            self._flush()
+            self._closed.set()
+            with self.connection:
+                self.connection.execute("UPDATE sessions SET ended = ? WHERE id = ?",
+                                        (time.time() if ended is None else ended,
+                                         self.session_id))
+            self.connection.close()
+
+
+def _where(session=None, tag=None, start=None, end=None):
+    """
+    SQL conditions on the frames (alias f), on indexed columns
+
+    Args:
+        session (int or str, optional) : session id or name
+        tag (str, optional) : tag name
+        start (float, optional) : first time kept, in seconds
+        end (float, optional) : last time kept, in seconds
+
+    Returns:
+        where (str), parameters (list)
+    """
+    conditions, parameters = [], []
+    if session is not None:
+        if str(session).isdigit():
+            conditions.append("f.session_id = ?")
+            parameters.append(int(session))
+        else:
+            conditions.append("f.session_id IN (SELECT id FROM sessions WHERE name = ?)")
+            parameters.append(session)
+    if tag is not None:
+        conditions.append("f.tag_id = (SELECT id FROM tags WHERE name = ?)")
+        parameters.append(tag)
+    if start is not None:
+        conditions.append("f.time >= ?")
+        parameters.append(start)
+    if end is not None:
+        conditions.append("f.time <= ?")
+        parameters.append(end)
+    return (" WHERE " + " AND ".join(conditions)) if conditions else "", parameters
+
+
+def parse_time(text):
+    """
+    Args:
+        text (str or None) : local date and time, ex: "2025-12-02 10:15"
+
+    Returns:
+        seconds (float or None) : POSIX time
+    """
+    if text is None:
+        return None
+    return datetime.datetime.fromisoformat(text).timestamp()
+
+
+def load_positions(path, session=None, tag=None, start=None, end=None, covariance=False):
+    """
+    Positions of a session, a tag or a time window, sorted by time
+
+    Args:
+        path (str) : SQLite file
+        session (int or str, optional) : session id or name
+        tag (str, optional) : tag name
+        start (float, optional) : first time kept, in seconds
+        end (float, optional) : last time kept, in seconds
+        covariance (bool, optional) : also return the covariance of the positions
+
+    Returns:
+        xs (list of float), ys (list of float), times (list of float)
+        var_x, cov_xy, var_y (list of float or None) : only with covariance,
+                                            None for the positions without one
+    """
+    where, parameters = _where(session, tag, start, end)
+    columns = "f.x, f.y, f.time" + (", f.var_x, f.cov_xy, f.var_y" if covariance else "")
+    connection = sqlite3.connect(path)
+    try:
+        rows = connection.execute(
+            f"SELECT {columns} FROM frames f{where} ORDER BY f.time, f.id",
+            parameters).fetchall()
+    finally:
+        connection.close()
+    nb_columns = 6 if covariance else 3
+    if not rows:
+        return ([],) * nb_columns
+    return tuple(list(column) for column in zip(*rows))
+
+
+def tag_counts(path, session=None, start=None, end=None):
+    """
+    Args:
+        path (str) : SQLite file
+        session, start, end : same filters as load_positions
+
+    Returns:
+        counts (dictionary{k: tag name, v: int}) : positions of each tag in
+                                                   the selection
+    """
+    where, parameters = _where(session, None, start, end)
+    connection = sqlite3.connect(path)
+    try:
+        return dict(connection.execute(
+            f"SELECT t.name, COUNT(*) FROM frames f JOIN tags t ON t.id = f.tag_id{where} "
+            "GROUP BY f.tag_id", parameters).fetchall())
+    finally:
+        connection.close()
+
+
+def used_anchors(path, session=None, tag=None, start=None, end=None):
+    """
+    Args:
+        path (str) : SQLite file
+        session, tag, start, end : same filters as load_positions
+
+    Returns:
+        anchors (set of str) : anchors that have a range in the selection
+    """
+    where, parameters = _where(session, tag, start, end)
+    connection = sqlite3.connect(path)
+    try:
+        if not where:
+            rows = connection.execute(
+                "SELECT name FROM anchors WHERE id IN (SELECT DISTINCT anchor_id FROM ranges)")
+        else:
+            rows = connection.execute(
+                "SELECT DISTINCT a.name FROM frames f JOIN ranges r ON r.frame_id = f.id "
+                f"JOIN anchors a ON a.id = r.anchor_id{where}", parameters)
+        return {name for (name,) in rows}
+    finally:
+        connection.close()
+
+
+def read_range_chunks(path, session=None, tag=None, anchor=None, start=None, end=None):
+    """
+    Stream the ranges of a selection, like meanRange.read_chunks on a CSV
+
+    Args:
+        path (str) : SQLite file
+        session, tag, start, end : same filters as load_positions
+        anchor (str, optional) : anchor name
+
+    Yields:
+        chunk (dictionary{k: anchor id, v: list of float}) : ranges of each
+                                                anchor in the next chunk_size rows
+    """
+    where, parameters = _where(session, tag, start, end)
+    query = "SELECT a.name, r.distance FROM ranges r JOIN anchors a ON a.id = r.anchor_id"
+    if where:   # the frames are only read when filtered on
+        query += " JOIN frames f ON f.id = r.frame_id"
+    if anchor is not None:
+        where += (" AND " if where else " WHERE ") + "a.name = ?"
+        parameters.append(anchor)
+    connection = sqlite3.connect(path)
+    try:
+        cursor = connection.execute(query + where, parameters)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            chunk = {}
+            for name, distance in rows:
+                chunk.setdefault(name, []).append(distance)
+            yield chunk
+    finally:
+        connection.close()
+
+
+def sessions(path):
+    """
+    Args:
+        path (str) : SQLite file
+
+    Returns:
+        sessions (list of tuple(id, name, started, ended, nb_frames))
+    """
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute(
+            "SELECT s.id, s.name, s.started, s.ended, "
+            "(SELECT COUNT(*) FROM frames f WHERE f.session_id = s.id) "
+            "FROM sessions s ORDER BY s.id").fetchall()
+    finally:
+        connection.close()
+
+
+def import_csv(path, db):
+    """
+    Import a positions CSV as a new session named after the file
+
+    Args:
+        path (str) : CSV log
+        db (str) : SQLite file
+
+    Returns:
+        nb_positions (int)
+    """
+    positions = []
+    with open_log(path) as file:
+        for row in utils.read_log(file):
+            try:
+                x = float(row.get("x_transformed") or row.get("pos_x"))
+                y = float(row.get("y_transformed") or row.get("pos_y"))
+                t = datetime.datetime.fromisoformat(row["Timestamp"]).timestamp()
+            except (TypeError, ValueError, KeyError):
+                continue  # skip invalid rows
+            ranges = {}
+            for i in range(1, 5):
+                try:
+                    ranges[row[f"id_{i}"]] = float(row[f"d{i}"])
+                except (KeyError, TypeError, ValueError):
+                    continue
+            ranges.pop("", None)
+            error = row.get("expected_error")
+            try:
+                covariance = tuple(float(row[c]) for c in ("var_x", "cov_xy", "var_y"))
+            except (KeyError, TypeError, ValueError):
+                covariance = None
+            positions.append({
+                "tag": row.get("Tag") or os.path.basename(path).split(".")[0],
+                "time": t, "ranges": ranges, "x": x, "y": y,
+                "covariance": covariance,
+                "expected_error": float(error) if error else None,
+            })
+
+    name = os.path.basename(path).split(".")[0]
+    position_store = PositionStore(db, name, positions[0]["time"] if positions else None)
+    for position in positions:
+        position_store.write(position)
+    position_store.close(positions[-1]["time"] if positions else None)
+    return len(positions)
+
+
+def main():
+    parser = build_arg_parser()
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO) # To see the results
+
+    for path in args.csv:
+        if not os.path.exists(path):
+            logging.error(f"File {path} does not exist.")
+            continue
+        nb_positions = import_csv(path, args.db)
+        logging.info(f"{path}: {nb_positions} positions imported")
+
+    if not os.path.exists(args.db):
+        logging.error(f"No database {args.db}")
+        return
+    logging.info("Sessions:")
+    for session_id, name, started, ended, nb_frames in sessions(args.db):
+        start = datetime.datetime.fromtimestamp(started).strftime("%Y-%m-%d %H:%M")
+        duration = f"{(ended - started) / 60:.0f} min" if ended else "running"
+        logging.info(f"  {session_id}: {name or ''} {start}, {duration}, {nb_frames} positions")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import numpy as np
+
+# Ranges are sent with 3 decimals (mm) and validated under 15 m by the
+# server, so a mm histogram is exact for them and has a fixed size
+histogram_resolution = 0.001    # m
+histogram_max = 15.0            # m, bigger values go in the last bin
+
+
+class RunningStats:
+    """
+    Count, mean, variance, min and max of a stream of values in O(1) memory.
+    Batches are added with Chan's formula (Welford generalized), and two
+    RunningStats merge exactly, so shards can be computed in parallel.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0   # sum of squared differences to the mean
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        """
+        Add a batch of values
+
+        Args:
+            values (numpy.ndarray) : new values
+        """
+        if len(values) == 0:
+            return
+        other = RunningStats()
+        other.count = len(values)
+        other.mean = float(np.mean(values))
+        other.m2 = float(np.sum((values - other.mean) ** 2))
+        other.min = float(np.min(values))
+        other.max = float(np.max(values))
+        self.merge(other)
+
+    def add(self, value):
+        """
+        Add one value (Welford)
+
+        Args:
+            value (float) : new value
+        """
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        """
+        Add the values of another RunningStats
+
+        Args:
+            other (RunningStats) : stats of another shard
+        """
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count else 0.0
+
+    @property
+    def std(self):
+        return self.variance ** 0.5
+
+
+class RangeHistogram:
+    """
+    Fixed resolution histogram of ranges. Constant memory, exact percentiles
+    at the resolution and merged by adding the counts.
+    """
+
+    def __init__(self, resolution=histogram_resolution, max_value=histogram_max):
+        self.resolution = resolution
+        self.counts = np.zeros(int(round(max_value / resolution)) + 1, dtype=np.int64)
+
+    def update(self, values):
+        """
+        Add a batch of values
+
+        Args:
+            values (numpy.ndarray) : new values
+        """
+        bins = np.clip(np.rint(values / self.resolution), 0, len(self.counts) - 1)
+        self.counts += np.bincount(bins.astype(np.intp), minlength=len(self.counts))
+
+    def merge(self, other):
+        """
+        Args:
+            other (RangeHistogram) : histogram of another shard (same resolution)
+        """
+        self.counts += other.counts
+
+    def percentile(self, q):
+        """
+        Args:
+            q (float) : percentile between 0 and 100
+
+        Returns:
+            value (float) : value under which q% of the values are (NaN if empty)
+        """
+        total = self.counts.sum()
+        if total == 0:
+            return float("nan")
+        cumulative = np.cumsum(self.counts)
+        index = np.searchsorted(cumulative, q / 100.0 * total)
+        return float(min(index, len(self.counts) - 1) * self.resolution)
+
+    def coarse(self, bin_width):
+        """
+        Histogram with bigger bins, for display
+
+        Args:
+            bin_width (float) : width of the bins in meters
+
+        Returns:
+            edges (numpy.ndarray) : left edge of each non empty bin
+            counts (numpy.ndarray) : number of values in each of those bins
+        """
+        factor = max(1, int(round(bin_width / self.resolution)))
+        padded = np.pad(self.counts, (0, -len(self.counts) % factor))
+        counts = padded.reshape(-1, factor).sum(axis=1)
+        edges = np.arange(len(counts)) * factor * self.resolution
+        used = np.nonzero(counts)[0]
+        if len(used) == 0:
+            return edges[:0], counts[:0]
+        span = slice(used[0], used[-1] + 1)
+        return edges[span], counts[span]
+
+
+class AnchorStats:
+    """
+    Running stats and histogram of the ranges of one anchor
+    """
+
+    def __init__(self):
+        self.stats = RunningStats()
+        self.histogram = RangeHistogram()
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        self.stats.update(values)
+        self.histogram.update(values)
+
+    def merge(self, other):
+        self.stats.merge(other.stats)
+        self.histogram.merge(other.histogram)
+
+
+def merge_anchor_stats(shards):
+    """
+    Merge the per anchor stats of several shards
+
+    Args:
+        shards (list of dictionary{k: anchor id, v: AnchorStats})
+
+    Returns:
+        merged (dictionary{k: anchor id, v: AnchorStats})
+    """
+    merged = {}
+    for shard in shards:
+        for anchor_id, anchor_stats in shard.items():
+            if anchor_id in merged:
+                merged[anchor_id].merge(anchor_stats)
+            else:
+                merged[anchor_id] = anchor_stats
+    return merged
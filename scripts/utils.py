@@ -1,30 +1,79 @@
 import csv
 import datetime
+import itertools
 import json
 import logging
 import os
-import re
 import socket
 import sys
+import time
 
-import matplotlib.pyplot as plt
 import numpy as np
-from scipy.optimize import minimize
-import turtle
 
-from zeroconf import ServiceInfo, Zeroconf
+import capture
+import liveness
+import protocol
+from session import ResumeCache, TagSession
+
+# matplotlib, scipy and zeroconf are imported where they are used: the server
+# only needs numpy at startup and must run headless (no Tk, no plotting)
 
 TCP_IP = "0.0.0.0" # Accepts everything
 TCP_PORT = 5000
 
-meter2pixel = 50   # Ususally always fit in the window (real-time only)
-                    # Decrease this number if the anchors are at more than 3-4 meters apart
-
 filename = "../logs/positions.csv" # Will always write in this file
 
+# Columns of the CSV, in the order write_position writes them. The server
+# doesn't write the header row (clear_file isn't called on start)
+log_columns = [
+    "Nb Anchors", "id_1", "id_2", "id_3", "id_4", "d1", "d2", "d3",
+    "d4", "pos_x", "pos_y", "Timestamp", "expected_error", "Tag",
+    "var_x", "cov_xy", "var_y"
+]
+
 # Put this value to 2 if doing the antennas calibration
 minimum_anchors_for_position = 3    # maximum precision
 
+# Reject outliers per anchor before solving (see range_filter.py)
+use_range_filter = True
+
+# Standard deviation of one range (chip incertitude), the smallest error
+# assumed for the ranges when estimating the covariance of a position
+range_sigma = 0.1   # m
+
+# Expected error of each position, set by the server (see gdop.py)
+precision_map = None
+low_confidence_error = 0.5  # m, positions with a larger expected error are flagged
+
+# Folder where the raw stream of each connection is recorded, set by the
+# server --capture (see capture.py and replay.py)
+capture_dir = None
+
+# SQLite storage of the positions, set by the server --storage (see store.py)
+store = None
+write_csv = True
+
+# NLOS classifier and weights of the ranges from their powers, set by the
+# server (see nlos.py). None: every range weighs the same
+range_model = None
+
+# Ring of the live positions in shared memory for the local readers, set by
+# the server --shm (see live_ring.py)
+live_ring = None
+
+# Streaming health of the anchors, set by the server (see anchor_health.py)
+anchor_monitor = None
+
+# Configs of every room, set by the server --rooms (see rooms.py). The room
+# of each Tag is then chosen from its ranges instead of using anchors
+rooms = None
+
+# Sessions of the Tags and their capture files, kept a while after their
+# connection is lost: a Tag that reconnects resumes them (see session.py)
+sessions = ResumeCache(lambda tag_id: TagSession(tag_id, session_anchor_ids()))
+recorders = ResumeCache(lambda ip, addr: capture.CaptureWriter(capture_dir, addr),
+                        "Capture", on_expire=lambda recorder: recorder.close())
+
 # Small padding for the calibration in post-process
 img_padding = 25
 no_image_padding = 1
@@ -60,92 +109,241 @@ def load_anchors(config_path="../config.json"):
     return anchors
 
 
+def session_anchor_ids():
+    """
+    Returns:
+        ids (list of str) : anchors a TagSession can receive, those of every
+                            room with rooms
+    """
+    return rooms.anchor_ids() if rooms is not None else list(anchors)
+
+
 def on_exit():
-    """ Close all matplotlib plots on exit """
-    plt.close('all')
+    """ Close all matplotlib plots on exit (only if matplotlib was used) """
+    plt = sys.modules.get("matplotlib.pyplot")
+    if plt is not None:
+        plt.close('all')
 
 
-def main_loop(sock, display = False):
+def main_loop(sock, live_state=None):
     """
     Main loop handling TCP data reception, position computing and CSV writing
 
     Args:
         sock (socket.socket instance): Listening socke, accepts connections
-        display (bool) : if True, will display a turtle window with real-time
-                         position and Anchors. Default to False
+        live_state (LiveState, optional) : if given, every computed position is
+                         published in it for the live views. Defaults to None
     """
     logger.info(f"Waiting for connection on port {TCP_PORT}")
     conn, addr = sock.accept()
-    conn.settimeout(800.0)    # Probably lost Tag connection
+    liveness.set_keepalive(conn)
+    # Short timeout: the heartbeats of the Tag are checked between 2 reads
+    conn.settimeout(liveness.poll_interval)
     logger.info(f"Connection accepted from {addr}")
 
-    if display:
-        global t_anchors, t_tag
-    buffer = ""  # reset buffer per connection
+    decoder = protocol.StreamDecoder()
+    alive = liveness.Liveness(addr)
+    recorder = recorders.get(addr[0], addr) if capture_dir else None
+    session = None
+    tag_sessions = {}   # tag id -> session, the tags of this connection
 
     try:
         while True:
-            anchors_list, buffer = read_data(conn, buffer)
-            ranges = {}
-
-            if display:
-                clean(t_anchors)
-
-            for anchor in anchors_list:
-                if anchor["A"] in anchors:
-                    anchor_range = float(anchor["R"])
-                    if anchor_range > 0.0 and anchor_range < 15.0: # Basic validation
-                        ranges[anchor["A"]] = anchor_range
-                    if display:
-                        ax, ay, az = anchors[anchor["A"]]
-                        pos_x = -250 + ax * meter2pixel # constants to fit in turtle window
-                        pos_y = 150 - ay * meter2pixel
-                        draw_uwb_anchor(pos_x, pos_y, anchor["A"], t_anchors)
-
-            anchor_ids = sorted(ranges.keys())[:4]
-            distances = [ranges[a] for a in anchor_ids]
-
-            while len(anchor_ids) < 4:
-                anchor_ids.append(None)
-            while len(distances) < 4:
-                distances.append(None)
-
-            if len(ranges) >= minimum_anchors_for_position:
-                x = 0.0 # For 1 anchor calculation
-                y = 0.0
-
-                if len(ranges) > 1: # Cannot find pos with 1 anchor
-                    x, y = tag_pos(ranges, anchors)
-
-                if x == -1 or y == -1:
+            try:
+                frames, recv_time = read_data(conn, decoder, recorder)
+            except socket.timeout as e:
+                if e.errno is None and not alive.stale():
                     continue
-
-                with open(filename, "a", newline="") as file:
-                    writer = csv.writer(file)
-                    writer.writerow([
-                        len(ranges),
-                        *anchor_ids,
-                        *distances,
-                        x, y, datetime.datetime.now()
-                    ])
-                if display:
-                    clean(t_tag)
-                    draw_uwb_tag(x, y, "TAG", t_tag)
+                raise
+            alive.received(frames)
+            for frame in frames:
+                # Old firmwares (JSON) don't send their id
+                tag_id = f"{frame.tag:X}" if frame.tag is not None else addr[0]
+                if session is None or session.tag_id != tag_id:
+                    session = tag_sessions.get(tag_id)
+                    if session is None:
+                        session = tag_sessions[tag_id] = sessions.get(tag_id)
+                process_frame(frame, session, recv_time, live_state)
 
     except (ConnectionResetError, BrokenPipeError):
         logger.warning(f"Connection lost from {addr}, waiting for new device...")
         conn.close()
         pass # to try again
-    except socket.timeout:
+    except OSError:     # socket.timeout, or TCP keepalive without answer
         conn.close()
-        logger.warning("Lost connection to the Tag")
+        logger.warning(f"Lost connection to the Tag {addr[0]} (silent for " \
+                       f"more than {alive.timeout} s)")
         pass # to try again
     except KeyboardInterrupt:
         on_exit()
         conn.close()
         raise KeyboardInterrupt
+    finally:
+        if recorder is not None:
+            recorder.flush()
+            recorders.release(addr[0])
+        for tag_id in tag_sessions:
+            sessions.release(tag_id)
+            if live_ring is not None:
+                live_ring.remove(tag_id)
+            if live_state is not None:
+                live_state.remove(tag_id)
     
 
+def process_frame(frame, session, recv_time, live_state=None):
+    """
+    Compute the positions of one frame and write them in the CSV file.
+    A raw samples frame gives one position per sample, in time order.
+
+    Args:
+        frame (protocol.Frame) : frame received from the Tag
+        session (TagSession) : state of the tag that sent the frame
+        recv_time (float) : time.time() when the frame was received
+        live_state (LiveState, optional) : if given, the positions are published
+                                           in it for the live views
+    """
+    for position in compute_frame(frame, session, recv_time):
+        write_position(position, live_state)
+
+
+def compute_frame(frame, session, recv_time):
+    """
+    Positions of one frame, without writing them (see pipeline.py)
+
+    Args:
+        frame (protocol.Frame) : frame received from the Tag
+        session (TagSession) : state of the tag that sent the frame
+        recv_time (float) : time.time() when the frame was received
+
+    Returns:
+        positions (list of dict) : see compute_position, in time order
+    """
+    positions = []
+    for timestamp, raw_ranges, powers in session.measurements(frame, recv_time,
+                                                              use_range_filter):
+        position = compute_position(raw_ranges, session, timestamp, powers)
+        if position is not None:
+            positions.append(position)
+    return positions
+
+
+def compute_position(raw_ranges, session, timestamp, powers=None):
+    """
+    Compute the position from a set of ranges
+
+    Args:
+        raw_ranges (dictionary{k: anchor id, v: distance float}) : ranges received,
+                    already through the range filter (see TagSession.measurements)
+        session (TagSession) : state of the tag that measured the ranges
+        timestamp (float) : time of the measure (time.time() format)
+        powers (dictionary{k: anchor id, v: tuple(rx dBm, first path dBm)},
+                optional) : powers of the ranges, they weigh the ranges with
+                            range_model
+
+    Returns:
+        position (dict or None) : tag, time, ranges used, x, y, covariance,
+                                  expected error, room (with rooms) and RX
+                                  power, None if no position can be computed
+    """
+    room_anchors, room_precision, room = anchors, precision_map, None
+    if rooms is not None:
+        room = rooms.room_for(session, raw_ranges)
+        if room is not None:
+            room_anchors, room_precision = room.anchors, room.precision_map
+
+    ranges = {}
+
+    for anchor_id, anchor_range in raw_ranges.items():
+        if anchor_id in room_anchors:
+            if anchor_range > 0.0 and anchor_range < 15.0: # Basic validation
+                ranges[anchor_id] = anchor_range
+
+    if len(ranges) < minimum_anchors_for_position:
+        return None
+
+    x = 0.0 # For 1 anchor calculation
+    y = 0.0
+    covariance = None
+
+    variances = None
+    if range_model is not None and powers:
+        variances = range_model.variances(ranges, powers)
+
+    if len(ranges) > 1: # Cannot find pos with 1 anchor
+        x, y, covariance = tag_pos(ranges, room_anchors, variances)
+
+    if x == -1 or y == -1:
+        return None
+
+    expected_error = None
+    if room_precision is not None:
+        expected_error = room_precision.expected_error(ranges.keys(), x, y)
+        if expected_error is not None and expected_error > low_confidence_error:
+            logger.debug(f"Low confidence position ({x}, {y}): "
+                         f"expected error {expected_error:.2f} m")
+
+    return {
+        "tag": session.tag_id,
+        "time": timestamp,
+        "ranges": ranges,
+        "x": x,
+        "y": y,
+        "covariance": covariance,
+        "expected_error": expected_error,
+        "room": None if room is None else room.name,
+        "rx_power": {a: p[0] for a, p in powers.items()} if powers else None,
+    }
+
+
+def write_position(position, live_state=None):
+    """
+    Write a position in the CSV file and/or the SQLite storage
+
+    Args:
+        position (dict) : result of compute_position
+        live_state (LiveState, optional) : if given, the position is published
+                                           in it for the live views
+    """
+    ranges = position["ranges"]
+    anchor_ids = sorted(ranges.keys())[:4]
+    distances = [ranges[a] for a in anchor_ids]
+
+    while len(anchor_ids) < 4:
+        anchor_ids.append(None)
+    while len(distances) < 4:
+        distances.append(None)
+
+    expected_error = position["expected_error"]
+    covariance = position.get("covariance") or ("", "", "")
+    if write_csv:
+        with open(filename, "a", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow([
+                len(ranges),
+                *anchor_ids,
+                *distances,
+                position["x"], position["y"],
+                datetime.datetime.fromtimestamp(position["time"]),
+                "" if expected_error is None else round(expected_error, 3),
+                position["tag"],
+                *covariance
+            ])
+    if store is not None:
+        store.write(position)
+    monitor = anchor_monitor
+    if rooms is not None and position.get("room") is not None:
+        room = rooms.get(position["room"])
+        monitor = None if room is None else room.monitor
+    if monitor is not None:
+        monitor.update(ranges, position["x"], position["y"], position["time"],
+                       position.get("rx_power"))
+    if live_ring is not None:
+        live_ring.publish(position)
+    if live_state is not None:
+        live_state.publish(position["tag"], position["x"], position["y"],
+                           ranges, position["time"], position.get("covariance"))
+
+
 def setup_logging(level = logging.WARNING):
     """
     Make the logger prints in the console during runtime
@@ -162,16 +360,20 @@ def setup_logging(level = logging.WARNING):
     logger.addHandler(console_handler)
 
 
-def tag_pos(ranges, anchors):
+def tag_pos(ranges, anchors, variances=None):
     """
     Compute tag position based on distances to known anchors
 
     Args:
         ranges (dictionary{k: anchor id, v: distance float}): Distances with ids
         anchors (dictionary{key: anchor id, value: tuple(x, y, z)}) : anchors positions with ids
+        variances (dictionary{k: anchor id, v: float}, optional) : variance of
+                    each range (see nlos.RangeModel), the least squares are
+                    then weighted by their inverse. Defaults to equal weights
 
     Returns:
         floats x and y with 3 decimals
+        covariance (tuple(var_x, cov_xy, var_y) or None) : see position_covariance
     """
     keys = [k for k in ranges if k in anchors]
     anchor_coords = np.array([anchors[k] for k in keys])
@@ -188,17 +390,85 @@ def tag_pos(ranges, anchors):
         # Third distance for trilateration
         c = np.linalg.norm(right_anchor - left_anchor)
 
-        return tag_pos_2_anchors(right_dist, left_dist, c)
+        x, y = tag_pos_2_anchors(right_dist, left_dist, c)
+        if x == -1 or y == -1:
+            return x, y, None
+        # In the frame of tag_pos_2_anchors: left anchor at (0, 0), right at (c, 0)
+        covariance = position_covariance(np.array([[0.0, 0.0], [c, 0.0]]),
+                                          np.array([left_dist, right_dist]), np.array([x, y]))
+        return x, y, covariance
+
+    from scipy.optimize import minimize # Loaded at the first solve only
+
+    if variances is None:
+        def error(pos):
+            est = np.sqrt(((anchor_coords - pos) ** 2).sum(axis=1))
+            return np.sum((est - dists) ** 2)
+    else:
+        inverse = 1.0 / np.array([variances[k] for k in keys])
+        weights = inverse / inverse.mean()  # same scale as the unweighted solve
 
-    def error(pos):
-        est = np.sqrt(((anchor_coords - pos) ** 2).sum(axis=1))
-        return np.sum((est - dists) ** 2)
+        def error(pos):
+            est = np.sqrt(((anchor_coords - pos) ** 2).sum(axis=1))
+            return np.sum(weights * (est - dists) ** 2)
 
     # Initial guess = centroid of all the anchors 
     # TODO: For optimization we could keep the last position and use it as the
     # initial guess because its faster if we start near the solution 
     result = minimize(error, x0=np.mean(anchor_coords, axis=0))
-    return round(float(result.x[0]), 3), round(float(result.x[1]),3)
+    # One Jacobian at the solution, negligible next to the solve
+    covariance = position_covariance(anchor_coords, dists, result.x,
+                                     variances=None if variances is None else 1.0 / inverse)
+    return round(float(result.x[0]), 3), round(float(result.x[1]),3), covariance
+
+
+def position_covariance(anchor_coords, dists, position, sigma=None, variances=None):
+    """
+    Covariance of a position, sigma^2 (J^T J)^-1 with J the Jacobian of the
+    ranges at the solution (unit vectors from the anchors to the tag). With
+    more than 2 ranges, the residuals also estimate sigma and the larger
+    estimate is kept, so noisy ranges give a larger covariance.
+
+    Args:
+        anchor_coords (numpy.ndarray) : shape (n, 2) or (n, 3) anchors used
+        dists (numpy.ndarray) : shape (n,) measured ranges
+        position (numpy.ndarray) : solution, same dimension as the anchors
+        sigma (float, optional) : standard deviation of one range. Defaults
+                                  to range_sigma
+        variances (numpy.ndarray, optional) : shape (n,) variance of each
+                    range, (J^T W J)^-1 with W their inverse is then used
+
+    Returns:
+        covariance (tuple(var_x, cov_xy, var_y) or None) : in m^2, None if the
+                                    geometry does not fix the position
+    """
+    if sigma is None:
+        sigma = range_sigma
+    delta = position - anchor_coords
+    est = np.sqrt((delta ** 2).sum(axis=1))
+    if np.any(est < 1e-9):
+        return None
+    jx, jy = delta[:, 0] / est, delta[:, 1] / est
+    a, b, c = jx @ jx, jx @ jy, jy @ jy
+    det = a * c - b * b
+    if det < 1e-9:  # all the anchors in line with the tag
+        return None
+
+    if variances is not None:
+        # Weighted: the residuals only scale the covariance up, in units of
+        # the variances given
+        w = 1.0 / np.asarray(variances, dtype=float)
+        a, b, c = (w * jx) @ jx, (w * jx) @ jy, (w * jy) @ jy
+        det = a * c - b * b
+        variance = 1.0
+        if len(dists) > 2:
+            variance = max(variance, float((w * (est - dists) ** 2).sum()) / (len(dists) - 2))
+    else:
+        variance = sigma ** 2
+        if len(dists) > 2:
+            variance = max(variance, float(((est - dists) ** 2).sum()) / (len(dists) - 2))
+    return (round(float(variance * c / det), 6), round(float(-variance * b / det), 6),
+            round(float(variance * a / det), 6))
 
 
 def tag_pos_2_anchors(a, b, c):
@@ -254,6 +524,7 @@ def connect_wifi():
     Returns:
         sock (socket.socket instance): Listening socke, accepts connections
     """
+    from zeroconf import ServiceInfo, Zeroconf
 
     hostname = socket.gethostname()
     local_ip = socket.gethostbyname(hostname)
@@ -279,55 +550,28 @@ def connect_wifi():
     return sock
 
 
-def read_data(conn, buffer):
+def read_data(conn, decoder, recorder=None):
     """
-    Read and parse incoming JSON UWB data from the socket
+    Read and decode incoming UWB data from the socket (binary frames or JSON)
 
     Args:
         conn (socket.socket) : connection, we can use it for sending or
                                receiving data
-        buffer (str) : accumulated received data
+        decoder (protocol.StreamDecoder) : keeps the incomplete data between
+                                           2 calls
+        recorder (capture.CaptureWriter, optional) : records the raw data
 
     Returns:
-        uwb_list (list of dictionaries) : each dictionary is an anchor with its
-                                          id and its range measured
-        buffer (str) : cleaned version of the accumulated received data
+        frames (list of protocol.Frame) : complete frames received, in order
+        recv_time (float) : time.time() when the data was received
     """
-    try:
-        chunk = conn.recv(1024).decode("utf-8")
-        buffer += chunk
-
-        uwb_list = []
-
-        # Use regex to extract complete JSON objects
-        pattern = r'\{"links":\s*\[.*?\]\}'
-
-        matches = re.findall(pattern, buffer)
-
-        if not matches:
-            return uwb_list  # nothing complete yet
-
-        # Keep only the last complete JSON object
-        last_json = matches[-1]
-
-        # Remove everything up to after the last complete JSON
-        last_index = buffer.rfind(last_json) + len(last_json)
-        buffer = buffer[last_index:]
-
-        # Parse it
-        uwb_data = json.loads(last_json)
-        uwb_list = uwb_data.get("links", []) # [] is default return if != links
-
-        return uwb_list, buffer
-
-    except json.JSONDecodeError as e:
-        logger.error("EXCEPTION!", e, last_json if 'last_json' in locals() else buffer)
-        return [], buffer
-    except socket.timeout:
-        raise socket.timeout
-    except Exception as e:
-        logger.error("EXCEPTION!", e)
-        return [], buffer
+    chunk = conn.recv(4096)
+    recv_time = time.time()
+    if not chunk:
+        raise ConnectionResetError("Connection closed by the Tag")
+    if recorder is not None:
+        recorder.write(chunk, recv_time)
+    return decoder.feed(chunk), recv_time
 
 
 def clear_file():
@@ -337,88 +581,69 @@ def clear_file():
     logger.debug("CSV file cleared")
     with open(filename, "w", newline="") as file:
         writer = csv.writer(file)
-        writer.writerow([
-            "Nb Anchors", "id_1", "id_2", "id_3", "id_4", "d1", "d2", "d3",
-            "d4", "pos_x", "pos_y", "Timestamp"            
-        ])
-
+        writer.writerow(log_columns)
 
-# All the functions under this point are functions to display the turtle window in real-time only
-# They are functions directly taken from the Makerfabs showcase code for the Tag and Anchors
-# https://github.com/Makerfabs/Makerfabs-ESP32-UWB/blob/main/example/IndoorPositioning/uwb_position_display.py
 
-def screen_init():
+def log_header(row):
     """
-    Initialize the turtle-based UI 
-    """
-    screen = turtle.Screen()
-    screen.setup(1200, 800)
-    screen.tracer(True)
-
-    global t_anchors, t_tag
-
-    t_anchors = turtle.Turtle()
-    t_tag = turtle.Turtle()
-    turtle_init(t_anchors)
-    turtle_init(t_tag)
-
-
-def turtle_init(t=turtle):
-    """
-    Initialize a turtle object
-    """
-    t.hideturtle()
-    t.speed(0)
-
-
-def fill_cycle(x, y, r, color="black", t=turtle):
-    """
-    Draw a filled circle on the screen
-    """
-    t.up()
-    t.goto(x, y)
-    t.down()
-    t.dot(r, color)
-    t.up()
+    Columns of a positions CSV, from its first row
 
+    Args:
+        row (list of str) : first row of the CSV
 
-def write_txt(x, y, txt, color="black", t=turtle, f=('Arial', 12, 'normal')):
-    """
-    Write text at a given position
+    Returns:
+        columns (list of str) : name of each column, log_columns if the CSV
+                                has no header row
+        is_header (bool) : the row is the header, not a position
     """
+    if "Timestamp" in row:
+        return row, True
+    return log_columns, False
 
-    t.pencolor(color)
-    t.up()
-    t.goto(x, y)
-    t.down()
-    t.write(txt, move=False, align='left', font=f)
-    t.up()
 
-
-def clean(t=turtle):
-    """
-    Clear a turtle layer
+def log_times(texts):
     """
-    t.clear()
+    Parse the Timestamp column of a log, all at once when every row is
+    valid (much faster than strptime on each row), else row by row
 
+    Args:
+        texts (list of str) : timestamps, ex: "2025-12-02 10:15:03.125000"
 
-def draw_uwb_anchor(x, y, txt, t):
+    Returns:
+        times (numpy.ndarray) : time in seconds, NaN for an invalid timestamp
+                                (ex: the last row, still being written)
     """
-    Draw a UWB anchor point
+    try:
+        parsed = np.array(texts, dtype="datetime64[us]")
+    except ValueError:
+        parsed = np.empty(len(texts), dtype="datetime64[us]")
+        for i, text in enumerate(texts):
+            try:
+                parsed[i] = np.datetime64(text.strip(), "us")
+            except ValueError:
+                parsed[i] = np.datetime64("NaT")
+    times = parsed.astype(np.int64) / 1e6
+    times[np.isnat(parsed)] = np.nan
+    return times
+
+
+def read_log(file):
     """
-    r = 20
-    fill_cycle(x, y, r, "green", t)
-    write_txt(x + r, y, txt,
-              "black",  t, f=('Arial', 16, 'normal'))
+    Rows of a positions CSV, like csv.DictReader but also for the CSV the
+    server writes, which has no header row
 
+    Args:
+        file (text file object) : open CSV (see meanRange.open_log)
 
-def draw_uwb_tag(x, y, txt, t):
-    """
-    Draw the tag position
+    Yields:
+        row (dictionary{k: column, v: str}) : missing columns are None
     """
-    pos_x = -250 + int(x * meter2pixel)
-    pos_y = 150 - int(y * meter2pixel)
-    r = 20
-    fill_cycle(pos_x, pos_y, r, "blue", t)
-    write_txt(pos_x, pos_y, txt + ": (" + str(x) + "," + str(y) + ")",
-              "black",  t, f=('Arial', 16, 'normal'))
+    reader = csv.reader(file)
+    first = next(reader, None)
+    if first is None:
+        return
+    columns, is_header = log_header(first)
+    if not is_header:
+        yield dict(itertools.zip_longest(columns, first[:len(columns)]))
+    for row in reader:
+        yield dict(itertools.zip_longest(columns, row[:len(columns)]))
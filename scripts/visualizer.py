@@ -1,6 +1,5 @@
 import argparse
-import csv
-from datetime import datetime
+from datetime import datetime, timezone
 import json
 import logging
 import os
@@ -9,6 +8,7 @@ import subprocess
 import matplotlib.image as mpimg
 import matplotlib.cm as cm
 import matplotlib.pyplot as plt
+from matplotlib.collections import EllipseCollection
 from matplotlib.patches import Ellipse
 from matplotlib.widgets import Slider, Button                  
 
@@ -16,6 +16,11 @@ import numpy as np
 from scipy.ndimage import uniform_filter1d
 from scipy.stats import norm
 
+import gdop
+import live_state
+import lod
+import log_tail
+import store
 import utils
 
 # Heatmap
@@ -43,10 +48,31 @@ def build_arg_parser():
                    help='Displays the precision of the entire log')
     p.add_argument('--trail', type=int, default=10,
                     help='Number of previous points to show (e.g. --trail 25)')
+    p.add_argument('--path', action='store_true',
+                   help='Draws the whole path up to the current frame, ' \
+                        'simplified to the zoom so long sessions stay smooth')
+    p.add_argument('--gdop', action='store_true',
+                   help='Overlays the expected position error of the anchors ' \
+                        'geometry (see gdop.py)')
+    p.add_argument('--uncertainty', action='store_true',
+                   help='Draws the 2 sigma ellipse of the current and past ' \
+                        'positions, from the covariance given by the solver')
     p.add_argument('--max_time_diff', type=float, default=0.2,
                     help='Maximum amount of time in seconds between 2 positions')
     p.add_argument('--csv', type=str, default="../logs/positions.csv",
-                    help='CSV file we want to read from')
+                    help='CSV file we want to read from, or SQLite storage (see store.py)')
+    p.add_argument('--session', type=str,
+                    help='SQLite only: id or name of the session displayed')
+    p.add_argument('--tag', type=str,
+                    help='Tag displayed, defaults to the tag with the most positions')
+    p.add_argument('--start', type=str,
+                    help='SQLite only: first time displayed, ex: "2025-12-02 10:15"')
+    p.add_argument('--end', type=str,
+                    help='SQLite only: last time displayed')
+    p.add_argument('--follow', action='store_true',
+                   help='Follows the CSV while the server writes it, like tail -f')
+    p.add_argument('--refresh', type=float, default=0.5,
+                    help='Seconds between 2 reads of the CSV with --follow')
     p.add_argument('--calibration', action='store_true',
                    help='Calibrate a certain CSV and PNG for visualization' \
                         'You need to save the results to visualize it !!!' \
@@ -57,12 +83,78 @@ def build_arg_parser():
     return p
 
 
-def get_positions(csv_filename):
+def db_filters(args):
     """
-    Reads x, y, and timestamp data from the CSV file.
+    Selection asked on the command line, applied by SQLite
+
+    Args:
+        args (argparse.Namespace) : All command line args are accessible from it
+
+    Returns:
+        filters (dict) : session, tag, start and end for the store loaders
+    """
+    return {"session": args.session, "tag": args.tag,
+            "start": store.parse_time(args.start), "end": store.parse_time(args.end)}
+
+
+def select_tag(csv_filename, filters):
+    """
+    Tag displayed when none is asked: the trajectories of several tags
+    can't be drawn as one, so the tag with the most positions is kept
+
+    Args:
+        csv_filename (str) : path to the CSV file or the SQLite storage
+        filters (dict) : selection (see db_filters)
+
+    Returns:
+        tag (str or None) : None if the log has one tag or no Tag column
+    """
+    if filters.get("tag") is not None:
+        return filters["tag"]
+    if store.is_database(csv_filename):
+        counts = store.tag_counts(csv_filename, filters["session"],
+                                  filters["start"], filters["end"])
+    else:
+        counts = {}
+        with open(csv_filename, newline='') as file:
+            for row in utils.read_log(file):
+                tag = row.get("Tag") or None
+                counts[tag] = counts.get(tag, 0) + 1
+    if len(counts) < 2:
+        return None
+    tag = max(counts, key=counts.get)
+    others = ", ".join(sorted(str(t) for t in counts if t != tag))
+    utils.logger.warning(f"The log has {len(counts)} tags, showing {tag} " \
+                         f"(--tag to show {others})")
+    return tag
+
+
+def read_rows(csv_filename, filters=None):
+    """
+    Rows of a positions CSV, with or without header, of the tag selected
 
     Args:
         csv_filename (str) : path to the CSV file
+        filters (dict, optional) : only its tag is used (see select_tag)
+
+    Yields:
+        row (dictionary{k: column, v: str})
+    """
+    tag = (filters or {}).get("tag")
+    with open(csv_filename, newline='') as file:
+        for row in utils.read_log(file):
+            if tag is None or row.get("Tag") == tag:
+                yield row
+
+
+def get_positions(csv_filename, filters=None):
+    """
+    Reads x, y, and timestamp data from the CSV file or the SQLite storage.
+
+    Args:
+        csv_filename (str) : path to the CSV file or the SQLite storage
+        filters (dict, optional) : selection (see db_filters), the CSV only
+                                   uses its tag
 
     Returns:
         xs (numpy.ndarray) : every x coordinate of each measured position
@@ -70,28 +162,36 @@ def get_positions(csv_filename):
         timestamps (numpy.ndarray) : every timestamps in string
         float_timestamps (numpy.ndarray) : every timestamps in float
     """
-    xs, ys, timestamps, float_timestamps = [], [], [], []
-    with open(csv_filename, newline='') as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            try:
-                x = float(row.get("x_transformed", row.get("pos_x")))
-                y = float(row.get("y_transformed", row.get("pos_y")))
-
-                # For calculations with time
-                t = datetime.strptime(row["Timestamp"], "%Y-%m-%d %H:%M:%S.%f")
-                float_timestamps.append(t.timestamp())
+    if store.is_database(csv_filename):
+        xs, ys, float_timestamps = store.load_positions(csv_filename, **(filters or {}))
+        timestamps = [str(datetime.fromtimestamp(t)) for t in float_timestamps]
+        xs, ys = np.array(xs), np.array(ys)
+        return densify_positions(xs, ys, timestamps, float_timestamps)
 
-                # For display
-                t = row.get("Timestamp")
-                timestamps.append(t)
-
-                xs.append(x)
-                ys.append(y)
-            except ValueError:
-                continue  # skip invalid rows
-
-    xs, ys = np.array(xs), np.array(ys)
+    xs, ys, timestamps, float_timestamps = [], [], [], []
+    for row in read_rows(csv_filename, filters):
+        try:
+            x = float(row.get("x_transformed", row.get("pos_x")))
+            y = float(row.get("y_transformed", row.get("pos_y")))
+
+            # For calculations with time
+            t = datetime.strptime(row["Timestamp"], "%Y-%m-%d %H:%M:%S.%f")
+            float_timestamps.append(t.timestamp())
+
+            # For display
+            t = row.get("Timestamp")
+            timestamps.append(t)
+
+            xs.append(x)
+            ys.append(y)
+        except (TypeError, ValueError):
+            continue  # skip invalid rows
+
+    # The rows of a log are in the order they were solved, not measured
+    order = np.argsort(float_timestamps, kind="stable")
+    xs, ys = np.array(xs)[order], np.array(ys)[order]
+    timestamps = [timestamps[i] for i in order]
+    float_timestamps = [float_timestamps[i] for i in order]
 
     xs, ys, timestamps, float_timestamps = densify_positions(xs, ys, timestamps, float_timestamps)
 
@@ -156,32 +256,119 @@ def densify_positions(xs, ys, timestamps, float_timestamps, max_dt=0.2):
     return np.array(new_xs), np.array(new_ys), padded_ts, new_ts
 
 
-def smart_anchors(anchors, csv_filename):
+def get_uncertainty(csv_filename, filters=None):
+    """
+    Reads the covariance of each position (not densified)
+
+    Args:
+        csv_filename (str) : path to the CSV file or the SQLite storage
+        filters (dict, optional) : selection (see db_filters), the CSV only
+                                   uses its tag
+
+    Returns:
+        float_timestamps (numpy.ndarray) : every timestamps in float, sorted
+        covariances (numpy.ndarray) : shape (n, 3) var_x, cov_xy, var_y of
+                                      each position, NaN when unknown
+    """
+    if store.is_database(csv_filename):
+        columns = store.load_positions(csv_filename, **(filters or {}), covariance=True)
+        times = np.array(columns[2], dtype=float)
+        covariances = np.array(columns[3:], dtype=float).T.reshape(-1, 3)
+        return times, covariances
+
+    times, covariances = [], []
+    for row in read_rows(csv_filename, filters):
+        try:
+            t = datetime.strptime(row["Timestamp"], "%Y-%m-%d %H:%M:%S.%f").timestamp()
+        except (TypeError, ValueError, KeyError):
+            continue  # skip invalid rows
+        try:
+            covariance = [float(row[c]) for c in ("var_x", "cov_xy", "var_y")]
+        except (TypeError, ValueError, KeyError):
+            covariance = [np.nan] * 3
+        times.append(t)
+        covariances.append(covariance)
+    order = np.argsort(times, kind="stable")
+    return np.array(times)[order], np.array(covariances, dtype=float).reshape(-1, 3)[order]
+
+
+def covariance_ellipses(covariances, sigmas=2):
+    """
+    Axes of the uncertainty ellipses, all at once
+
+    Args:
+        covariances (numpy.ndarray) : shape (n, 3) var_x, cov_xy, var_y
+        sigmas (float, optional) : size of the ellipses in standard deviations
+
+    Returns:
+        widths (numpy.ndarray), heights (numpy.ndarray) : full axes in m
+        angles (numpy.ndarray) : angles of the widths in degrees
+    """
+    a, b, c = covariances[:, 0], covariances[:, 1], covariances[:, 2]
+    mean = (a + c) / 2
+    spread = np.sqrt(((a - c) / 2) ** 2 + b ** 2)
+    major = np.sqrt(np.maximum(mean + spread, 0))
+    minor = np.sqrt(np.maximum(mean - spread, 0))
+    angles = np.degrees(0.5 * np.arctan2(2 * b, a - c))
+    return 2 * sigmas * major, 2 * sigmas * minor, angles
+
+
+def smart_anchors(anchors, csv_filename, filters=None):
     """
     Returns only the anchors that were used in the CSV file.
     Args:        
         anchors (dictionary{key: anchor id, value: tuple(x, y, z)}) : 
                                                     anchors positions with ids
-        csv_filename (str) : path to the CSV file
+        csv_filename (str) : path to the CSV file or the SQLite storage
+        filters (dict, optional) : selection (see db_filters), the CSV only
+                                   uses its tag
 
     Returns:
         anchors (dictionary{key: anchor id, value: tuple(x, y, z)}) : 
                                 anchors positions with ids only used in the csv
     """
+    if store.is_database(csv_filename):
+        used_anchors = store.used_anchors(csv_filename, **(filters or {}))
+        return {k: v for k, v in anchors.items() if k in used_anchors}
+
     used_anchors = set()
-    with open(csv_filename, newline='') as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            try:
-                for i in range(1, 5):
-                    anchor_id = row.get(f"id_{i}")
-                    if anchor_id:
-                        used_anchors.add(anchor_id)
-            except ValueError:
-                continue  # skip invalid rows
+    for row in read_rows(csv_filename, filters):
+        for i in range(1, 5):
+            anchor_id = row.get(f"id_{i}")
+            if anchor_id:
+                used_anchors.add(anchor_id)
     return {k: v for k, v in anchors.items() if k in used_anchors}
 
 
+def draw_grid(ax, x_min, x_max, y_min, y_max):
+    """
+    Draws the major and minor grid lines of the map
+
+    Args:
+        ax (matplotlib.axes.Axes) : map
+        x_min, x_max, y_min, y_max (float) : limits of the map
+    """
+    # Major grid spacing
+    bin_size_x = (x_max - x_min) / major_cells
+    bin_size_y = (y_max - y_min) / major_cells
+
+    # Minor grid spacing
+    minor_x = bin_size_x / minor_div
+    minor_y = bin_size_y / minor_div
+
+    # Apply major grid
+    ax.set_xticks(np.arange(x_min, x_max + bin_size_x, bin_size_x))
+    ax.set_yticks(np.arange(y_min, y_max + bin_size_y, bin_size_y))
+
+    # Apply minor grid
+    ax.set_xticks(np.arange(x_min, x_max + minor_x, minor_x), minor=True)
+    ax.set_yticks(np.arange(y_min, y_max + minor_y, minor_y), minor=True)
+
+    # Draw grids
+    ax.grid(which='major', linestyle=':', color='gray', linewidth=1.5, alpha=0.5)
+    ax.grid(which='minor', linestyle=':', color='gray', linewidth=1, alpha=0.3)
+
+
 def update_scatter_from_csv(anchors, args):
     """
     Main loop : Displays a dynamic trajectory plot of the tag positions.
@@ -230,7 +417,7 @@ def update_scatter_from_csv(anchors, args):
             if os.path.exists(new_anchors):
                 anchors = smart_anchors(utils.load_anchors(new_anchors), args.csv)
 
-        xs, ys, timestamps, float_timestamps = get_positions(args.csv)
+        xs, ys, timestamps, float_timestamps = get_positions(args.csv, db_filters(args))
 
         # This is better for non moving Tag
         if args.precision:
@@ -284,7 +471,8 @@ def update_scatter_from_csv(anchors, args):
 
         # Stops
         if args.stops:
-            useless_xs, useless_ys, useless_ts, stops_pos = detect_stops(args.csv)
+            useless_xs, useless_ys, useless_ts, stops_pos = detect_stops(
+                args.csv, filters=db_filters(args))
 
             stop_xs = [stop["x"] for stop in stops_pos]
             stop_ys = [stop["y"] for stop in stops_pos]
@@ -295,6 +483,23 @@ def update_scatter_from_csv(anchors, args):
         point, = ax.plot([], [], 'go', markersize=6, label="Current position")
         trail_scatter = ax.scatter([], [], c='blue', s=30, label="Past positions")
 
+        # Uncertainty of the current and past positions, from the solver
+        if args.uncertainty:
+            utils.logger.debug("Uncertainty ellipses")
+            cov_times, covariances = get_uncertainty(args.csv, db_filters(args))
+            frame_times = np.asarray(float_timestamps)
+            ellipses = EllipseCollection([], [], [], units='xy', offsets=np.empty((0, 2)),
+                                         offset_transform=ax.transData, facecolors='none',
+                                         edgecolors='orange', linewidths=1)
+            ax.add_collection(ellipses)
+
+        # Whole path, with the level of detail matching the zoom and the frame
+        if args.path:
+            utils.logger.debug("Path level of detail")
+            pyramid = lod.TrajectoryPyramid(xs, ys)
+            path_line, = ax.plot([], [], '-', color='gray', linewidth=1,
+                                 alpha=0.6, label="Path")
+
         # Labels, legend, etc.
         ax.set_xlabel("X")
         ax.set_ylabel("Y")
@@ -334,26 +539,28 @@ def update_scatter_from_csv(anchors, args):
             cbar = plt.colorbar(im, ax=ax)
             cbar.set_label("Seconds", rotation=270, labelpad=15)
 
-        # Grid lines
-        # Major grid spacing
-        bin_size_x = (x_max - x_min) / major_cells
-        bin_size_y = (y_max - y_min) / major_cells
+        # Expected error of the anchors geometry
+        if args.gdop and len(anchors) >= 2:
+            utils.logger.debug("Precision map")
+            error, extent = gdop.PrecisionMap.load(anchors).error_grid()
 
-        # Minor grid spacing
-        minor_x = bin_size_x / minor_div
-        minor_y = bin_size_y / minor_div
+            cmap = plt.colormaps["viridis_r"].copy()
+            cmap.set_bad(color="white")   # Ambiguous geometry
 
-        # Apply major grid
-        ax.set_xticks(np.arange(x_min, x_max + bin_size_x, bin_size_x))
-        ax.set_yticks(np.arange(y_min, y_max + bin_size_y, bin_size_y))
+            im = ax.imshow(
+                np.ma.masked_invalid(error).T,
+                extent=extent,
+                origin='lower',
+                cmap=cmap,
+                alpha=0.3,
+                aspect='auto',
+                vmax=utils.low_confidence_error
+            )
 
-        # Apply minor grid
-        ax.set_xticks(np.arange(x_min, x_max + minor_x, minor_x), minor=True)
-        ax.set_yticks(np.arange(y_min, y_max + minor_y, minor_y), minor=True)
+            cbar = plt.colorbar(im, ax=ax)
+            cbar.set_label("Expected error (m)", rotation=270, labelpad=15)
 
-        # Draw grids
-        ax.grid(which='major', linestyle=':', color='gray', linewidth=1.5, alpha=0.5)
-        ax.grid(which='minor', linestyle=':', color='gray', linewidth=1, alpha=0.3)
+        draw_grid(ax, x_min, x_max, y_min, y_max)
 
         # Title
         ax.set_title(f"Trajectory map : Frame 1/{len(xs)}\n{timestamps[0]}")
@@ -382,6 +589,23 @@ def update_scatter_from_csv(anchors, args):
         btn_prev = Button(ax_prev, "◀")
         btn_next = Button(ax_next, "▶")
 
+        def draw_path(ax=ax):
+            """
+            Redraws the path up to the current frame with the points of the
+            pyramid level that fits the visible area. Also called on zoom.
+            """
+            if not args.path:
+                return
+            (x0, x1), (y0, y1) = ax.get_xlim(), ax.get_ylim()
+            bbox = (min(x0, x1), max(x0, x1), min(y0, y1), max(y0, y1))
+            path_xs, path_ys = pyramid.path(0, int(slider.val), bbox)
+            path_line.set_data(path_xs, path_ys)
+            fig.canvas.draw_idle()
+
+        if args.path:
+            ax.callbacks.connect('xlim_changed', draw_path)
+            ax.callbacks.connect('ylim_changed', draw_path)
+
         def update(val):
             """
             Updates plot when slider range changes.
@@ -422,7 +646,21 @@ def update_scatter_from_csv(anchors, args):
             else:
                 trail_scatter.set_offsets(np.empty((0, 2)))
 
+            if args.uncertainty and len(cov_times):
+                # Measured position at or before each frame (densified frames
+                # have the uncertainty of the last measure)
+                frames = np.arange(max(0, end_frame - 1 - args.trail), end_frame)
+                measures = np.searchsorted(cov_times, frame_times[frames] + 1e-6) - 1
+                measures = measures.clip(0, len(cov_times) - 1)
+                known = ~np.isnan(covariances[measures, 0])
+                widths, heights, angles = covariance_ellipses(covariances[measures[known]])
+                ellipses.set_offsets(np.c_[xs[frames[known]], ys[frames[known]]])
+                ellipses.set_widths(widths)
+                ellipses.set_heights(heights)
+                ellipses.set_angles(angles)
+
             ax.set_title(f"Trajectory map : Frame {end_frame}/{len(xs)}\n{timestamps[end_frame - 1]}")
+            draw_path()
             fig.canvas.draw_idle()
 
         slider.on_changed(update)
@@ -451,21 +689,216 @@ def update_scatter_from_csv(anchors, args):
         plt.close()
 
 
-def plot_precision_1d(csv_filename):
+def follow_csv(anchors, args):
+    """
+    Follow mode : displays the positions while the server appends them to
+    the CSV. Every refresh only parses the new rows, adds them to the
+    heatmap and the stops, and blits the moving artists over a cached
+    background, so the cost of a refresh does not grow with the session.
+    Every Tag of the log has its own trail, current position and stops.
+
+    Args:
+        anchors (dictionary{key: anchor id, value: tuple(x, y, z)}) :
+                                                    anchors positions with ids
+        args (argparse.Namespace) : All command line args are accessible from it
+    """
+    tail = log_tail.LogTail(args.csv)
+    tracks = {}     # tag -> (xs, ys, ts GrowingArray, StopTracker)
+    colors = plt.colormaps["tab10"]
+
+    fig, ax = plt.subplots()
+    ax.set_aspect("equal") # Avoids stretching
+
+    # The map is the area of the anchors, the log is not known in advance
+    anchor_xs = [coord[0] for coord in anchors.values()]
+    anchor_ys = [coord[1] for coord in anchors.values()]
+    padding = utils.no_image_padding
+    x_min, x_max = min(anchor_xs) - padding, max(anchor_xs) + padding
+    y_min, y_max = min(anchor_ys) - padding, max(anchor_ys) + padding
+
+    ax.scatter(anchor_xs, anchor_ys, c="purple", s=80, marker="X", label="Anchors")
+
+    # Moving artists: not in the background, drawn by refresh()
+    moving = []
+
+    if args.heatmap:
+        x_edges = np.linspace(x_min, x_max, num_bins + 1)
+        y_edges = np.linspace(y_min, y_max, num_bins + 1)
+        counts = np.zeros((num_bins, num_bins))
+
+        cmap = plt.colormaps["Reds"].copy()
+        cmap.set_bad(color="white")   # In case there are invalid values
+
+        im = ax.imshow(
+            counts.T,
+            extent=[x_min, x_max, y_min, y_max],
+            origin='lower',
+            cmap=cmap,
+            alpha=0.3,
+            aspect='auto',
+            vmin=0,
+            vmax=args.max_time_diff,
+            animated=True
+        )
+        moving.append(im)
+
+        cbar = plt.colorbar(im, ax=ax)
+        cbar.set_label("Seconds", rotation=270, labelpad=15)
+
+    if args.stops:
+        stops_scatter = ax.scatter([], [], c="red", s=60, marker="^", label="Stops",
+                                   animated=True)
+        moving.append(stops_scatter)
+
+    trail_scatter = ax.scatter([], [], c='blue', s=30, label="Past positions", animated=True)
+    point = ax.scatter([], [], c='green', s=36, edgecolors="black", label="Current position",
+                       animated=True)
+    status = ax.text(0.01, 0.99, "Waiting for positions", transform=ax.transAxes,
+                     ha="left", va="top", fontsize=9, animated=True)
+    moving += [trail_scatter, point, status]
+
+    ax.set_xlabel("X")
+    ax.set_ylabel("Y")
+    ax.set_xlim(x_min, x_max)
+    ax.set_ylim(y_min, y_max)
+    ax.invert_yaxis()
+    ax.legend(loc="lower right")
+    draw_grid(ax, x_min, x_max, y_min, y_max)
+    ax.set_title(f"Trajectory map : following {os.path.basename(args.csv)}")
+
+    background = None
+
+    def draw_moving():
+        for artist in moving:
+            ax.draw_artist(artist)
+
+    def on_draw(event):
+        """ Full redraw (start, resize, zoom): caches the new background """
+        nonlocal background
+        background = fig.canvas.copy_from_bbox(ax.bbox)
+        draw_moving()
+
+    fig.canvas.mpl_connect("draw_event", on_draw)
+
+    def refresh():
+        """ Reads the new rows of the log and redraws the moving artists """
+        new_xs, new_ys, new_ts, new_tags, restarted = tail.read()
+        if not len(new_xs) and not restarted:
+            return
+
+        full_redraw = False
+        if restarted:
+            tracks.clear()
+            if args.heatmap:
+                counts[:] = 0
+                im.set_clim(0, args.max_time_diff)
+                full_redraw = True
+
+        for tag in np.unique(new_tags):
+            rows = new_tags == tag
+            if tag not in tracks:
+                tracks[tag] = (log_tail.GrowingArray(), log_tail.GrowingArray(),
+                               log_tail.GrowingArray(), live_state.StopTracker())
+            xs, ys, ts, stop_tracker = tracks[tag]
+            xs.extend(new_xs[rows])
+            ys.extend(new_ys[rows])
+            ts.extend(new_ts[rows])
+            if args.stops:
+                for x, y, t in zip(new_xs[rows], new_ys[rows], new_ts[rows]):
+                    stop_tracker.update(x, y, t)
+
+        if args.heatmap:
+            counts[:] += np.histogram2d(new_xs, new_ys, bins=[x_edges, y_edges])[0]
+            im.set_data(counts.T * args.max_time_diff)
+            # The scale doubles when exceeded so the colorbar is rarely redrawn
+            vmax = im.get_clim()[1]
+            peak = counts.max() * args.max_time_diff
+            if peak > vmax:
+                while peak > vmax:
+                    vmax *= 2
+                im.set_clim(0, vmax)
+                full_redraw = True
+
+        if args.stops:
+            stops = []
+            for _, _, _, stop_tracker in tracks.values():
+                stops += stop_tracker.stops
+                ongoing = stop_tracker.current()
+                if ongoing is not None:
+                    stops.append(ongoing)
+            stops_scatter.set_offsets(np.array([[stop["x"], stop["y"]] for stop in stops])
+                                      .reshape(-1, 2))
+
+        n = sum(len(track[0]) for track in tracks.values())
+        if n:
+            points, point_colors, trails, trail_colors = [], [], [], []
+            for i, (tag, (xs, ys, ts, _)) in enumerate(sorted(tracks.items())):
+                color = colors(i % colors.N)[:3] if len(tracks) > 1 else (0, 0, 1)
+                count = len(xs)
+                points.append((xs.values[-1], ys.values[-1]))
+                point_colors.append(color if len(tracks) > 1 else "green")
+
+                # Fade effect
+                start = max(0, count - 1 - args.trail)
+                trails.append(np.c_[xs.values[start:count - 1], ys.values[start:count - 1]])
+                alphas = np.linspace(0.1, 0.8, count - 1 - start)
+                trail_colors += [(*color, a) for a in alphas]
+            point.set_offsets(np.array(points))
+            point.set_facecolors(point_colors)
+            trail_scatter.set_offsets(np.concatenate(trails))
+            trail_scatter.set_facecolors(trail_colors)
+
+            last = max(track[2].values[-1] for track in tracks.values())
+            first = min(track[2].values[0] for track in tracks.values())
+            last_time = datetime.fromtimestamp(last, tz=timezone.utc)
+            duration = format_duration(last - first)
+            tags = f"{len(tracks)} tags  " if len(tracks) > 1 else ""
+            status.set_text(f"Frame {n}  {tags}{last_time:%Y-%m-%d %H:%M:%S}  ({duration})")
+        else:
+            point.set_offsets(np.empty((0, 2)))
+            trail_scatter.set_offsets(np.empty((0, 2)))
+            status.set_text("Waiting for positions")
+
+        if full_redraw or background is None:
+            fig.canvas.draw_idle()
+            return
+        fig.canvas.restore_region(background)
+        draw_moving()
+        fig.canvas.blit(ax.bbox)
+
+    refresh()
+    timer = fig.canvas.new_timer(interval=int(args.refresh * 1000))
+    timer.add_callback(refresh)
+    timer.start()
+
+    try:
+        plt.show()
+    except KeyboardInterrupt:
+        plt.close()
+    finally:
+        timer.stop()
+
+
+def plot_precision_1d(csv_filename, filters=None):
     """
     Reads the single range from CSV and display 1d precision
 
     Args:
-        csv_filename (str) : path to the CSV file
+        csv_filename (str) : path to the CSV file or the SQLite storage
+        filters (dict, optional) : selection (see db_filters), the CSV only
+                                   uses its tag
     """
     xs = []
-    with open(csv_filename, newline='') as file:
-        reader = csv.DictReader(file)
-        for row in reader:
+    if store.is_database(csv_filename):
+        for chunk in store.read_range_chunks(csv_filename, **(filters or {})):
+            for values in chunk.values():
+                xs.extend(values)
+    else:
+        for row in read_rows(csv_filename, filters):
             try:
                 x = float(row.get("d1"))
                 xs.append(x)
-            except ValueError:
+            except (TypeError, ValueError):
                 continue  # skip invalid rows
 
     xs = np.array(xs)
@@ -535,14 +968,16 @@ def format_duration(seconds_total):
         return f"{minutes:02d}:{seconds:02d}"
 
 
-def detect_stops(csv_filename, speed_thresh=0.2, min_duration=30.0):
+def detect_stops(csv_filename, speed_thresh=0.2, min_duration=30.0, filters=None):
     """
     Detects stops based on movement speed threshold and duration.
 
     Args:
-        csv_filename (str) : path to the CSV file
+        csv_filename (str) : path to the CSV file or the SQLite storage
         speed_thresh (float) : speed treshold to consider a target moving
         min_duration (float) : min pause to count as a stop
+        filters (dict, optional) : selection (see db_filters), the CSV only
+                                   uses its tag
 
     Returns:
         xs (numpy.ndarray) : every x coordinate of each measured position
@@ -554,7 +989,7 @@ def detect_stops(csv_filename, speed_thresh=0.2, min_duration=30.0):
                         - x position
                         - y position
     """
-    xs, ys, timestamps, float_timestamps = get_positions(csv_filename)
+    xs, ys, timestamps, float_timestamps = get_positions(csv_filename, filters)
 
     utils.logger.debug("Stops calculation")
 
@@ -592,15 +1027,17 @@ def detect_stops(csv_filename, speed_thresh=0.2, min_duration=30.0):
     return xs, ys, float_timestamps, stops
 
 
-def show_summary_window(csv_filename):
+def show_summary_window(csv_filename, filters=None):
     """
     Displays a static summary window with stops stats.
 
     Args:
-        csv_filename (str) : path to the CSV file
+        csv_filename (str) : path to the CSV file or the SQLite storage
+        filters (dict, optional) : selection (see db_filters), the CSV only
+                                   uses its tag
     """
 
-    xs, ys, float_timestamps, stops = detect_stops(csv_filename)
+    xs, ys, float_timestamps, stops = detect_stops(csv_filename, filters=filters)
 
     fig, ax = plt.subplots(figsize=(6, 4))
     ax.axis('off')
@@ -646,15 +1083,26 @@ def main():
     utils.setup_logging(logging.WARNING)
 
     anchors = utils.load_anchors()
-    anchors = smart_anchors(anchors, args.csv)
+
+    if args.follow:
+        if store.is_database(args.csv):
+            utils.logger.error("--follow reads a CSV log, not the SQLite storage")
+            return
+        # The log may be empty or not exist yet, so all the anchors are kept
+        follow_csv(anchors, args)
+        return
+
+    filters = db_filters(args)
+    args.tag = filters["tag"] = select_tag(args.csv, filters)
+    anchors = smart_anchors(anchors, args.csv, filters)
 
     if (args.stops):
-        show_summary_window(args.csv)
+        show_summary_window(args.csv, filters)
 
     if len(anchors) > 1:
         update_scatter_from_csv(anchors, args)
     else :
-        plot_precision_1d(args.csv)
+        plot_precision_1d(args.csv, filters)
 
 
 if __name__ == '__main__':
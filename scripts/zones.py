@@ -0,0 +1,299 @@
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+
+from meanRange import open_log
+import utils
+
+grid_cell = 0.05    # m, resolution of the zone lookup grid
+max_dwell_gap = 2.0 # s, a longer gap between 2 positions is not counted as dwell
+
+OUTSIDE = -1        # zone index of a position in no zone
+
+
+def build_arg_parser():
+    """Build argument parser."""
+    p = argparse.ArgumentParser(
+        description="Time spent in each zone of the room and transitions " \
+                    "between zones, from a positions CSV"
+    )
+    p.add_argument('--csv', type=str, default="../logs/positions.csv",
+                    help='CSV file we want to read from')
+    p.add_argument('--config', type=str, default="../config.json",
+                    help='Config file with the anchors and the "zones" polygons')
+    return p
+
+
+def load_zones(config_path="../config.json"):
+    """
+    Load the zones of a room. They are optional polygons in the config file,
+    next to the anchors, ex:
+        "zones": {"board": [[0, 0], [3, 0], [3, 1], [0, 1]], "door": [...]}
+    When zones overlap, the first one listed wins.
+
+    Args:
+        config_path (str, optional): The file path to the JSON config file.
+                    Defaults to ../config.json.
+
+    Returns:
+        zones (dictionary{key: zone name, value: numpy.ndarray (n, 2)}) :
+                                                polygon vertices of each zone
+    """
+    if not os.path.exists(config_path):
+        logging.error(f"Config file not found: {config_path}")
+        return {}
+    with open(config_path, "r") as f:
+        data = json.load(f)
+
+    return {name: np.asarray(polygon, dtype=float)[:, :2]
+            for name, polygon in data.get("zones", {}).items()}
+
+
+def points_in_polygon(points, polygon):
+    """
+    Even-odd test of many points against one polygon, vectorized on the
+    points (the loop is on the few edges of the polygon)
+
+    Args:
+        points (numpy.ndarray) : shape (n, 2)
+        polygon (numpy.ndarray) : shape (m, 2) vertices
+
+    Returns:
+        inside (numpy.ndarray) : shape (n,) booleans
+    """
+    x, y = points[:, 0], points[:, 1]
+    inside = np.zeros(len(points), dtype=bool)
+    x1, y1 = polygon[-1]
+    for x2, y2 in polygon:
+        crosses = (y1 > y) != (y2 > y)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (x < x_cross)
+        x1, y1 = x2, y2
+    return inside
+
+
+class ZoneGrid:
+    """
+    Rasterized zones: the polygons are tested once, at load, on a grid of
+    cells. Classifying positions is then only an index computation and a
+    lookup, for millions of positions at once or one live position.
+    """
+
+    def __init__(self, zones, cell=grid_cell):
+        """
+        Args:
+            zones (dictionary{key: zone name, value: numpy.ndarray (n, 2)})
+            cell (float, optional) : size of the grid cells in meters
+        """
+        self.names = list(zones)
+        self.cell = cell
+        if not zones:
+            self.origin = np.zeros(2)
+            self.grid = np.full((0, 0), OUTSIDE, dtype=np.int16)
+            return
+
+        vertices = np.concatenate(list(zones.values()))
+        self.origin = vertices.min(axis=0)
+        shape = np.ceil((vertices.max(axis=0) - self.origin) / cell).astype(int) + 1
+
+        # Centers of all the cells, x major
+        ix, iy = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing="ij")
+        centers = self.origin + (np.stack([ix.ravel(), iy.ravel()], axis=1) + 0.5) * cell
+
+        grid = np.full(len(centers), OUTSIDE, dtype=np.int16)
+        for index in reversed(range(len(self.names))): # first zone listed wins
+            grid[points_in_polygon(centers, zones[self.names[index]])] = index
+        self.grid = grid.reshape(shape)
+
+    def classify(self, xs, ys):
+        """
+        Zone of every position
+
+        Args:
+            xs (numpy.ndarray) : x coordinates
+            ys (numpy.ndarray) : y coordinates
+
+        Returns:
+            zones (numpy.ndarray) : index in self.names of the zone of each
+                                    position, OUTSIDE if in no zone
+        """
+        ix = np.floor((np.asarray(xs, dtype=float) - self.origin[0]) / self.cell).astype(np.intp)
+        iy = np.floor((np.asarray(ys, dtype=float) - self.origin[1]) / self.cell).astype(np.intp)
+        valid = (ix >= 0) & (iy >= 0) & (ix < self.grid.shape[0]) & (iy < self.grid.shape[1])
+        result = np.full(ix.shape, OUTSIDE, dtype=np.int16)
+        result[valid] = self.grid[ix[valid], iy[valid]]
+        return result
+
+    def zone_of(self, x, y):
+        """
+        Args:
+            x (float) : x coordinate
+            y (float) : y coordinate
+
+        Returns:
+            name (str or None) : zone of the position, None if in no zone
+        """
+        ix = int((x - self.origin[0]) // self.cell)
+        iy = int((y - self.origin[1]) // self.cell)
+        if 0 <= ix < self.grid.shape[0] and 0 <= iy < self.grid.shape[1]:
+            index = self.grid[ix, iy]
+            if index != OUTSIDE:
+                return self.names[index]
+        return None
+
+
+def dwell_and_transitions(zone_indexes, timestamps, nb_zones):
+    """
+    Time spent in each zone and transitions between zones
+
+    Args:
+        zone_indexes (numpy.ndarray) : zone of each position (ZoneGrid.classify)
+        timestamps (numpy.ndarray) : time of each position in seconds
+        nb_zones (int) : number of zones
+
+    Returns:
+        dwell (numpy.ndarray) : shape (nb_zones + 1,) seconds in each zone,
+                                the last one is outside of every zone
+        transitions (numpy.ndarray) : shape (nb_zones + 1, nb_zones + 1) number
+                                of moves from a zone (row) to another (column)
+    """
+    # OUTSIDE (-1) becomes the last index
+    zone_indexes = np.where(zone_indexes == OUTSIDE, nb_zones, zone_indexes).astype(np.intp)
+
+    dt = np.diff(timestamps)
+    dt[(dt < 0) | (dt > max_dwell_gap)] = 0.0
+    dwell = np.bincount(zone_indexes[:-1], weights=dt, minlength=nb_zones + 1)
+
+    changes = np.nonzero(zone_indexes[1:] != zone_indexes[:-1])[0]
+    transitions = np.zeros((nb_zones + 1, nb_zones + 1), dtype=np.int64)
+    np.add.at(transitions, (zone_indexes[changes], zone_indexes[changes + 1]), 1)
+    return dwell, transitions
+
+
+class ZoneTracker:
+    """
+    Incremental dwell and transitions of one tag, O(1) per position
+    """
+
+    def __init__(self, zone_grid):
+        self.zone_grid = zone_grid
+        self.current = None     # name of the current zone, None = outside
+        self.last_time = None
+        self.dwell = {}         # zone name -> seconds
+        self.transitions = {}   # (from, to) -> count
+
+    def update(self, x, y, t):
+        """
+        Add a position
+
+        Args:
+            x (float) : x coordinate of the tag
+            y (float) : y coordinate of the tag
+            t (float) : time of the position in seconds
+        """
+        zone = self.zone_grid.zone_of(x, y)
+        if self.last_time is not None:
+            dt = t - self.last_time
+            if 0 < dt <= max_dwell_gap and self.current is not None:
+                self.dwell[self.current] = self.dwell.get(self.current, 0.0) + dt
+            if zone != self.current:
+                key = (self.current, zone)
+                self.transitions[key] = self.transitions.get(key, 0) + 1
+        self.current = zone
+        self.last_time = t
+
+    def summary(self):
+        """
+        Returns:
+            summary (dict) : current zone, seconds per zone and transitions
+        """
+        return {
+            "zone": self.current,
+            "dwell": {k: round(v, 1) for k, v in self.dwell.items()},
+            "transitions": [[a, b, n] for (a, b), n in self.transitions.items()],
+        }
+
+
+def read_positions(csv_filename):
+    """
+    Read the raw positions of a log (no densification), per tag. A log with
+    a Tag column can hold many tags, otherwise it is one tag named after the
+    file.
+
+    Args:
+        csv_filename (str) : path to the CSV file (.gz, .bz2, .xz accepted)
+
+    Returns:
+        positions (dictionary{k: tag, v: tuple(xs, ys, timestamps)}) : numpy
+                    arrays of x, y and time in seconds, sorted by time
+    """
+    default_tag = os.path.basename(csv_filename).split(".")[0]
+    rows = {}
+    with open_log(csv_filename) as file:
+        for row in utils.read_log(file):
+            x = row.get("x_transformed", row.get("pos_x"))
+            y = row.get("y_transformed", row.get("pos_y"))
+            if not x or not y or not row.get("Timestamp"):
+                continue
+            try:
+                x, y = float(x), float(y)
+            except ValueError:
+                continue  # skip invalid rows
+            xs, ys, times = rows.setdefault(row.get("Tag") or default_tag, ([], [], []))
+            xs.append(x)
+            ys.append(y)
+            times.append(row["Timestamp"])
+
+    positions = {}
+    for tag, (xs, ys, times) in rows.items():
+        timestamps = utils.log_times(times)
+        valid = ~np.isnan(timestamps)
+        if not valid.any():
+            continue
+        order = np.argsort(timestamps[valid], kind="stable")
+        positions[tag] = (np.array(xs, dtype=float)[valid][order],
+                          np.array(ys, dtype=float)[valid][order], timestamps[valid][order])
+    return positions
+
+
+def main():
+    parser = build_arg_parser()
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO) # To see the results
+
+    zones = load_zones(args.config)
+    if not zones:
+        logging.error(f"No zones in {args.config}")
+        return
+
+    zone_grid = ZoneGrid(zones)
+    names = zone_grid.names + ["(outside)"]
+    positions = read_positions(args.csv)
+    for tag, (xs, ys, timestamps) in sorted(positions.items()):
+        if len(positions) > 1:
+            logging.info(f"Tag {tag}:")
+        if len(xs) < 2:
+            logging.warning("Not enough positions.")
+            continue
+
+        dwell, transitions = dwell_and_transitions(
+            zone_grid.classify(xs, ys), timestamps, len(zone_grid.names)
+        )
+
+        logging.info("Time per zone:")
+        for name, seconds in zip(names, dwell):
+            logging.info(f"  {name}: {seconds:.1f} s")
+
+        logging.info("Transitions:")
+        for i, j in zip(*np.nonzero(transitions)):
+            logging.info(f"  {names[i]} -> {names[j]}: {transitions[i, j]}")
+    if not positions:
+        logging.warning("Not enough positions.")
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,6 @@
 #include <Adafruit_GFX.h>
 #include <Adafruit_SSD1306.h>
 
-#include <vector>
 #include "secrets.h"
 
 char ANCHOR_ADD[] = "A3:AA:5B:D5:A9:9A:E2:9C";
@@ -85,6 +84,13 @@ char TAG_ADDR[] = "7D:00:22:EA:82:60:3B:9B";
 // Comment to push tag code
 #define PUSHING_ANCHOR_CODE
 
+// Comment to send the old JSON messages instead of binary frames
+#define USE_BINARY_FRAMES
+
+// Comment to send the median filtered snapshot instead of every range
+// measured since the last send (needs USE_BINARY_FRAMES)
+#define SEND_RAW_SAMPLES
+
 Adafruit_SSD1306 display(128, 64, &Wire, -1);
 
 #ifndef PUSHING_ANCHOR_CODE
@@ -98,18 +104,81 @@ TaskHandle_t networkTask;
 const char *serverIP = "spatialPedagogy.local";
 const uint16_t serverPort = 5000;
 
+// Binary frame, must match scripts/protocol.py (little endian)
+// header  : 'S' 'P' | version u8 | type u8 | body length u16
+// type 1, snapshot :
+// body    : tag id u16 | sequence u32 | millis u32 | nb links u8
+//           nb links * (anchor addr u16 | range mm u16 | RX power cdBm i16
+//                       | first path power cdBm i16)
+// type 2, raw samples :
+// body    : tag id u16 | sequence u32 | millis u32 | nb samples u16
+//           nb samples * (anchor addr u16 | range mm u16 | RX power cdBm i16
+//                         | first path power cdBm i16 | age ms u16)
+// type 3, heartbeat (between the data frames) :
+// body    : tag id u16 | sequence u32 | millis u32 | nb anchors in range u8
+// trailer : CRC-16/CCITT (init 0xFFFF) of header + body, u16
+// Version 1 had no first path power and no heartbeat
+#define FRAME_VERSION 2
+#define FRAME_TYPE_SNAPSHOT 1
+#define FRAME_TYPE_SAMPLES 2
+#define FRAME_TYPE_HEARTBEAT 3
+#define FRAME_HEADER_SIZE 6
+#define FRAME_BODY_SIZE 11
+#define FRAME_LINK_SIZE 8
+#define FRAME_MAX_LINKS 16
+#define FRAME_SAMPLES_BODY_SIZE 12
+#define FRAME_SAMPLE_SIZE 10
+#define FRAME_MAX_SAMPLES 96 // ~7 anchors * 10 Hz * 500 ms, with margin
+
+// The server drops a connection silent for 1 s (scripts/liveness.py): a
+// heartbeat is sent between the data frames, even without any anchor, and
+// a lost connection is opened again right away (the server resumes the
+// session of the Tag)
+#define SEND_MS 500
+#define HEARTBEAT_MS 250
+#define RECONNECT_MS 500
+#define CONNECT_TIMEOUT_MS 500
+
+uint8_t frame_buffer[FRAME_HEADER_SIZE + FRAME_SAMPLES_BODY_SIZE + FRAME_MAX_SAMPLES * FRAME_SAMPLE_SIZE + 2];
+uint32_t frame_seq = 0;
+
+// Ranges measured since the last send (written by newRange on core 1,
+// read by networkLoop on core 0)
+struct Sample
+{
+  uint16_t anchor_addr;
+  float range;
+  float dbm;
+  float fp_dbm;
+  uint32_t time;
+};
+
+struct Sample samples[FRAME_MAX_SAMPLES];
+int sample_count = 0;
+portMUX_TYPE samples_mux = portMUX_INITIALIZER_UNLOCKED;
+
 float median_filter(float *arr, int size)
 {
-  std::vector<float> temp;
-  for (int i = 0; i < size; i++)
-    if (arr[i] > 0.01) // ignore zeros
-      temp.push_back(arr[i]);
+  // Insertion sort in a stack array: no heap allocation at every send
+  float temp[RANGE_HISTORY];
+  int n = 0;
+  for (int i = 0; i < size && n < RANGE_HISTORY; i++)
+  {
+    if (arr[i] <= 0.01) // ignore zeros
+      continue;
+    int j = n++;
+    while (j > 0 && temp[j - 1] > arr[i])
+    {
+      temp[j] = temp[j - 1];
+      j--;
+    }
+    temp[j] = arr[i];
+  }
 
-  if (temp.empty())
+  if (n == 0)
     return 0.0;
 
-  std::sort(temp.begin(), temp.end());
-  return temp[temp.size() / 2];
+  return temp[n / 2];
 }
 
 struct Link
@@ -118,6 +187,7 @@ struct Link
   float range_history[RANGE_HISTORY];
   int history_index;
   float dbm;
+  float fp_dbm; // first path power, much lower than dbm when the direct path is blocked
   struct Link *next;
 };
 
@@ -158,6 +228,7 @@ void add_link(struct Link *p, uint16_t addr)
   }
   a->history_index = 0;
   a->dbm = 0.0;
+  a->fp_dbm = 0.0;
   a->next = NULL;
 
   // Add anchor to end of struct Link
@@ -196,7 +267,7 @@ struct Link *find_link(struct Link *p, uint16_t addr)
   return NULL;
 }
 
-void fresh_link(struct Link *p, uint16_t addr, float range, float dbm)
+void fresh_link(struct Link *p, uint16_t addr, float range, float dbm, float fp_dbm)
 {
   if (range < 0.1 || range > 10.0)
     return; // Ignore negative values and above 10 meters
@@ -210,6 +281,7 @@ void fresh_link(struct Link *p, uint16_t addr, float range, float dbm)
 
     // Save RX power
     temp->dbm = dbm;
+    temp->fp_dbm = fp_dbm;
   }
   else
   {
@@ -217,6 +289,25 @@ void fresh_link(struct Link *p, uint16_t addr, float range, float dbm)
   }
 }
 
+void add_sample(uint16_t addr, float range, float dbm, float fp_dbm)
+{
+  if (range < 0.1 || range > 10.0)
+    return; // Same validation as fresh_link
+
+  portENTER_CRITICAL(&samples_mux);
+  if (sample_count < FRAME_MAX_SAMPLES)
+  {
+    samples[sample_count].anchor_addr = addr;
+    samples[sample_count].range = range;
+    samples[sample_count].dbm = dbm;
+    samples[sample_count].fp_dbm = fp_dbm;
+    samples[sample_count].time = millis();
+    sample_count++;
+  }
+  // else the network is too slow, the sample is dropped
+  portEXIT_CRITICAL(&samples_mux);
+}
+
 void print_link(struct Link *p)
 {
   struct Link *temp = p;
@@ -261,8 +352,9 @@ void make_link_json(struct Link *p, String *s)
   while (temp->next != NULL)
   {
     temp = temp->next;
-    char link_json[50];
-    sprintf(link_json, "{\"A\":\"%X\",\"R\":\"%.3f\"}", temp->anchor_addr, median_filter(temp->range_history, RANGE_HISTORY));
+    char link_json[80];
+    sprintf(link_json, "{\"A\":\"%X\",\"R\":\"%.3f\",\"P\":\"%.2f\",\"F\":\"%.2f\"}", temp->anchor_addr,
+            median_filter(temp->range_history, RANGE_HISTORY), temp->dbm, temp->fp_dbm);
     *s += link_json;
     if (temp->next != NULL)
     {
@@ -271,6 +363,116 @@ void make_link_json(struct Link *p, String *s)
   }
   *s += "]}";
 }
+
+void put_u16(uint8_t *buf, uint16_t v)
+{
+  buf[0] = v & 0xFF;
+  buf[1] = v >> 8;
+}
+
+void put_u32(uint8_t *buf, uint32_t v)
+{
+  put_u16(buf, v & 0xFFFF);
+  put_u16(buf + 2, v >> 16);
+}
+
+uint16_t crc16(const uint8_t *data, size_t len)
+{
+  uint16_t crc = 0xFFFF;
+  for (size_t i = 0; i < len; i++)
+  {
+    crc ^= (uint16_t)data[i] << 8;
+    for (int b = 0; b < 8; b++)
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+  }
+  return crc;
+}
+
+uint16_t tag_short_address()
+{
+  // Same byte order as DW1000Device::getShortAddress()
+  byte *addr = DW1000Ranging.getCurrentShortAddress();
+  return (addr[1] << 8) | addr[0];
+}
+
+size_t make_link_frame(struct Link *p, uint8_t *buf)
+{
+  uint8_t *link = buf + FRAME_HEADER_SIZE + FRAME_BODY_SIZE;
+  uint8_t count = 0;
+  struct Link *temp = p;
+
+  while (temp->next != NULL && count < FRAME_MAX_LINKS)
+  {
+    temp = temp->next;
+    float range = median_filter(temp->range_history, RANGE_HISTORY);
+    put_u16(link, temp->anchor_addr);
+    put_u16(link + 2, (uint16_t)(range * 1000.0 + 0.5));
+    put_u16(link + 4, (uint16_t)(int16_t)(temp->dbm * 100.0));
+    put_u16(link + 6, (uint16_t)(int16_t)(temp->fp_dbm * 100.0));
+    link += FRAME_LINK_SIZE;
+    count++;
+  }
+
+  uint16_t body_len = FRAME_BODY_SIZE + count * FRAME_LINK_SIZE;
+  buf[0] = 'S';
+  buf[1] = 'P';
+  buf[2] = FRAME_VERSION;
+  buf[3] = FRAME_TYPE_SNAPSHOT;
+  put_u16(buf + 4, body_len);
+
+  uint8_t *body = buf + FRAME_HEADER_SIZE;
+  put_u16(body, tag_short_address());
+  put_u32(body + 2, frame_seq++);
+  put_u32(body + 6, millis());
+  body[10] = count;
+
+  size_t len = FRAME_HEADER_SIZE + body_len;
+  put_u16(buf + len, crc16(buf, len));
+  return len + 2;
+}
+
+size_t make_samples_frame(uint8_t *buf)
+{
+  static struct Sample taken[FRAME_MAX_SAMPLES];
+  int count;
+
+  // Copy and reset quickly so newRange never waits for the network
+  portENTER_CRITICAL(&samples_mux);
+  count = sample_count;
+  memcpy(taken, samples, count * sizeof(struct Sample));
+  sample_count = 0;
+  portEXIT_CRITICAL(&samples_mux);
+
+  uint32_t now = millis();
+  uint8_t *sample = buf + FRAME_HEADER_SIZE + FRAME_SAMPLES_BODY_SIZE;
+  for (int i = 0; i < count; i++)
+  {
+    uint32_t age = now - taken[i].time;
+    put_u16(sample, taken[i].anchor_addr);
+    put_u16(sample + 2, (uint16_t)(taken[i].range * 1000.0 + 0.5));
+    put_u16(sample + 4, (uint16_t)(int16_t)(taken[i].dbm * 100.0));
+    put_u16(sample + 6, (uint16_t)(int16_t)(taken[i].fp_dbm * 100.0));
+    put_u16(sample + 8, age > 0xFFFF ? 0xFFFF : age);
+    sample += FRAME_SAMPLE_SIZE;
+  }
+
+  uint16_t body_len = FRAME_SAMPLES_BODY_SIZE + count * FRAME_SAMPLE_SIZE;
+  buf[0] = 'S';
+  buf[1] = 'P';
+  buf[2] = FRAME_VERSION;
+  buf[3] = FRAME_TYPE_SAMPLES;
+  put_u16(buf + 4, body_len);
+
+  uint8_t *body = buf + FRAME_HEADER_SIZE;
+  put_u16(body, tag_short_address());
+  put_u32(body + 2, frame_seq++);
+  put_u32(body + 6, now);
+  put_u16(body + 10, count);
+
+  size_t len = FRAME_HEADER_SIZE + body_len;
+  put_u16(buf + len, crc16(buf, len));
+  return len + 2;
+}
 #endif
 
 void newRange()
@@ -282,10 +484,16 @@ void newRange()
   Serial.print(" m");
   Serial.print("\t RX power: ");
   Serial.print(DW1000Ranging.getDistantDevice()->getRXPower());
+  Serial.print(" dBm");
+  Serial.print("\t FP power: ");
+  Serial.print(DW1000Ranging.getDistantDevice()->getFPPower());
   Serial.println(" dBm");
 
 #ifndef PUSHING_ANCHOR_CODE
-  fresh_link(uwb_data, DW1000Ranging.getDistantDevice()->getShortAddress(), DW1000Ranging.getDistantDevice()->getRange(), DW1000Ranging.getDistantDevice()->getRXPower());
+  fresh_link(uwb_data, DW1000Ranging.getDistantDevice()->getShortAddress(), DW1000Ranging.getDistantDevice()->getRange(), DW1000Ranging.getDistantDevice()->getRXPower(), DW1000Ranging.getDistantDevice()->getFPPower());
+#ifdef SEND_RAW_SAMPLES
+  add_sample(DW1000Ranging.getDistantDevice()->getShortAddress(), DW1000Ranging.getDistantDevice()->getRange(), DW1000Ranging.getDistantDevice()->getRXPower(), DW1000Ranging.getDistantDevice()->getFPPower());
+#endif
 #endif
 }
 
@@ -415,6 +623,43 @@ void display_uwb(struct Link *p)
   display.display();
 }
 
+size_t make_heartbeat_frame(uint8_t *buf)
+{
+  buf[0] = 'S';
+  buf[1] = 'P';
+  buf[2] = FRAME_VERSION;
+  buf[3] = FRAME_TYPE_HEARTBEAT;
+  put_u16(buf + 4, FRAME_BODY_SIZE);
+
+  uint8_t *body = buf + FRAME_HEADER_SIZE;
+  put_u16(body, tag_short_address());
+  put_u32(body + 2, frame_seq++);
+  put_u32(body + 6, millis());
+  int count = count_links(uwb_data);
+  body[10] = count > 0xFF ? 0xFF : count;
+
+  size_t len = FRAME_HEADER_SIZE + FRAME_BODY_SIZE;
+  put_u16(buf + len, crc16(buf, len));
+  return len + 2;
+}
+
+bool connect_server()
+{
+  if (WiFi.status() != WL_CONNECTED)
+  {
+    return false; // The Wi-Fi reconnects by itself
+  }
+  if (!client.connect(serverIP, serverPort, CONNECT_TIMEOUT_MS))
+  {
+    client.stop();
+    return false;
+  }
+  Serial.println("Connected to server!");
+  client.setNoDelay(true);
+  client.setTimeout(50);
+  return true;
+}
+
 void send_tcp(String *msg_json)
 {
   if (client.connected())
@@ -423,19 +668,48 @@ void send_tcp(String *msg_json)
   }
 }
 
+void send_tcp_frame(const uint8_t *buf, size_t len)
+{
+  if (client.connected() && client.write(buf, len) != len)
+  {
+    client.stop(); // Server gone, reconnect
+  }
+}
+
 long int runtime = 0;
+long int heartbeat_time = 0;
+long int reconnect_time = 0;
 
 void networkLoop(void *parameter)
 {
   while (1) //Infinite loop
   {
-    if ((millis() - runtime) > 500)
+    if (!client.connected() && (millis() - reconnect_time) > RECONNECT_MS)
+    {
+      reconnect_time = millis();
+      connect_server();
+    }
+
+    if ((millis() - runtime) > SEND_MS)
     {
+#if defined(USE_BINARY_FRAMES) && defined(SEND_RAW_SAMPLES)
+      send_tcp_frame(frame_buffer, make_samples_frame(frame_buffer));
+#elif defined(USE_BINARY_FRAMES)
+      send_tcp_frame(frame_buffer, make_link_frame(uwb_data, frame_buffer));
+#else
       make_link_json(uwb_data, &all_json);
       send_tcp(&all_json);
+#endif
       display_uwb(uwb_data);
-      runtime = millis();
+      runtime = heartbeat_time = millis();
     }
+#ifdef USE_BINARY_FRAMES
+    else if ((millis() - heartbeat_time) > HEARTBEAT_MS)
+    {
+      send_tcp_frame(frame_buffer, make_heartbeat_frame(frame_buffer));
+      heartbeat_time = millis();
+    }
+#endif
     vTaskDelay(10 / portTICK_PERIOD_MS); // Small delay
   }
 }
@@ -481,16 +755,9 @@ void setup()
   Serial.print("IP address: ");
   Serial.println(WiFi.localIP());
 
-  if (client.connect(serverIP, serverPort))
+  if (!connect_server())
   {
-    Serial.println("Connected to server!");
-    client.setNoDelay(true);
-    client.setTimeout(50);
-  }
-  else
-  {
-    client.stop();
-    Serial.print("Connection failed. WiFi status: ");
+    Serial.println("Connection failed, retrying from the network task");
   }
 #endif
 